@@ -6,7 +6,11 @@ variants_file : str : CSV file containing variants with columns: contig, start,
                     variants" file that vaxrank outputs here.
 --bam : str, str    : Label and path to BAM file (can be repeated for multiple BAM files)
 --vcf : str, str    : Label and path to VCF file (can also be repeated)
---output : str      : Output CSV file to save the results
+--output : str      : Output file to save the results (.csv, .parquet or .feather)
+--sweep             : Count all variants in one sorted pass over each contig of each BAM
+--jobs : int        : Number of processes to spread the BAM annotation over
+--chunk-size : int  : Annotate this many variants at a time, appending each chunk to the output
+--store : str       : Database of earlier results, so that only loci never counted before are counted
 
 Example:
 python count_alleles_varcode_tqdm_rna.py \
@@ -29,18 +33,164 @@ are not marked as duplicates.
 *****************************
 """.strip())
 
+from collections import OrderedDict
+import gzip
+from os.path import splitext
 import pysam
 import numpy as np
 import pandas as pd
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
-import varcode
-import pysam
-import pandas as pd
+from annotation_store import AnnotationStore
+from contigs import ContigIndex, canonical_contig_name
+
+
+VCF_ALLELE_COUNT_SUFFIXES = ["ref_count", "alt_count", "depth", "vaf"]
+
+# Version of the BAM and VCF allele counting, which results in the annotation store are keyed on.
+# Bump it whenever a change would count other values from the same files.
+COUNTING_VERSION = 1
+
+
+def normalize_variant(contig, start, ref, alt):
+    """
+    Normalize a variant the way varcode.Variant does, by trimming the prefix and suffix shared
+    between the reference and alternate alleles.
+
+    Returns:
+    tuple: (contig, start, ref, alt), where start is the base before the inserted sequence for
+        insertions.
+    """
+    start = int(start)
+    ref = "" if ref in ".-" else ref.upper()
+    alt = "" if alt in ".-" else alt.upper()
+    prefix_length = 0
+    while (prefix_length < min(len(ref), len(alt)) and
+            ref[prefix_length] == alt[prefix_length]):
+        prefix_length += 1
+    ref = ref[prefix_length:]
+    alt = alt[prefix_length:]
+    suffix_length = 0
+    while (suffix_length < min(len(ref), len(alt)) and
+            ref[-suffix_length - 1] == alt[-suffix_length - 1]):
+        suffix_length += 1
+    if suffix_length:
+        ref = ref[:-suffix_length]
+        alt = alt[:-suffix_length]
+    if ref:
+        start += prefix_length
+    else:
+        start += max(0, prefix_length - 1)
+    return canonical_contig_name(contig), start, ref, alt
+
+
+def parse_vcf_numbers(value):
+    """
+    Parse a comma separated VCF sample field into a list of floats, with NaN for missing values.
+    """
+    if value is None:
+        return []
+    return [np.nan if x in (".", "") else float(x) for x in value.split(",")]
+
+
+def sample_allele_counts(format_keys, sample, alt_index):
+    """
+    Allele counts for one alternate allele of a VCF record, from one sample column.
+
+    Multi-allelic records give one value per allele (AD) or per alternate allele (AF, FA), and
+    we pick out the ones for the given allele.
+
+    Returns:
+    list: [ref_count, alt_count, depth, vaf], with NaN for the values that aren't available.
+    """
+    fields = dict(zip(format_keys, sample.split(":")))
+
+    def allele_value(values):
+        if len(values) == 1:
+            return values[0]
+        return values[alt_index] if alt_index < len(values) else np.nan
 
+    allele_depths = parse_vcf_numbers(fields.get("AD"))
+    if len(allele_depths) > alt_index + 1:
+        ref_count, alt_count = allele_depths[0], allele_depths[alt_index + 1]
+    else:
+        ref_count = alt_count = np.nan
 
-def annotate_from_vcf(vcf_file, variants_df, label):
+    af = allele_value(parse_vcf_numbers(fields.get("AF"))) if "AF" in fields else np.nan
+    vaf = allele_value(parse_vcf_numbers(fields.get("FA"))) if "FA" in fields else af
+
+    if "DP" in fields:
+        depth = parse_vcf_numbers(fields["DP"])[0]
+    elif af == 0:
+        depth = 0 if alt_count == 0 else np.nan
+    else:
+        # Guess the depth from alt count and VAF
+        depth = alt_count / af
+    return [ref_count, alt_count, depth, vaf]
+
+
+def read_vcf_allele_counts(vcf_file):
+    """
+    Read the normal and tumor allele counts of each passing variant in a VCF file.
+
+    This is a plain line reader rather than varcode.load_vcf, which needs to resolve a reference
+    genome and builds a Variant object with all of the INFO and sample metadata for each record.
+    As in varcode, only records with a FILTER of "PASS" or "." are kept, each alternate allele is
+    a separate variant, and variants are normalized (see normalize_variant). The tumor and
+    normal samples are the ones with "tumor" and "normal" in their names.
+
+    Returns:
+    dict: Maps each (contig, start, ref, alt) to a list of the normal ref count, alt count,
+        depth and VAF, followed by the same for the tumor.
+    """
+    open_fn = gzip.open if vcf_file.endswith(".gz") else open
+    records = {}
+    with open_fn(vcf_file, "rt") as f:
+        for line in f:
+            if line.startswith("##"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if line.startswith("#"):
+                sample_names = fields[9:]
+                tumor_index, = [i for (i, s) in enumerate(sample_names) if "tumor" in s.lower()]
+                normal_index, = [i for (i, s) in enumerate(sample_names) if "normal" in s.lower()]
+                continue
+            contig, pos, _, ref, alts, _, vcf_filter = fields[:7]
+            if vcf_filter not in ("PASS", "."):
+                continue
+            format_keys = fields[8].split(":")
+            samples = fields[9:]
+            for alt_index, alt in enumerate(alts.split(",")):
+                # skip missing and symbolic alleles
+                if not set(alt.upper()) <= set("ACGTN"):
+                    continue
+                records[normalize_variant(contig, pos, ref, alt)] = (
+                    sample_allele_counts(format_keys, samples[normal_index], alt_index) +
+                    sample_allele_counts(format_keys, samples[tumor_index], alt_index))
+    return records
+
+
+def vcf_columns(label):
+    return [
+        f'{label}_{kind}_{suffix}'
+        for kind in ["normal", "tumor"]
+        for suffix in VCF_ALLELE_COUNT_SUFFIXES
+    ]
+
+
+def empty_vcf_columns(records, label):
+    """
+    Columns that annotate_from_vcf would fill with NaN for every variant in the VCF.
+    """
+    if not records:
+        return []
+    values = np.array(list(records.values()), dtype=np.float64)
+    return [col for (col, empty) in zip(vcf_columns(label), np.isnan(values).all(axis=0)) if empty]
+
+
+def annotate_from_vcf(vcf_file, variants_df, label, records=None, drop_columns=None):
     """
     Annotate allelic depths and VAFs from a VCF file.
 
@@ -58,316 +208,834 @@ def annotate_from_vcf(vcf_file, variants_df, label):
     - {label}_tumor_depth - Depth in tumor sample
     - {label}_tumor_vaf - Variant allele frequency in tumor sample
     - {label} - Boolean indicating whether the variant was found in the VCF file
+
+    Columns that are NaN for every variant are dropped. When annotating in chunks, pass the
+    records read once with read_vcf_allele_counts, and drop_columns from empty_vcf_columns so
+    that every chunk ends up with the same columns.
     """
-    vcf = varcode.load_vcf(vcf_file)
-    metadata = vcf.metadata
+    if records is None:
+        records = read_vcf_allele_counts(vcf_file)
+    columns = vcf_columns(label)
 
     # Initialize new columns in the DataFrame
-    for kind in ["normal", "tumor"]:
-        variants_df[f'{label}_{kind}_ref_count'] = np.nan
-        variants_df[f'{label}_{kind}_alt_count'] = np.nan
-        variants_df[f'{label}_{kind}_depth'] = np.nan
-        variants_df[f'{label}_{kind}_vaf'] = np.nan
+    for col in columns:
+        variants_df[col] = np.nan
 
     variants_df[label] = False
 
-    if not vcf.variants:
+    if not records:
         return variants_df
 
-    example_variant = vcf.variants[0]
+    vcf_df = pd.DataFrame(
+        list(records.values()),
+        index=pd.MultiIndex.from_tuples(list(records)),
+        columns=columns,
+        dtype=np.float64)
+    keys = pd.MultiIndex.from_tuples([
+        normalize_variant(*row)
+        for row in variants_df[['contig', 'start', 'ref', 'alt']].itertuples(index=False)
+    ])
+    matched = vcf_df.reindex(keys)
+    for col in columns:
+        variants_df[col] = matched[col].values
+    variants_df[label] = keys.isin(vcf_df.index)
+
+    if drop_columns is None:
+        drop_columns = [col for col in columns if variants_df[col].isnull().all()]
+    for col in drop_columns:
+        print("Dropping col (all nan)", col)
+        del variants_df[col]
 
-    variants = [
-        varcode.Variant(
-            contig=row.contig,
-            start=row.start,
-            ref=row.ref,
-            alt=row.alt,
-            genome=example_variant.reference_name)
-        for _, row in variants_df.iterrows()
-    ]
+    print(f"Annotated {label} variants: {variants_df[label].sum()} of {len(variants_df)}")
+    return variants_df
 
-    sample_names = metadata[example_variant]["sample_info"]
-    tumor_sample_name, = [s for s in sample_names if "tumor" in s.lower()]
-    normal_sample_name, = [s for s in sample_names if "normal" in s.lower()]
-
-    for ((idx, row), variant) in zip(variants_df.iterrows(), variants):
-        info = metadata.get(variant)
-        if info is not None:
-            d = {
-                "normal": info["sample_info"][normal_sample_name],
-                "tumor": info["sample_info"][tumor_sample_name],
-            }
-            for kind in ["normal", "tumor"]:
-                sample_info = d[kind]
-                if "DP" in sample_info:
-                    depth = sample_info["DP"]
-                else:
-                    try:
-                        depth = sample_info["AD"][1] / sample_info["AF"]  # Guess the depth from alt count and VAF
-                    except ZeroDivisionError:
-                        if sample_info["AD"][1] == 0:
-                            depth = 0
-                        else:
-                            depth = np.nan
-                variants_df.loc[idx, f'{label}_{kind}_depth'] = depth
-
-                if "FA" in sample_info:
-                    variants_df.loc[idx, f'{label}_{kind}_vaf'] = sample_info["FA"]
-                elif "AF" in sample_info:
-                    variants_df.loc[idx, f'{label}_{kind}_vaf'] = sample_info["AF"]
-
-                if "AD" in sample_info:
-                    ref_count, alt_count = sample_info["AD"]
-                else:
-                    ref_count = alt_count = np.nan
+# CIGAR operation codes, as used by pysam.AlignedSegment.cigartuples:
+# M=0, I=1, D=2, N=3, S=4, H=5, P=6, '='=7, X=8, B=9
+CIGAR_SKIP = 3
+CIGAR_SOFT_CLIP = 4
+CIGAR_CONSUMES_QUERY = np.array([1, 1, 0, 0, 1, 0, 0, 1, 1, 0], dtype=bool)
+CIGAR_CONSUMES_REFERENCE = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1, 0], dtype=bool)
 
-                variants_df.loc[idx, f'{label}_{kind}_ref_count'] = ref_count
-                variants_df.loc[idx, f'{label}_{kind}_alt_count'] = alt_count
+# Default size of the decoded read cache, in aligned pairs (about 64MB)
+READ_CACHE_MAX_PAIRS = 2000000
 
-                variants_df.loc[idx, f"{label}"] = True
+# When sweeping over a contig, variants further apart than this get separate region queries
+# rather than streaming through all the reads between them.
+SWEEP_MAX_GAP = 2000
 
-    for kind in ["normal", "tumor"]:
-        for suffix in ["ref_count", "alt_count", "depth", "vaf"]:
-            col = f'{label}_{kind}_{suffix}'
-            if variants_df[col].isnull().all():
-                print("Dropping col (all nan)", col)
-                del variants_df[col]
 
-    print(f"Annotated {label} variants: {variants_df[label].sum()} of {len(variants_df)}")
-    return variants_df
+class DecodedReads(object):
+    """
+    Alignments of a batch of reads, decoded from their CIGAR strings and sequences into flat
+    NumPy arrays.
+
+    There is one entry per aligned pair that can be counted, in the order pysam's
+    get_aligned_pairs() would return them for each read. Skips (e.g. introns in RNA reads) and
+    soft clips never count, so they only shift the positions of the following entries, and hard
+    clips and padding aren't aligned pairs at all:
+    - read_ids: index of the read the entry belongs to.
+    - reference_positions: 0-based reference position. For insertions this is the last
+      reference position before the entry (i.e. forward-filled), or -1 if there is none.
+    - query_positions: 0-based position in the read sequence, -1 for deletions.
+    - bases: read base as an ASCII code, 0 where the entry has no base.
+    - aligned: whether the entry consumes the reference.
+    """
+    READ_FIELDS = ["reference_positions", "query_positions", "bases", "aligned"]
+    READ_FIELD_DTYPES = [np.int64, np.int64, np.uint8, bool]
+
+    def __init__(self, reads):
+        self.num_reads = len(reads)
+        cigars = [read.cigartuples or [] for read in reads]
+        cigar = np.array(
+            [op for read_cigar in cigars for op in read_cigar], dtype=np.int64).reshape(-1, 2)
+        op_read_ids = np.repeat(np.arange(self.num_reads), [len(c) for c in cigars])
+        ops, op_lengths = cigar[:, 0], cigar[:, 1]
+
+        # per-read offsets of the first query and reference base of each operation
+        read_first_ops = np.searchsorted(op_read_ids, np.arange(self.num_reads))
+        op_query_lengths = np.where(CIGAR_CONSUMES_QUERY[ops], op_lengths, 0)
+        op_reference_lengths = np.where(CIGAR_CONSUMES_REFERENCE[ops], op_lengths, 0)
+        op_query_offsets = (
+            self._cumsum_per_read(op_query_lengths, op_read_ids, read_first_ops) -
+            op_query_lengths)
+        op_reference_offsets = (
+            self._cumsum_per_read(op_reference_lengths, op_read_ids, read_first_ops) -
+            op_reference_lengths)
+
+        counted = (
+            (CIGAR_CONSUMES_QUERY[ops] | CIGAR_CONSUMES_REFERENCE[ops]) &
+            (ops != CIGAR_SKIP) & (ops != CIGAR_SOFT_CLIP))
+        ops = ops[counted]
+        op_lengths = op_lengths[counted]
+        op_read_ids = op_read_ids[counted]
+        op_query_offsets = op_query_offsets[counted]
+        op_reference_offsets = op_reference_offsets[counted]
+
+        # expand the operations into one entry per base
+        entry_ops = np.repeat(np.arange(len(ops)), op_lengths)
+        offsets_in_op = np.arange(len(entry_ops)) - np.repeat(
+            np.cumsum(op_lengths) - op_lengths, op_lengths)
+        self.read_ids = op_read_ids[entry_ops]
+        self.aligned = CIGAR_CONSUMES_REFERENCE[ops][entry_ops]
+        consumes_query = CIGAR_CONSUMES_QUERY[ops][entry_ops]
+
+        # number of reference bases consumed up to and including each entry
+        reference_offsets = op_reference_offsets[entry_ops] + np.where(
+            self.aligned, offsets_in_op + 1, 0)
+        reference_starts = np.array([read.reference_start for read in reads], dtype=np.int64)
+        self.reference_positions = np.where(
+            reference_offsets > 0, reference_starts[self.read_ids] + reference_offsets - 1, -1)
+        self.query_positions = np.where(
+            consumes_query, op_query_offsets[entry_ops] + offsets_in_op, -1)
+
+        sequences = [read.query_sequence or "" for read in reads]
+        sequence_lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+        sequence_starts = np.cumsum(sequence_lengths) - sequence_lengths
+        all_bases = np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)
+        has_base = (
+            (self.query_positions >= 0) &
+            (self.query_positions < sequence_lengths[self.read_ids]))
+        self.bases = np.zeros(len(entry_ops), dtype=np.uint8)
+        self.bases[has_base] = all_bases[
+            sequence_starts[self.read_ids[has_base]] + self.query_positions[has_base]]
+
+    @staticmethod
+    def _cumsum_per_read(values, read_ids, read_first_indices):
+        totals = np.cumsum(values)
+        totals_before_read = np.concatenate([[0], totals])[read_first_indices]
+        return totals - totals_before_read[read_ids]
+
+    def split(self):
+        """
+        Entries of each read, as (len(READ_FIELDS), num_entries) int64 arrays.
+        """
+        entries = np.array([getattr(self, field) for field in self.READ_FIELDS], dtype=np.int64)
+        boundaries = np.searchsorted(self.read_ids, np.arange(self.num_reads + 1))
+        return [
+            entries[:, begin:end].copy()
+            for (begin, end) in zip(boundaries[:-1], boundaries[1:])
+        ]
 
-def get_aligned_pairs_with_cigar(read):
+    @classmethod
+    def from_split(cls, reads_entries):
+        """
+        Batch of reads from the per-read entries returned by split().
+        """
+        decoded_reads = cls([])
+        if reads_entries:
+            entries = np.concatenate(reads_entries, axis=1)
+            decoded_reads.num_reads = len(reads_entries)
+            decoded_reads.read_ids = np.repeat(
+                np.arange(len(reads_entries)),
+                np.fromiter((e.shape[1] for e in reads_entries), np.int64, len(reads_entries)))
+            for (field, dtype, values) in zip(cls.READ_FIELDS, cls.READ_FIELD_DTYPES, entries):
+                setattr(decoded_reads, field, values.astype(dtype, copy=False))
+        return decoded_reads
+
+    def count_per_read(self, entries):
+        """
+        Number of entries selected by the boolean mask `entries`, for each read.
+        """
+        return np.bincount(self.read_ids[entries], minlength=self.num_reads)
+
+    def sequence_equals(self, entries, allele):
+        """
+        For each read, whether the bases of the entries selected by the boolean mask `entries`
+        spell out the given allele.
+        """
+        indices = np.flatnonzero(entries & (self.bases != 0))
+        read_ids = self.read_ids[indices]
+        num_bases = np.bincount(read_ids, minlength=self.num_reads)
+        if len(allele) == 0:
+            return num_bases == 0
+        allele_bases = np.frombuffer(allele.encode("ascii"), dtype=np.uint8)
+        rank_in_read = np.arange(len(indices)) - np.searchsorted(read_ids, read_ids)
+        matches = (
+            (rank_in_read < len(allele_bases)) &
+            (self.bases[indices] == allele_bases[np.minimum(rank_in_read, len(allele_bases) - 1)]))
+        num_mismatches = np.bincount(read_ids[~matches], minlength=self.num_reads)
+        return (num_bases == len(allele_bases)) & (num_mismatches == 0)
+
+
+class DecodedReadCache(object):
     """
-    Get aligned pairs with the CIGAR operation and read sequence at each position.
+    LRU cache of decoded reads, so that reads overlapping several nearby variants are only
+    decoded once.
+
+    Reads are identified by their (query name, flag, reference start). The cache size is bounded
+    by the total number of aligned pairs of the cached reads, which take 32 bytes each.
+    """
+    def __init__(self, max_pairs=READ_CACHE_MAX_PAIRS):
+        self.max_pairs = max_pairs
+        self.num_pairs = 0
+        self.hits = 0
+        self.misses = 0
+        self._reads = OrderedDict()
+
+    def decode(self, reads):
+        """
+        DecodedReads for the given reads, only decoding the ones that aren't in the cache.
+        """
+        keys = [(read.query_name, read.flag, read.reference_start) for read in reads]
+        missing = []
+        for (i, key) in enumerate(keys):
+            if key in self._reads:
+                self._reads.move_to_end(key)
+            else:
+                missing.append(i)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        missing_reads = DecodedReads([reads[i] for i in missing])
+        decoded = dict(zip([keys[i] for i in missing], missing_reads.split()))
+        if len(missing) == len(keys):
+            # nothing to put together from the cache
+            result = missing_reads
+        else:
+            result = DecodedReads.from_split(
+                [decoded[key] if key in decoded else self._reads[key] for key in keys])
+
+        for (key, read_entries) in decoded.items():
+            self._reads[key] = read_entries
+            self.num_pairs += read_entries.shape[1]
+        while self.num_pairs > self.max_pairs:
+            _, read_entries = self._reads.popitem(last=False)
+            self.num_pairs -= read_entries.shape[1]
+
+        return result
+
+
+def count_alleles(decoded_reads, start, ref, alt):
+    """
+    Count the reads supporting the reference and alternate alleles of a variant.
+
+    Deletions: a read covers the deletion if it has (non-skipped) pairs in the deleted interval.
+    If the read contains an insertion, it must have pairs for both the first and last deleted
+    position. It supports the alternate allele if all of those pairs are deletions, and the
+    reference allele if none of them are.
+
+    Insertions: a read covers the insertion if it has a pair at the preceding position. The bases
+    inserted after that pair are compared to the alternate and reference alleles.
+
+    Substitutions: a read covers the substitution if it has pairs in the substituted interval. Its
+    bases in that interval (including any inserted bases) are compared to the alleles.
 
     Parameters:
-    read (pysam.AlignedSegment): A read from a BAM file.
+    decoded_reads (DecodedReads): Reads overlapping the variant.
+    start (int): 1-based variant position, using varcode's conventions for indels.
+    ref (str): Reference allele ("" for insertions).
+    alt (str): Alternate allele ("" for deletions).
 
     Returns:
-    pd.DataFrame: A DataFrame containing the reference position, read position, CIGAR operation, and read base.
-    """
-    aligned_pairs = read.get_aligned_pairs(with_seq=False)
-    cigar_operations = read.cigartuples
-
-    # Create lists to hold the result
-    ref_positions = []
-    read_positions = []
-    cigar_ops = []
-    read_bases = []
-
-    # Variables to track the current position in the read and reference
-    read_index = 0
-
-    for operation, length in cigar_operations:
-        for _ in range(length):
-            if read_index < len(aligned_pairs):
-                read_pos, ref_pos = aligned_pairs[read_index]
-
-                if operation == 0:  # Match or mismatch
-                    cigar_op = 'M'
-                elif operation == 1:  # Insertion
-                    cigar_op = 'I'
-                elif operation == 2:  # Deletion
-                    cigar_op = 'D'
-                elif operation == 3:  # Skip (N)
-                    cigar_op = 'N'
-                elif operation == 4:  # Soft clipping
-                    cigar_op = 'S'
-                elif operation == 5:  # Hard clipping
-                    cigar_op = 'H'
-                elif operation == 6:  # Padding (P)
-                    cigar_op = 'P'
-                else:
-                    cigar_op = None
+    tuple: (ref_count, alt_count, total_depth)
+    """
+    reads = decoded_reads
+    position = start - 1
+    in_window = reads.reference_positions >= position
+
+    if alt == "":
+        # Handle deletion
+        last_position = position + len(ref) - 1
+        inserted = ~reads.aligned
+        entries = (
+            in_window &
+            (reads.reference_positions <= last_position) &
+            ~(inserted & (reads.reference_positions == last_position)))
+        has_insertion = reads.count_per_read(inserted) > 0
+        has_ends = (
+            (reads.count_per_read(reads.aligned & (reads.reference_positions == position)) > 0) &
+            (reads.count_per_read(reads.aligned & (reads.reference_positions == last_position)) > 0))
+        covers = (reads.count_per_read(entries) > 0) & (~has_insertion | has_ends)
+        has_query = reads.query_positions >= 0
+        supports_alt = reads.count_per_read(entries & has_query) == 0
+        supports_ref = reads.count_per_read(entries & ~has_query) == 0
+
+    else:
+        if ref == "":
+            # Handle insertion: the first pair is the base before the inserted sequence
+            entries = in_window & (reads.reference_positions == position)
+            covers = reads.count_per_read(entries) > 0
+            indices = np.flatnonzero(entries)
+            first_in_read = np.ones(len(indices), dtype=bool)
+            first_in_read[1:] = reads.read_ids[indices[1:]] != reads.read_ids[indices[:-1]]
+            entries = entries.copy()
+            entries[indices[first_in_read]] = False
+        else:
+            np.testing.assert_equal(len(ref), len(alt))
+            # Handle substitution
+            entries = in_window & (reads.reference_positions < position + len(ref))
+            covers = reads.count_per_read(entries) > 0
+        supports_alt = reads.sequence_equals(entries, alt)
+        supports_ref = reads.sequence_equals(entries, ref)
 
-                if read_pos is not None and read_pos < len(read.query_sequence):
-                    read_base = read.query_sequence[read_pos]
-                else:
-                    read_base = None
+    total_depth = int(covers.sum())
+    alt_count = int((covers & supports_alt).sum())
+    ref_count = int((covers & ~supports_alt & supports_ref).sum())
+    return ref_count, alt_count, total_depth
 
-                ref_positions.append(ref_pos)
-                read_positions.append(read_pos)
-                cigar_ops.append(cigar_op)
-                read_bases.append(read_base)
 
-                read_index += 1
+def find_bam_contigs(bam, contigs):
+    """
+    Names in the BAM file of the given (varcode-normalized) contigs, looked up in an alias index
+    of the BAM header.
 
-    df = pd.DataFrame({
-        'reference_position': ref_positions,
-        'read_position': read_positions,
-        'cigar_operation': cigar_ops,
-        'read_base': read_bases
-    })
-    df['reference_position'] = df['reference_position'].astype(float)
-    df['read_position'] = df['read_position'].astype(float)
-    return df
+    Returns:
+    dict: Maps each contig to its name in the BAM file.
+    """
+    contig_index = ContigIndex(bam.references)
+    missing = [contig for contig in contigs if contig not in contig_index]
+    if missing:
+        raise ValueError(
+            f"Could not find {missing} in BAM file {bam.filename.decode()}. "
+            f"Valid contigs are: {bam.references}")
+    return {contig: contig_index[contig] for contig in contigs}
+
+
+def is_counted(read, min_mapq):
+    # Exclude reads with very low mapping quality or that are marked as duplicates.
+    return read.mapping_quality >= min_mapq and not read.is_duplicate
 
-def annotate_from_bam(bam_file, variants_df, label, min_mapq=10):
+
+def alignment_end(read):
     """
-    Function to count reads supporting reference and alternate alleles for given variants in a BAM file.
+    End of the read's alignment (exclusive), as htslib computes it for region queries.
+    """
+    end = read.reference_end
+    if end is None or end == read.reference_start:
+        return read.reference_start + 1
+    return end
+
+
+def decode_reads(reads, cache=None):
+    return cache.decode(reads) if cache is not None else DecodedReads(reads)
+
+
+def count_loci_by_fetch(bam, loci, min_mapq, desc=None, cache=None):
+    """
+    Count alleles for each locus with its own region query.
 
     Parameters:
-    bam_file (str): Path to the BAM file.
-    variants_df (pd.DataFrame): DataFrame containing variants with columns 'contig', 'start', 'ref', 'alt'.
-    label (str): Label for the BAM file (used to name the count columns).
+    bam (pysam.AlignmentFile): Indexed BAM file.
+    loci (list of tuples): (bam_contig, start, ref, alt) for each locus.
+    min_mapq (int): Minimum mapping quality of counted reads.
+    desc (str): Description for the progress bar, or None to not show one.
+    cache (DecodedReadCache): Cache of decoded reads, or None to decode the reads for each locus.
 
     Returns:
-    pd.DataFrame: DataFrame with additional columns for read counts and depth.
+    np.ndarray: (ref_count, alt_count, total_depth) for each locus, shape (len(loci), 3).
     """
-    # Open the BAM file
-    bam = pysam.AlignmentFile(bam_file, "rb")
+    counts = np.zeros((len(loci), 3), dtype=np.int64)
+    for i, (contig, start, ref, alt) in enumerate(tqdm(loci, desc=desc, disable=desc is None)):
+        reads = [read for read in bam.fetch(contig, start - 1, start) if is_counted(read, min_mapq)]
+        counts[i] = count_alleles(decode_reads(reads, cache), start, ref, alt)
+    return counts
+
+
+def count_loci_by_sweep(bam, loci, min_mapq, desc=None, cache=None, max_gap=SWEEP_MAX_GAP):
+    """
+    Count alleles for each locus in a single forward pass over each contig.
+
+    Loci are sorted by position and the reads overlapping them are streamed in order, keeping
+    a window of the reads that overlap the current locus. A new region query is only started
+    when the next locus is more than `max_gap` bases past the previous one, so that nearby loci
+    share BGZF blocks and reads, but long stretches without variants are skipped.
 
-    # index the bam if needed
+    Parameters are the same as for count_loci_by_fetch.
+    """
+    counts = np.zeros((len(loci), 3), dtype=np.int64)
+    order = sorted(range(len(loci)), key=lambda i: (loci[i][0], loci[i][1]))
+    progress = tqdm(total=len(loci), desc=desc, disable=desc is None)
+
+    i = 0
+    while i < len(order):
+        # find the block of loci that share a single region query
+        contig = loci[order[i]][0]
+        block_end = i + 1
+        while (block_end < len(order) and
+                loci[order[block_end]][0] == contig and
+                loci[order[block_end]][1] - loci[order[block_end - 1]][1] <= max_gap):
+            block_end += 1
+        block = order[i:block_end]
+
+        reads = bam.fetch(contig, loci[block[0]][1] - 1, loci[block[-1]][1])
+        next_read = next(reads, None)
+        window = []
+        for locus_index in block:
+            _, start, ref, alt = loci[locus_index]
+            position = start - 1
+            while next_read is not None and next_read.reference_start <= position:
+                if is_counted(next_read, min_mapq):
+                    window.append((alignment_end(next_read), next_read))
+                next_read = next(reads, None)
+            window = [(end, read) for (end, read) in window if end > position]
+            counts[locus_index] = count_alleles(
+                decode_reads([read for (_, read) in window], cache), start, ref, alt)
+            progress.update()
+        i = block_end
+
+    progress.close()
+    return counts
+
+
+def open_indexed_bam(bam_file):
+    """
+    Open a BAM file, indexing it first if needed.
+    """
+    bam = pysam.AlignmentFile(bam_file, "rb")
     if not bam.has_index():
         print(f"Indexing {bam_file}")
+        bam.close()
         pysam.index(bam_file)
         bam = pysam.AlignmentFile(bam_file, "rb")
+    return bam
 
-    # Initialize new columns in the DataFrame
-    variants_df[f'{label}_ref_count'] = 0
-    variants_df[f'{label}_alt_count'] = 0
-    variants_df[f'{label}_depth'] = 0
-    variants_df[f'{label}_vaf'] = np.nan
-
-    # Iterate over each variant
-    for idx, row in tqdm(variants_df.iterrows(), total=variants_df.shape[0],
-            desc=f"Annotating {label}"):
-        contig = row['contig']
-        start = row['start']
-        ref = row['ref']
-        alt = row['alt']
-
-        ref_count = 0
-        alt_count = 0
-        total_depth = 0
-
-        # Deal with varcode name mangling
-        possible_contigs = [contig, "chr" + contig]
-        if contig == "MT":
-            possible_contigs.append("M")
-            possible_contigs.append("chrM")
-
-        correct_contig = None
-        reads = None
-        for possible_contig in possible_contigs:
-            try:
-                reads = bam.fetch(possible_contig, start - 1, start)
-                correct_contig = possible_contig
-                break
-            except ValueError:
-                pass
-        if correct_contig is None:
-            raise ValueError(
-                f"Could not find any of {possible_contigs} in BAM file {bam_file}. Valid contigs are: {bam.references}")
 
-        variants_df.at[idx, 'unmangled_contig'] = correct_contig
+def get_loci(bam, variants_df):
+    """
+    Deduplicate the (contig, start, ref, alt) loci of the variants.
 
-        # Exclude reads with very low mapping quality or that are marked as duplicates.
-        reads = [
-            read for read in reads
-            if read.mapping_quality >= min_mapq and not read.is_duplicate
-        ]
+    Returns:
+    tuple: (loci, locus_ids, unmangled_contigs) where loci is a list of
+        (bam_contig, start, ref, alt) tuples, locus_ids gives the index in loci of each variant,
+        and unmangled_contigs gives the BAM contig name of each variant.
+    """
+    keys = variants_df[['contig', 'start', 'ref', 'alt']]
+    locus_ids = keys.groupby(list(keys.columns), sort=False).ngroup().values
+    bam_contigs = find_bam_contigs(bam, keys['contig'].unique())
+    loci = [
+        (bam_contigs[contig], int(start), ref, alt)
+        for (contig, start, ref, alt) in keys.drop_duplicates().itertuples(index=False)
+    ]
+    return loci, locus_ids, keys['contig'].map(bam_contigs).values
 
-        if alt == "":
-            # Handle deletion
-            num_bases_deleted = len(ref)
-            for read in reads:
-                read_positions = get_aligned_pairs_with_cigar(read)
-                read_positions = read_positions.loc[
-                    (~read_positions.cigar_operation.isin(['N', 'S']))
-                ]
-
-                try:
-                    relevant_read_positions = read_positions.set_index("reference_position").loc[
-                        start - 1 :
-                        start - 1 + num_bases_deleted - 1
-                    ]
-                except KeyError:
-                    continue
 
-                if len(relevant_read_positions) > 0:
-                    total_depth += 1
-                    if relevant_read_positions.read_position.isnull().all():
-                        alt_count += 1
-                    elif (~relevant_read_positions.read_position.isnull()).all():
-                        ref_count += 1
-
-        elif ref == "":
-            # Handle insertion
-            for read in reads:
-                read_positions = get_aligned_pairs_with_cigar(read)
-                read_positions["reference_position"] = read_positions["reference_position"].fillna(method="ffill")
-                relevant_read_positions = read_positions.loc[
-                    (~read_positions.cigar_operation.isin(['N', 'S'])) &
-                    (read_positions.reference_position == start - 1)
-                ]
-                if len(relevant_read_positions) > 0:
-                    total_depth += 1
-                    read_sequence = "".join(relevant_read_positions.iloc[1:].read_base.fillna(""))
-                    if read_sequence == alt:
-                        alt_count += 1
-                    elif read_sequence == ref:
-                        ref_count += 1
+def count_loci(
+        bam_file,
+        loci,
+        min_mapq=10,
+        sweep=False,
+        desc=None,
+        read_cache_size=READ_CACHE_MAX_PAIRS):
+    """
+    Count alleles for each locus in a BAM file, using its own file handle and read cache so that
+    it can run in a worker process.
 
+    Returns:
+    tuple: (counts, read_cache_stats), where counts has the (ref_count, alt_count, total_depth)
+        for each locus, shape (len(loci), 3), and read_cache_stats is an array of the
+        (hits, misses) of the decoded read cache.
+    """
+    cache = DecodedReadCache(read_cache_size) if read_cache_size > 0 else None
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        if sweep:
+            counts = count_loci_by_sweep(bam, loci, min_mapq, desc=desc, cache=cache)
         else:
-            np.testing.assert_equal(len(ref), len(alt))
-            # Handle substitution
-            for read in reads:
-                read_positions = get_aligned_pairs_with_cigar(read)
-                read_positions["reference_position"] = read_positions["reference_position"].fillna(method="ffill")
-                relevant_read_positions = read_positions.loc[
-                    (~read_positions.cigar_operation.isin(['N', 'S'])) &
-                    (read_positions.reference_position >= start - 1) &
-                    (read_positions.reference_position < start - 1 + len(ref))
-                ]
-
-                if len(relevant_read_positions) > 0:
-                    total_depth += 1
-                    read_sequence = "".join(relevant_read_positions.read_base.fillna(""))
-                    if read_sequence == alt:
-                        alt_count += 1
-                    elif read_sequence == ref:
-                        ref_count += 1
-
-        # Update the counts and depth in the DataFrame
-        variants_df.at[idx, f'{label}_ref_count'] = ref_count
-        variants_df.at[idx, f'{label}_alt_count'] = alt_count
-        variants_df.at[idx, f'{label}_depth'] = total_depth
-        if total_depth > 0:
-            variants_df.at[idx, f'{label}_vaf'] = alt_count / total_depth
-
-    # Close the BAM file
-    bam.close()
+            counts = count_loci_by_fetch(bam, loci, min_mapq, desc=desc, cache=cache)
+    read_cache_stats = np.array([cache.hits, cache.misses] if cache is not None else [0, 0])
+    return counts, read_cache_stats
+
+
+def report_read_cache(label, read_cache_stats):
+    hits, misses = read_cache_stats
+    if hits + misses:
+        print(
+            f"Decoded read cache for {label}: {hits} hits, {misses} misses "
+            f"({100 * hits / (hits + misses):.1f}% hit rate)")
 
+
+def lookup_loci(store, bam_file, loci, min_mapq):
+    """
+    Counts of the loci that the annotation store already has for a BAM file, and the indices of
+    the loci still to count (all of them without a store).
+    """
+    if store is None:
+        return np.zeros((len(loci), 3), dtype=np.int64), list(range(len(loci)))
+    return store.lookup_counts(bam_file, min_mapq, loci)
+
+
+def set_bam_columns(variants_df, label, counts, locus_ids, unmangled_contigs):
+    """
+    Add the count columns for a BAM file to the DataFrame.
+    """
+    ref_counts, alt_counts, depths = counts[locus_ids].T
+    variants_df['unmangled_contig'] = unmangled_contigs
+    variants_df[f'{label}_ref_count'] = ref_counts
+    variants_df[f'{label}_alt_count'] = alt_counts
+    variants_df[f'{label}_depth'] = depths
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variants_df[f'{label}_vaf'] = np.where(depths > 0, alt_counts / depths, np.nan)
     return variants_df
 
 
-def main(variants_file, bam_files, vcf_files, output_file):
-    print(disclaimer)
+def annotate_from_bam(
+        bam_file,
+        variants_df,
+        label,
+        min_mapq=10,
+        sweep=False,
+        read_cache_size=READ_CACHE_MAX_PAIRS,
+        store=None):
+    """
+    Function to count reads supporting reference and alternate alleles for given variants in a BAM file.
+
+    Duplicate (contig, start, ref, alt) rows are only counted once.
+
+    Parameters:
+    bam_file (str): Path to the BAM file.
+    variants_df (pd.DataFrame): DataFrame containing variants with columns 'contig', 'start', 'ref', 'alt'.
+    label (str): Label for the BAM file (used to name the count columns).
+    min_mapq (int): Minimum mapping quality of counted reads.
+    sweep (bool): If True, count all variants in one sorted pass over each contig instead of
+        querying the BAM separately for each variant.
+    read_cache_size (int): Maximum number of aligned pairs to keep in the cache of decoded reads,
+        which saves decoding the same reads again for nearby variants. 0 disables the cache.
+    store (AnnotationStore): Store of earlier counts, or None. Only the loci it doesn't have are
+        counted, and their counts are added to it.
 
-    # Load the variants DataFrame
-    variants_df = pd.read_csv(variants_file)
+    Returns:
+    pd.DataFrame: DataFrame with additional columns for read counts and depth.
+    """
+    with open_indexed_bam(bam_file) as bam:
+        loci, locus_ids, unmangled_contigs = get_loci(bam, variants_df)
+    counts, missing = lookup_loci(store, bam_file, loci, min_mapq)
+    if missing:
+        missing_loci = [loci[i] for i in missing]
+        desc = f"Annotating {label}" + (" (sweep)" if sweep else "")
+        counts[missing], read_cache_stats = count_loci(
+            bam_file, missing_loci, min_mapq=min_mapq, sweep=sweep, desc=desc,
+            read_cache_size=read_cache_size)
+        report_read_cache(label, read_cache_stats)
+        if store is not None:
+            store.store_counts(bam_file, min_mapq, missing_loci, counts[missing])
+    return set_bam_columns(variants_df, label, counts, locus_ids, unmangled_contigs)
+
+
+def annotate_from_bams(
+        bam_files,
+        variants_df,
+        min_mapq=10,
+        sweep=False,
+        jobs=1,
+        read_cache_size=READ_CACHE_MAX_PAIRS,
+        store=None):
+    """
+    Annotate counts from several BAM files, spreading the work over a pool of processes.
 
-    variants_df["contig"] = variants_df["contig"].astype(str)
-    variants_df["ref"] = variants_df["ref"].fillna("").astype(str)
-    variants_df["alt"] = variants_df["alt"].fillna("").astype(str)
+    The work is split into one shard per (BAM file, contig). Each shard is counted in a worker
+    process with its own BAM file handle, and the resulting count arrays are merged back into the
+    DataFrame in the order the BAM files were given, so the output doesn't depend on `jobs`.
 
-    if "gene_name" in variants_df.columns:
-        variants_df["gene_name"] = variants_df["gene_name"].fillna("").astype(str)
+    Parameters:
+    bam_files (list of tuples): (label, path) for each BAM file.
+    variants_df (pd.DataFrame): DataFrame containing variants with columns 'contig', 'start', 'ref', 'alt'.
+    min_mapq (int): Minimum mapping quality of counted reads.
+    sweep (bool): Count each shard in a single sorted pass, see annotate_from_bam.
+    jobs (int): Number of worker processes.
+    read_cache_size (int): Size of the decoded read cache of each worker, see annotate_from_bam.
+    store (AnnotationStore): Store of earlier counts, or None, see annotate_from_bam. Only the
+        main process uses it.
 
-    if "unmangled_contig" not in variants_df.columns:
-        variants_df["unmangled_contig"] = None
+    Returns:
+    pd.DataFrame: DataFrame with additional columns for read counts and depth for each BAM.
+    """
+    if jobs <= 1:
+        for label, bam_path in bam_files:
+            variants_df = annotate_from_bam(
+                bam_path,
+                variants_df,
+                label,
+                min_mapq=min_mapq,
+                sweep=sweep,
+                read_cache_size=read_cache_size,
+                store=store)
+        return variants_df
 
-    # Process each BAM file
+    bams = []
+    counts = []
+    shards = []
     for label, bam_path in bam_files:
-        variants_df = annotate_from_bam(bam_path, variants_df, label)
+        with open_indexed_bam(bam_path) as bam:
+            loci, locus_ids, unmangled_contigs = get_loci(bam, variants_df)
+        bam_counts, missing = lookup_loci(store, bam_path, loci, min_mapq)
+        bams.append((label, loci, locus_ids, unmangled_contigs))
+        counts.append(bam_counts)
+        locus_indices_by_contig = {}
+        for i in missing:
+            locus_indices_by_contig.setdefault(loci[i][0], []).append(i)
+        for locus_indices in locus_indices_by_contig.values():
+            shards.append((len(bams) - 1, bam_path, locus_indices))
+
+    read_cache_stats = [np.zeros(2, dtype=np.int64) for _ in bams]
+    # start the biggest shards first, so that they don't end up running last
+    shards.sort(key=lambda shard: len(shard[2]), reverse=True)
+    bam_path_by_index = [bam_path for (_, bam_path) in bam_files]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                count_loci,
+                bam_path,
+                [bams[bam_index][1][i] for i in locus_indices],
+                min_mapq=min_mapq,
+                sweep=sweep,
+                read_cache_size=read_cache_size): (bam_index, locus_indices)
+            for (bam_index, bam_path, locus_indices) in shards
+        }
+        for future in tqdm(as_completed(futures), total=len(futures),
+                desc=f"Annotating {len(bam_files)} BAMs with {jobs} jobs"):
+            bam_index, locus_indices = futures[future]
+            shard_counts, shard_read_cache_stats = future.result()
+            counts[bam_index][locus_indices] = shard_counts
+            read_cache_stats[bam_index] += shard_read_cache_stats
+            if store is not None:
+                store.store_counts(
+                    bam_path_by_index[bam_index],
+                    min_mapq,
+                    [bams[bam_index][1][i] for i in locus_indices],
+                    shard_counts)
+
+    for (label, _, locus_ids, unmangled_contigs), bam_counts, bam_read_cache_stats in zip(
+            bams, counts, read_cache_stats):
+        report_read_cache(label, bam_read_cache_stats)
+        variants_df = set_bam_columns(variants_df, label, bam_counts, locus_ids, unmangled_contigs)
+    return variants_df
+
+
+def read_variants(variants_file, chunk_size=None, dtype=None):
+    """
+    Read the variants CSV, either all at once or in chunks of `chunk_size` rows.
+
+    Parameters:
+    dtype (dict): Types of some of the columns, passed on to pd.read_csv.
+
+    Returns:
+    iterator of pd.DataFrame: The variants, as a single DataFrame or one per chunk.
+    """
+    if chunk_size:
+        chunks = pd.read_csv(variants_file, chunksize=chunk_size, dtype=dtype)
+    else:
+        chunks = [pd.read_csv(variants_file, dtype=dtype)]
+
+    for variants_df in chunks:
+        variants_df["contig"] = variants_df["contig"].astype(str)
+        variants_df["ref"] = variants_df["ref"].fillna("").astype(str)
+        variants_df["alt"] = variants_df["alt"].fillna("").astype(str)
+
+        if "gene_name" in variants_df.columns:
+            variants_df["gene_name"] = variants_df["gene_name"].fillna("").astype(str)
+
+        if "unmangled_contig" not in variants_df.columns:
+            variants_df["unmangled_contig"] = None
+
+        yield variants_df
+
 
-    # Process each VCF file
-    for label, vcf_path in vcf_files:
-        variants_df = annotate_from_vcf(vcf_path, variants_df, label)
+OUTPUT_FORMATS = {".csv": "csv", ".parquet": "parquet", ".feather": "feather"}
 
-    # Save the updated DataFrame to the specified output file
-    variants_df.to_csv(output_file, index=False)
+# Arrow types (as pyarrow aliases) of the variants columns that this script reads or fills in
+VARIANT_COLUMN_TYPES = {
+    "contig": "string",
+    "start": "int64",
+    "ref": "string",
+    "alt": "string",
+    "gene_name": "string",
+    "unmangled_contig": "string",
+}
+
+
+def bam_column_types(label):
+    return {
+        f'{label}_ref_count': "int64",
+        f'{label}_alt_count': "int64",
+        f'{label}_depth': "int64",
+        f'{label}_vaf': "double",
+    }
+
+
+def vcf_column_types(label):
+    column_types = {col: "double" for col in vcf_columns(label)}
+    column_types[label] = "bool"
+    return column_types
+
+
+def infer_column_types(variants_file, chunk_size):
+    """
+    Arrow types of the columns of the variants CSV that fit every chunk of it.
+
+    pandas infers the type of each column separately for each chunk, so e.g. a column that is
+    empty in the first chunk is read as floats there, and as strings in a later chunk that has
+    text in it. This reads the whole file once, and picks int64 or double for columns that are
+    numbers in every chunk, bool for ones that are booleans in every chunk, and string for the
+    others (including columns that are always empty).
+
+    Returns:
+    dict: Maps each column to a pyarrow type alias.
+    """
+    kinds = OrderedDict()
+    for chunk in pd.read_csv(variants_file, chunksize=chunk_size):
+        for col in chunk.columns:
+            kinds.setdefault(col, set())
+            if chunk[col].notnull().any():
+                kinds[col].add(chunk[col].dtype.kind)
+    column_types = OrderedDict()
+    for (col, col_kinds) in kinds.items():
+        if col_kinds == {"i"}:
+            column_types[col] = "int64"
+        elif col_kinds and col_kinds <= {"i", "f"}:
+            column_types[col] = "double"
+        elif col_kinds == {"b"}:
+            column_types[col] = "bool"
+        else:
+            column_types[col] = "string"
+    return column_types
+
+
+class VariantsWriter(object):
+    """
+    Writes annotated variants one chunk at a time, so that the whole table never has to be in
+    memory. The format (CSV, Parquet or Feather) is picked from the output file extension.
+
+    Parquet and Feather output need pyarrow. Each chunk becomes a Parquet row group or a Feather
+    record batch. Its columns are converted to the types in `column_types` (pyarrow type
+    aliases), so that e.g. a column with only missing values in the first chunk still has the
+    right type. Any other columns get the types pyarrow infers for them in the first chunk.
+    """
+    def __init__(self, path, column_types=None):
+        self.path = path
+        extension = splitext(path)[1].lower()
+        if extension not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unsupported output file extension {extension}, "
+                f"use one of {list(OUTPUT_FORMATS)}")
+        self.format = OUTPUT_FORMATS[extension]
+        self.num_rows = 0
+        self.column_types = column_types or {}
+        self._arrow_writer = None
+        self._schema = None
+
+    def write(self, variants_df):
+        if self.format == "csv":
+            first = self.num_rows == 0
+            variants_df.to_csv(self.path, index=False, mode="w" if first else "a", header=first)
+        else:
+            import pyarrow as pa
+            if self._arrow_writer is None:
+                inferred_schema = pa.Table.from_pandas(variants_df, preserve_index=False).schema
+                self._schema = pa.schema([
+                    pa.field(field.name, pa.type_for_alias(self.column_types[field.name]))
+                    if field.name in self.column_types else field
+                    for field in inferred_schema
+                ])
+                if self.format == "parquet":
+                    import pyarrow.parquet as pq
+                    self._arrow_writer = pq.ParquetWriter(self.path, self._schema)
+                else:
+                    self._arrow_writer = pa.ipc.new_file(
+                        self.path, self._schema,
+                        options=pa.ipc.IpcWriteOptions(compression="lz4"))
+            table = pa.Table.from_pandas(variants_df, schema=self._schema, preserve_index=False)
+            self._arrow_writer.write_table(table)
+        self.num_rows += len(variants_df)
+
+    def close(self):
+        if self._arrow_writer is not None:
+            self._arrow_writer.close()
+        elif self.num_rows == 0 and self.format == "csv":
+            open(self.path, "w").close()
+
+
+def main(
+        variants_file,
+        bam_files,
+        vcf_files,
+        output_file,
+        sweep=False,
+        jobs=1,
+        chunk_size=None,
+        read_cache_size=READ_CACHE_MAX_PAIRS,
+        store_path=None):
+    print(disclaimer)
+    store = AnnotationStore(store_path, COUNTING_VERSION) if store_path else None
+
+    # Read each VCF file once, rather than for each chunk
+    vcf_records = [
+        (label, vcf_path, store.vcf_allele_counts(vcf_path, read_vcf_allele_counts)
+         if store is not None else read_vcf_allele_counts(vcf_path))
+        for label, vcf_path in vcf_files]
+
+    # Declare the types of the output columns, so that every chunk is written with the same ones
+    column_types = infer_column_types(variants_file, chunk_size) if chunk_size else {}
+    column_types.update(VARIANT_COLUMN_TYPES)
+    for label, _ in bam_files:
+        column_types.update(bam_column_types(label))
+    for label, _, _ in vcf_records:
+        column_types.update(vcf_column_types(label))
+    string_columns = {col: str for (col, col_type) in column_types.items() if col_type == "string"}
+
+    writer = VariantsWriter(output_file, column_types)
+    for variants_df in read_variants(variants_file, chunk_size, dtype=string_columns):
+        if chunk_size:
+            print(f"Annotating variants {writer.num_rows + 1}-{writer.num_rows + len(variants_df)}")
+
+        # Process each BAM file
+        variants_df = annotate_from_bams(
+            bam_files, variants_df, sweep=sweep, jobs=jobs, read_cache_size=read_cache_size,
+            store=store)
+
+        # Process each VCF file
+        for label, vcf_path, records in vcf_records:
+            variants_df = annotate_from_vcf(
+                vcf_path,
+                variants_df,
+                label,
+                records=records,
+                drop_columns=empty_vcf_columns(records, label) if chunk_size else None)
+
+        # Save the updated DataFrame (or append the chunk) to the specified output file
+        writer.write(variants_df)
+    writer.close()
+    if store is not None:
+        store.report()
+        store.close()
     print(f'Wrote: {output_file}')
 
 
@@ -380,8 +1048,31 @@ if __name__ == '__main__':
     parser.add_argument("--vcf", type=str, nargs=2, action='append',
                         required=True, help='Label and path to VCF file.')
     parser.add_argument('--output', type=str, required=True,
-        help='Output CSV file to save the results')
+        help='Output file to save the results: .csv, or .parquet / .feather (needs pyarrow)')
+    parser.add_argument('--sweep', action='store_true',
+        help='Count all variants in one sorted pass over each contig of each BAM, instead of '
+             'querying the BAM separately for each variant. Faster for many variants.')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Number of processes to spread the BAM annotation over (sharded by BAM and contig)')
+    parser.add_argument('--chunk-size', type=int,
+        help='Annotate the variants this many rows at a time and append each chunk to the output, '
+             'to bound memory use on large variant tables')
+    parser.add_argument('--read-cache-size', type=int, default=READ_CACHE_MAX_PAIRS,
+        help='Maximum number of aligned read bases to keep in the cache of decoded reads shared by '
+             'nearby variants (per BAM and job), 0 to disable the cache')
+    parser.add_argument('--store', type=str,
+        help='SQLite database of earlier results, keyed on the contents of the BAM and VCF files, '
+             'to reuse instead of counting again; created if it does not exist, and added to')
 
     args = parser.parse_args()
 
-    main(args.variants_file, args.bam, args.vcf, args.output)
+    main(
+        args.variants_file,
+        args.bam,
+        args.vcf,
+        args.output,
+        sweep=args.sweep,
+        jobs=args.jobs,
+        chunk_size=args.chunk_size,
+        read_cache_size=args.read_cache_size,
+        store_path=args.store)
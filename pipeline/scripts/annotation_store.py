@@ -0,0 +1,217 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent store of annotate_variants.py results, so that re-annotating a patient's variants
+(e.g. after vaxrank is rerun with other parameters) only counts the loci it hasn't seen before.
+
+Allele counts are keyed on (BAM fingerprint, min_mapq, contig, start, ref, alt), and the allele
+counts read from each VCF on the VCF's fingerprint. Fingerprints are of the file contents, not
+their paths or modification times, so results survive files being moved, copied or hardlinked,
+and a regenerated file with other contents gets new results. They also include the version of
+the counting code that the store is opened with, so that results counted differently by an older
+version aren't reused. The store is a SQLite database, which several runs can use at once.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+# BAM files are fingerprinted by their size, their first and last bytes, which include the
+# header and the last reads' BGZF blocks, and their whole index; reading all of the BAM would take
+# as long as the counting. The index has the file offsets of the reads all along the BAM, so a
+# change to the reads in the middle of it moves those offsets. VCF files are small, and hashed
+# whole, as are BAM files without an index.
+BAM_FINGERPRINT_BYTES = 1 << 20
+
+# Where samtools and sambamba put the index of BAM file "x.bam"
+BAM_INDEX_SUFFIXES = [".bam.bai", ".bai", ".bam.csi", ".csi"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bam_counts (
+    bam TEXT NOT NULL,
+    min_mapq INTEGER NOT NULL,
+    contig TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    ref TEXT NOT NULL,
+    alt TEXT NOT NULL,
+    ref_count INTEGER NOT NULL,
+    alt_count INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (bam, min_mapq, contig, start, ref, alt)
+);
+CREATE TABLE IF NOT EXISTS vcfs (
+    vcf TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS vcf_records (
+    vcf TEXT NOT NULL,
+    contig TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    ref TEXT NOT NULL,
+    alt TEXT NOT NULL,
+    allele_counts TEXT NOT NULL,
+    PRIMARY KEY (vcf, contig, start, ref, alt)
+);
+"""
+
+
+def _hash_file(path, digest):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest
+
+
+def find_bam_index(path):
+    """
+    Path of a BAM file's index, or None if it doesn't have one.
+    """
+    base = path[:-len(".bam")] if path.endswith(".bam") else path
+    for suffix in BAM_INDEX_SUFFIXES:
+        if os.path.exists(base + suffix):
+            return base + suffix
+    return None
+
+
+def bam_fingerprint(path):
+    """
+    Hash of a BAM file's size, first and last BAM_FINGERPRINT_BYTES bytes and index, or of all
+    of the BAM if it isn't indexed.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    index = find_bam_index(path)
+    if index is None:
+        _hash_file(path, digest)
+    else:
+        with open(path, "rb") as f:
+            digest.update(f.read(BAM_FINGERPRINT_BYTES))
+            f.seek(max(0, size - BAM_FINGERPRINT_BYTES))
+            digest.update(f.read(BAM_FINGERPRINT_BYTES))
+        _hash_file(index, digest)
+    return "bam:" + digest.hexdigest()
+
+
+def vcf_fingerprint(path):
+    """
+    Hash of a VCF file's contents.
+    """
+    return "vcf:" + _hash_file(path, hashlib.sha1()).hexdigest()
+
+
+class AnnotationStore(object):
+    """
+    SQLite database of BAM allele counts and VCF allele counts, keyed on file fingerprints.
+
+    Parameters:
+    path (str): Database file, created if it doesn't exist.
+    version (int): Version of the code that computes the stored counts. Only counts stored with
+        the same version are looked up.
+    timeout (int): Seconds to wait for other runs to finish writing to the database.
+    """
+    def __init__(self, path, version, timeout=600):
+        self.path = path
+        self.version = version
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+        self._fingerprints = {}
+        self.bam_hits = 0
+        self.bam_misses = 0
+
+    def _fingerprint(self, path, fingerprint_fn):
+        # each file is only fingerprinted once per run, however many chunks are annotated
+        if path not in self._fingerprints:
+            self._fingerprints[path] = "v%d:%s" % (self.version, fingerprint_fn(path))
+        return self._fingerprints[path]
+
+    def lookup_counts(self, bam_path, min_mapq, loci):
+        """
+        Stored allele counts of the given loci in a BAM file.
+
+        Parameters:
+        bam_path (str): BAM file.
+        min_mapq (int): Minimum mapping quality of the counted reads.
+        loci (list of tuples): (bam_contig, start, ref, alt) for each locus.
+
+        Returns:
+        tuple: (counts, missing), where counts is an array of the (ref_count, alt_count,
+            total_depth) for each locus, shape (len(loci), 3), and missing is a list of the
+            indices of the loci without stored counts (whose rows are 0).
+        """
+        bam = self._fingerprint(bam_path, bam_fingerprint)
+        stored = {}
+        for contig in set(locus[0] for locus in loci):
+            rows = self.connection.execute(
+                "SELECT start, ref, alt, ref_count, alt_count, depth FROM bam_counts "
+                "WHERE bam = ? AND min_mapq = ? AND contig = ?", (bam, min_mapq, contig))
+            for start, ref, alt, ref_count, alt_count, depth in rows:
+                stored[(contig, start, ref, alt)] = (ref_count, alt_count, depth)
+        counts = np.zeros((len(loci), 3), dtype=np.int64)
+        missing = []
+        for i, locus in enumerate(loci):
+            if locus in stored:
+                counts[i] = stored[locus]
+            else:
+                missing.append(i)
+        self.bam_hits += len(loci) - len(missing)
+        self.bam_misses += len(missing)
+        return counts, missing
+
+    def store_counts(self, bam_path, min_mapq, loci, counts):
+        """
+        Store the allele counts of loci in a BAM file (see lookup_counts).
+        """
+        bam = self._fingerprint(bam_path, bam_fingerprint)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO bam_counts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(bam, min_mapq, contig, int(start), ref, alt) + tuple(int(c) for c in locus_counts)
+                 for (contig, start, ref, alt), locus_counts in zip(loci, counts)])
+
+    def vcf_allele_counts(self, vcf_path, read_fn):
+        """
+        The allele counts of a VCF file, as returned by read_fn(vcf_path), read from the store if
+        it has them and otherwise stored.
+        """
+        vcf = self._fingerprint(vcf_path, vcf_fingerprint)
+        if self.connection.execute("SELECT 1 FROM vcfs WHERE vcf = ?", (vcf,)).fetchone():
+            rows = self.connection.execute(
+                "SELECT contig, start, ref, alt, allele_counts FROM vcf_records WHERE vcf = ?",
+                (vcf,))
+            return dict(
+                ((contig, start, ref, alt), [float(x) for x in allele_counts.split(",")])
+                for contig, start, ref, alt, allele_counts in rows)
+
+        records = read_fn(vcf_path)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO vcf_records VALUES (?, ?, ?, ?, ?, ?)",
+                [(vcf, contig, start, ref, alt, ",".join(repr(float(x)) for x in allele_counts))
+                 for (contig, start, ref, alt), allele_counts in records.items()])
+            self.connection.execute("INSERT OR IGNORE INTO vcfs VALUES (?)", (vcf,))
+        return records
+
+    def report(self):
+        total = self.bam_hits + self.bam_misses
+        if total:
+            print(
+                f"Annotation store {self.path}: {self.bam_hits} of {total} BAM loci already "
+                f"counted ({100 * self.bam_hits / total:.1f}%)")
+
+    def close(self):
+        self.connection.close()
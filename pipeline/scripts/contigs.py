@@ -0,0 +1,162 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Contig name aliasing, shared by the pipeline rules and scripts.
+
+References don't agree on contig names: b37 uses "1", "X" and "MT", while hg19 and GRCh38 use
+"chr1", "chrX" and "chrM". A ContigIndex maps every spelling of a contig name to the name the
+reference (or BAM) actually uses, so that lookups are a single dict access whichever naming the
+caller has.
+
+This module only uses the standard library, so that it can be imported when the Snakefile is
+parsed.
+"""
+
+import csv
+
+
+def canonical_contig_name(contig):
+    """
+    Contig name without any "chr" prefix, with "M" normalized to "MT" (the same way varcode names
+    contigs). Unplaced and alt contigs are stripped too, e.g. "chrUn_gl000220" -> "Un_gl000220".
+    """
+    if contig.lower().startswith("chr"):
+        contig = contig[3:]
+    if contig.isalpha():
+        contig = contig.upper()
+    if contig == "M":
+        contig = "MT"
+    return contig
+
+
+def contig_aliases(contig):
+    """
+    All the names that refer to the given contig, including the name itself: with and without the
+    "chr" prefix, whichever way round the contig is named.
+    """
+    canonical = canonical_contig_name(contig)
+    aliases = [contig, canonical, "chr" + canonical]
+    if canonical == "MT":
+        aliases += ["M", "chrM", "chrMT"]
+    return aliases
+
+
+def is_primary_contig(contig):
+    """
+    Whether the contig is an autosome, a sex chromosome or the mitochondrial genome.
+    """
+    canonical = canonical_contig_name(contig)
+    return canonical.isdigit() or canonical in ("X", "Y", "MT")
+
+
+def read_fai_contigs(fai_file):
+    """
+    Contig names from a samtools .fai index, in reference order.
+    """
+    with open(fai_file) as f:
+        return [row[0] for row in csv.reader(f, delimiter="\t") if row]
+
+
+def read_sequence_dict_contigs(dict_file):
+    """
+    Contig names from the @SQ lines of a Picard sequence dictionary, in reference order.
+    """
+    contigs = []
+    with open(dict_file) as f:
+        for line in f:
+            if line.startswith("@SQ"):
+                fields = dict(
+                    field.split(":", 1) for field in line.rstrip("\n").split("\t")[1:])
+                contigs.append(fields["SN"])
+    return contigs
+
+
+class ContigIndex(object):
+    """
+    Index from every alias of a set of contigs to the contig name.
+
+    If two contigs share an alias (e.g. a reference with both "1" and "chr1"), each contig's own
+    name still refers to itself, and other aliases refer to the contig that comes first.
+    """
+    def __init__(self, contigs):
+        self.contigs = list(contigs)
+        self.aliases = {}
+        for contig in self.contigs:
+            for alias in contig_aliases(contig):
+                self.aliases.setdefault(alias, contig)
+        for contig in self.contigs:
+            self.aliases[contig] = contig
+
+    @classmethod
+    def from_reference(cls, fai_file, dict_file=None):
+        """
+        Index of the contigs in a reference's .fai index, checked against its sequence
+        dictionary if given.
+        """
+        contigs = read_fai_contigs(fai_file)
+        if dict_file is not None:
+            dict_contigs = read_sequence_dict_contigs(dict_file)
+            if dict_contigs != contigs:
+                raise ValueError(
+                    "Contigs in %s don't match the ones in %s" % (dict_file, fai_file))
+        return cls(contigs)
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read an index written by ContigIndex.write.
+        """
+        index = cls([])
+        with open(path) as f:
+            for alias, contig in csv.reader(f, delimiter="\t"):
+                if alias == contig:
+                    index.contigs.append(contig)
+                index.aliases[alias] = contig
+        return index
+
+    def write(self, path):
+        """
+        Write the index as a TSV file of (alias, contig) rows, with each contig's own row first.
+        """
+        with open(path, "w") as f:
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            for contig in self.contigs:
+                writer.writerow([contig, contig])
+            for alias, contig in self.aliases.items():
+                if alias != contig:
+                    writer.writerow([alias, contig])
+
+    def primary_contigs(self):
+        """
+        Autosomes, sex chromosomes and the mitochondrial genome, in reference order.
+        """
+        return [contig for contig in self.contigs if is_primary_contig(contig)]
+
+    def get(self, contig, default=None):
+        return self.aliases.get(contig, default)
+
+    def __getitem__(self, contig):
+        try:
+            return self.aliases[contig]
+        except KeyError:
+            raise KeyError(
+                "Could not find contig %s or any of its aliases %s. Valid contigs are: %s" % (
+                    contig, contig_aliases(contig), self.contigs))
+
+    def __contains__(self, contig):
+        return contig in self.aliases
+
+    def __len__(self):
+        return len(self.contigs)
@@ -0,0 +1,191 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write Picard MarkDuplicates-style duplication metrics for a BAM file whose duplicates are marked.
+
+For duplicate marking backends that don't write Picard's metrics file (e.g. sambamba markdup),
+this counts the reads the way MarkDuplicates does, per library, and writes the same
+DuplicationMetrics table, so that scripts/sequencing.py can check it. Optical duplicates aren't
+detected by these backends, so READ_PAIR_OPTICAL_DUPLICATES is always 0.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import datetime
+import math
+
+import pysam
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--bam",
+    required=True,
+    help="BAM file with duplicates marked")
+
+parser.add_argument(
+    "--output",
+    required=True,
+    help="Metrics file to write")
+
+parser.add_argument(
+    "--command",
+    default="",
+    help="Command line that marked the duplicates, for the metrics file header")
+
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=1,
+    help="Threads for BGZF decompression")
+
+METRICS_COLUMNS = [
+    "LIBRARY",
+    "UNPAIRED_READS_EXAMINED",
+    "READ_PAIRS_EXAMINED",
+    "SECONDARY_OR_SUPPLEMENTARY_RDS",
+    "UNMAPPED_READS",
+    "UNPAIRED_READ_DUPLICATES",
+    "READ_PAIR_DUPLICATES",
+    "READ_PAIR_OPTICAL_DUPLICATES",
+    "PERCENT_DUPLICATION",
+    "ESTIMATED_LIBRARY_SIZE",
+]
+
+# Picard's name for the library of reads without one
+UNKNOWN_LIBRARY = "Unknown Library"
+
+
+def _library_size_equation(x, c, n):
+    return c / x - 1 + math.exp(-n / x)
+
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    """
+    Number of distinct molecules in the library, by the Lander-Waterman equation, solved the way
+    Picard's DuplicationMetrics.estimateLibrarySize does. Returns None if there are no duplicate
+    pairs to estimate it from.
+    """
+    read_pair_duplicates = read_pairs - unique_read_pairs
+    if read_pairs <= 0 or read_pair_duplicates <= 0:
+        return None
+    m, M = 1.0, 100.0
+    if (unique_read_pairs >= read_pairs or
+            _library_size_equation(m * unique_read_pairs, unique_read_pairs, read_pairs) < 0):
+        raise ValueError("Invalid values for pairs and unique pairs: %d, %d" % (
+            read_pairs, unique_read_pairs))
+    while _library_size_equation(M * unique_read_pairs, unique_read_pairs, read_pairs) > 0:
+        M *= 10.0
+    for _ in range(40):
+        r = (m + M) / 2.0
+        u = _library_size_equation(r * unique_read_pairs, unique_read_pairs, read_pairs)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return int(unique_read_pairs * (m + M) / 2.0)
+
+
+def count_duplicates(bam_path, threads=1):
+    """
+    Count the examined and duplicate reads of each library, like MarkDuplicates.
+
+    Returns:
+    OrderedDict: metrics dict (with the METRICS_COLUMNS keys) for each library.
+    """
+    counts = OrderedDict()
+    with pysam.AlignmentFile(bam_path, "rb", threads=threads) as bam:
+        read_group_libraries = dict(
+            (read_group["ID"], read_group.get("LB", UNKNOWN_LIBRARY))
+            for read_group in bam.header.to_dict().get("RG", []))
+        for read in bam.fetch(until_eof=True):
+            library = (
+                read_group_libraries.get(read.get_tag("RG"), UNKNOWN_LIBRARY)
+                if read.has_tag("RG") else UNKNOWN_LIBRARY)
+            if library not in counts:
+                counts[library] = dict((column, 0) for column in METRICS_COLUMNS[1:8])
+            library_counts = counts[library]
+            if read.is_unmapped:
+                library_counts["UNMAPPED_READS"] += 1
+            elif read.is_secondary or read.is_supplementary:
+                library_counts["SECONDARY_OR_SUPPLEMENTARY_RDS"] += 1
+            elif not read.is_paired or read.mate_is_unmapped:
+                library_counts["UNPAIRED_READS_EXAMINED"] += 1
+                if read.is_duplicate:
+                    library_counts["UNPAIRED_READ_DUPLICATES"] += 1
+            else:
+                # both reads of a pair are counted, and halved at the end
+                library_counts["READ_PAIRS_EXAMINED"] += 1
+                if read.is_duplicate:
+                    library_counts["READ_PAIR_DUPLICATES"] += 1
+
+    metrics = OrderedDict()
+    for library, library_counts in counts.items():
+        library_metrics = OrderedDict(LIBRARY=library)
+        library_metrics.update(library_counts)
+        library_metrics["READ_PAIRS_EXAMINED"] //= 2
+        library_metrics["READ_PAIR_DUPLICATES"] //= 2
+        examined = (
+            library_metrics["UNPAIRED_READS_EXAMINED"] + 2 * library_metrics["READ_PAIRS_EXAMINED"])
+        duplicates = (
+            library_metrics["UNPAIRED_READ_DUPLICATES"] +
+            2 * library_metrics["READ_PAIR_DUPLICATES"])
+        library_metrics["PERCENT_DUPLICATION"] = duplicates / examined if examined else 0.0
+        library_metrics["ESTIMATED_LIBRARY_SIZE"] = estimate_library_size(
+            library_metrics["READ_PAIRS_EXAMINED"],
+            library_metrics["READ_PAIRS_EXAMINED"] - library_metrics["READ_PAIR_DUPLICATES"])
+        metrics[library] = library_metrics
+    return metrics
+
+
+def _format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "%.6f" % value
+    return str(value)
+
+
+def write_metrics(path, metrics, command=""):
+    """
+    Write the metrics in Picard's metrics file format.
+    """
+    with open(path, "w") as f:
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write("# %s\n" % (command or "duplication_metrics.py"))
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write("# Started on: %s\n" % datetime.datetime.now().strftime("%a %b %d %H:%M:%S %Y"))
+        f.write("\n")
+        f.write("## METRICS CLASS\tpicard.sam.DuplicationMetrics\n")
+        f.write("\t".join(METRICS_COLUMNS) + "\n")
+        for library_metrics in metrics.values():
+            f.write("\t".join(
+                _format_value(library_metrics[column]) for column in METRICS_COLUMNS) + "\n")
+        f.write("\n")
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    metrics = count_duplicates(args.bam, args.threads)
+    write_metrics(args.output, metrics, args.command)
+    for library_metrics in metrics.values():
+        print("%s: %.2f%% duplication" % (
+            library_metrics["LIBRARY"], 100 * library_metrics["PERCENT_DUPLICATION"]))
+
+
+if __name__ == "__main__":
+    main()
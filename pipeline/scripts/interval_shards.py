@@ -0,0 +1,390 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Split the genome into interval lists with balanced amounts of work, to scatter GATK jobs over.
+
+The contigs are laid end to end in reference order and cut into shards of about the same
+weight. A base's weight is 1, or with a capture kit BED file, 1 if it's targeted and
+OFF_TARGET_WEIGHT otherwise, since that's where the reads (and so the work) are. Each shard is a
+contiguous stretch of the genome, so small contigs end up packed together and concatenating the
+per-shard VCFs in shard order keeps them sorted.
+
+Shards for calling may split a contig, but only at points where no reads pile up: between
+contigs, in the middle of the assembly gaps (runs of at least MIN_GAP_LENGTH Ns) of the reference
+FASTA, and with a BED file, in the middle of the gaps between targets. A cut is moved to the
+nearest such point, so that no indel or active region is split between two jobs; only if there
+are fewer of them than cuts to make do the remaining cuts fall wherever balances the weight.
+Without a BED or FASTA file, calling shards are cut anywhere. Shards for indel realignment only
+contain whole contigs: reads that straddle a cut would be written by the jobs on both sides of it.
+
+Each shard is written as <output-dir>/<prefix><i>.intervals, in GATK's interval list format
+(contig or contig:start-end, 1-based and inclusive).
+"""
+
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right
+import os
+from os.path import join
+import re
+
+from contigs import ContigIndex
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--fai",
+    required=True,
+    help="samtools .fai index of the reference")
+
+parser.add_argument(
+    "--contigs",
+    nargs="+",
+    required=True,
+    help="Contigs to split up, e.g. the primary contigs")
+
+parser.add_argument(
+    "--fasta",
+    default="",
+    help="Reference FASTA (indexed by --fai) to find the assembly gaps in, which calling shards "
+         "are cut at")
+
+parser.add_argument(
+    "--bed",
+    default="",
+    help="Capture kit BED file to weight the targeted bases by")
+
+parser.add_argument(
+    "--num-shards",
+    type=int,
+    required=True)
+
+parser.add_argument(
+    "--whole-contigs",
+    action="store_true",
+    help="Only cut between contigs (the number of shards is at most the number of contigs)")
+
+parser.add_argument(
+    "--output-dir",
+    required=True)
+
+parser.add_argument(
+    "--prefix",
+    default="shard")
+
+# relative weight of an untargeted base when a BED file is given
+OFF_TARGET_WEIGHT = 0.01
+
+# runs of Ns at least this long are assembly gaps, which no reads align across
+MIN_GAP_LENGTH = 1000
+
+# bytes of the FASTA file read at a time when looking for gaps
+FASTA_BLOCK_SIZE = 1 << 24
+
+N_RUN = re.compile(b"[Nn]+")
+
+
+def read_fai_lengths(fai_file):
+    with open(fai_file) as f:
+        return dict(
+            (fields[0], int(fields[1])) for fields in (line.split("\t") for line in f) if fields)
+
+
+def read_fasta_gaps(fasta_file, fai_file, contigs, min_length=MIN_GAP_LENGTH):
+    """
+    Runs of at least `min_length` Ns in the given contigs of a FASTA file, as a dict of contig ->
+    list of (start, end) (0-based, half-open). Each contig is read a block at a time, from its
+    offset in the .fai index.
+    """
+    with open(fai_file) as f:
+        entries = dict(
+            (fields[0], [int(field) for field in fields[1:5]])
+            for fields in (line.split("\t") for line in f) if len(fields) >= 5)
+    gaps = {}
+    with open(fasta_file, "rb") as f:
+        for contig in contigs:
+            length, offset, line_bases, line_width = entries[contig]
+            remaining = (length // line_bases) * line_width + length % line_bases
+            block_size = max(1, FASTA_BLOCK_SIZE // line_width) * line_width
+            runs = []
+            position = 0
+            f.seek(offset)
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                sequence = block.translate(None, b"\r\n")
+                for match in N_RUN.finditer(sequence):
+                    start, end = position + match.start(), position + match.end()
+                    if runs and runs[-1][1] == start:
+                        # a run that continues from the previous block
+                        runs[-1] = (runs[-1][0], end)
+                    else:
+                        runs.append((start, end))
+                position += len(sequence)
+            gaps[contig] = [(start, end) for (start, end) in runs if end - start >= min_length]
+    return gaps
+
+
+def read_bed_targets(bed_file, contig_index):
+    """
+    Merged, sorted target intervals per contig, as a dict of contig -> list of (start, end)
+    (0-based, half-open). Contigs are resolved through the given ContigIndex; targets on other
+    contigs are ignored.
+    """
+    targets = {}
+    with open(bed_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3 or fields[0] in ("track", "browser") or fields[0].startswith("#"):
+                continue
+            contig = contig_index.get(fields[0])
+            if contig is not None:
+                targets.setdefault(contig, []).append((int(fields[1]), int(fields[2])))
+    merged = {}
+    for contig, intervals in targets.items():
+        merged[contig] = []
+        for start, end in sorted(intervals):
+            if merged[contig] and start <= merged[contig][-1][1]:
+                merged[contig][-1] = (merged[contig][-1][0], max(end, merged[contig][-1][1]))
+            else:
+                merged[contig].append((start, end))
+    return merged
+
+
+class ContigWeights(object):
+    """
+    Cumulative weight along a contig, and the points it can safely be cut at.
+    """
+    def __init__(self, length, targets=None, gaps=None):
+        self.length = length
+        self.targets = targets
+        self.gaps = gaps
+        if targets is None:
+            self.total = float(length)
+            return
+        self.starts = [start for start, _ in targets]
+        self.ends = [end for _, end in targets]
+        # targeted bases before each target
+        self.targeted_before = [0]
+        for start, end in targets:
+            self.targeted_before.append(self.targeted_before[-1] + end - start)
+        self.total = self.weight_before(length)
+
+    def targeted_bases_before(self, position):
+        i = bisect_right(self.starts, position)
+        if i == 0:
+            return 0
+        start, end = self.targets[i - 1]
+        return self.targeted_before[i - 1] + min(position, end) - start
+
+    def weight_before(self, position):
+        if self.targets is None:
+            return float(position)
+        targeted = self.targeted_bases_before(position)
+        return targeted + OFF_TARGET_WEIGHT * (position - targeted)
+
+    def position_at_weight(self, weight):
+        """
+        First position whose cumulative weight reaches the given weight.
+        """
+        low, high = 0, self.length
+        while low < high:
+            middle = (low + high) // 2
+            if self.weight_before(middle) < weight:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def safe_cuts(self):
+        """
+        Sorted positions inside the contig that it can be cut at: the middle of each gap between
+        targets (and before the first and after the last one), and of each assembly gap. None if
+        there are neither targets nor gaps to go by, and any position will do.
+        """
+        if self.targets is None and self.gaps is None:
+            return None
+        cuts = set()
+        if self.targets is not None:
+            bounds = [0] + [bound for target in self.targets for bound in target] + [self.length]
+            cuts.update((bounds[k] + bounds[k + 1]) // 2 for k in range(0, len(bounds), 2))
+        if self.gaps is not None:
+            cuts.update((start + end) // 2 for (start, end) in self.gaps)
+        return sorted(cut for cut in cuts if 0 < cut < self.length)
+
+
+def partition_contigs(contig_weights, num_shards):
+    """
+    Split a sequence of contig weights into `num_shards` contiguous groups, minimizing the weight
+    of the heaviest group.
+
+    Returns:
+    list of int: Index of the first contig of each group.
+    """
+    def greedy_starts(capacity):
+        starts = [0]
+        weight = 0
+        for (i, contig_weight) in enumerate(contig_weights):
+            if weight + contig_weight > capacity and i > starts[-1]:
+                starts.append(i)
+                weight = 0
+            weight += contig_weight
+        return starts
+
+    # binary search for the smallest capacity that needs at most num_shards groups
+    low, high = max(contig_weights), sum(contig_weights)
+    for _ in range(100):
+        middle = (low + high) / 2
+        if len(greedy_starts(middle)) <= num_shards:
+            high = middle
+        else:
+            low = middle
+    starts = greedy_starts(high)
+
+    # split the heaviest groups that have more than one contig until there are num_shards
+    while len(starts) < num_shards:
+        ends = starts[1:] + [len(contig_weights)]
+        groups = [(sum(contig_weights[start:end]), start, end)
+                  for (start, end) in zip(starts, ends) if end - start > 1]
+        _, start, end = max(groups)
+        half = sum(contig_weights[start:end]) / 2
+        weight = 0
+        for i in range(start, end - 1):
+            weight += contig_weights[i]
+            if weight >= half:
+                break
+        starts = sorted(starts + [i + 1])
+    return starts
+
+
+def make_shards(contigs, weights, num_shards, whole_contigs=False):
+    """
+    Cut the contigs, in order, into shards of about the same weight.
+
+    Parameters:
+    contigs (list of str): Contigs, in reference order.
+    weights (dict): Contig -> ContigWeights.
+    num_shards (int): Number of shards to make.
+    whole_contigs (bool): Only cut between contigs.
+
+    Returns:
+    list of lists of (contig, start, end) tuples: 0-based, half-open intervals of each shard.
+    """
+    if whole_contigs:
+        num_shards = min(num_shards, len(contigs))
+        starts = partition_contigs([weights[contig].total for contig in contigs], num_shards)
+        ends = starts[1:] + [len(contigs)]
+        return [
+            [(contig, 0, weights[contig].length) for contig in contigs[start:end]]
+            for (start, end) in zip(starts, ends)
+        ]
+
+    contig_starts = [0.0]
+    for contig in contigs:
+        contig_starts.append(contig_starts[-1] + weights[contig].total)
+    total = contig_starts[-1]
+
+    def weight_before(cut):
+        i, position = cut
+        return contig_starts[i] + weights[contigs[i]].weight_before(position)
+
+    # cuts are (contig index, position) pairs, in increasing order; the safe ones are the starts
+    # of the contigs and their safe cuts, unless any position is safe
+    safe_cuts = [weights[contig].safe_cuts() for contig in contigs]
+    if any(contig_cuts is None for contig_cuts in safe_cuts):
+        candidates = None
+    else:
+        candidates = sorted(
+            [(i, 0) for i in range(1, len(contigs))] +
+            [(i, position)
+             for (i, contig_cuts) in enumerate(safe_cuts) for position in contig_cuts])
+
+    cuts = [(0, 0)]
+    for k in range(1, num_shards):
+        target = total * k / num_shards
+        i = max(0, min(bisect_right(contig_starts, target) - 1, len(contigs) - 1))
+        contig_weights = weights[contigs[i]]
+        position = contig_weights.position_at_weight(target - contig_starts[i])
+        cut = (i, position)
+        if candidates is not None:
+            # the safe cut nearest to the balanced one, after the previous cut and leaving enough
+            # safe cuts for the remaining ones
+            low = bisect_right(candidates, cuts[-1])
+            high = len(candidates) - (num_shards - 1 - k)
+            if low < high:
+                nearest = bisect_left(candidates, cut)
+                cut = min(
+                    set(candidates[min(max(j, low), high - 1)] for j in (nearest - 1, nearest)),
+                    key=lambda candidate: abs(weight_before(candidate) - target))
+            else:
+                print("Not enough safe points to cut %d shards at, cutting at %s:%d" % (
+                    num_shards, contigs[i], position))
+        if cut <= cuts[-1]:
+            # every shard gets at least one base, so that there are always num_shards of them
+            cut = (cuts[-1][0], cuts[-1][1] + 1)
+        if cut[1] >= weights[contigs[cut[0]]].length and cut[0] + 1 < len(contigs):
+            cut = (cut[0] + 1, 0)
+        cuts.append(cut)
+    cuts.append((len(contigs), 0))
+
+    shards = []
+    for (start_contig, start), (end_contig, end) in zip(cuts[:-1], cuts[1:]):
+        shard = []
+        for i in range(start_contig, min(end_contig + 1, len(contigs))):
+            interval_start = start if i == start_contig else 0
+            interval_end = end if i == end_contig else weights[contigs[i]].length
+            if interval_end > interval_start:
+                shard.append((contigs[i], interval_start, interval_end))
+        shards.append(shard)
+    return shards
+
+
+def format_interval(contig, start, end, length):
+    if start == 0 and end == length:
+        return contig
+    return "%s:%d-%d" % (contig, start + 1, end)
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    lengths = read_fai_lengths(args.fai)
+    contig_index = ContigIndex(list(lengths))
+    contigs = [contig_index[contig] for contig in args.contigs]
+
+    targets = read_bed_targets(args.bed, contig_index) if args.bed else None
+    gaps = read_fasta_gaps(args.fasta, args.fai, contigs) if args.fasta else None
+    weights = {
+        contig: ContigWeights(
+            lengths[contig],
+            None if targets is None else targets.get(contig, []),
+            None if gaps is None else gaps[contig])
+        for contig in contigs
+    }
+    shards = make_shards(contigs, weights, args.num_shards, args.whole_contigs)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for (i, shard) in enumerate(shards):
+        weight = sum(
+            weights[contig].weight_before(end) - weights[contig].weight_before(start)
+            for (contig, start, end) in shard)
+        print("%s%d: %d intervals, weight %.0f" % (args.prefix, i, len(shard), weight))
+        with open(join(args.output_dir, "%s%d.intervals" % (args.prefix, i)), "w") as f:
+            for contig, start, end in shard:
+                f.write(format_interval(contig, start, end, lengths[contig]) + "\n")
+
+
+if __name__ == "__main__":
+    main()
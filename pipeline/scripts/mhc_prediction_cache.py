@@ -0,0 +1,285 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run Vaxrank with its MHC binding predictions cached in a SQLite database shared across runs.
+
+Predictions are keyed on the predictor (Vaxrank's --mhc-predictor), its version, the allele and
+the peptide, so alleles and peptides that recur across patients (e.g. IDH1 R132H) are predicted
+once. The predictor Vaxrank builds is wrapped, so only the protein fragments and peptides with
+uncached predictions are sent to it; any mhctools predictor works, including the "random" one
+for tests. Several runs can use the same database at once: it's opened in WAL mode, with a busy
+timeout, and only adds rows. It should be on a local filesystem, not NFS.
+
+Usage:
+    python mhc_prediction_cache.py --cache <db> [--stats-output <json>] -- <vaxrank arguments>
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+import sqlite3
+import sys
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[1].strip(), allow_abbrev=False)
+
+parser.add_argument(
+    "--cache",
+    required=True,
+    help="SQLite database file of cached predictions; created if it doesn't exist")
+
+parser.add_argument(
+    "--predictor-version",
+    default="",
+    help="Version to key the predictions on. Defaults to the mhctools predictor class and "
+    "mhctools version; set it when the predictor changes without those changing (e.g. an IEDB "
+    "server update)")
+
+parser.add_argument(
+    "--stats-output",
+    default="",
+    help="JSON file to write the cache's lookup and hit counts to")
+
+parser.add_argument(
+    "--timeout",
+    type=float,
+    default=600,
+    help="Seconds to wait for another run's lock on the database")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    predictor TEXT NOT NULL,
+    version TEXT NOT NULL,
+    allele TEXT NOT NULL,
+    peptide TEXT NOT NULL,
+    score REAL,
+    percentile_rank REAL,
+    affinity REAL,
+    prediction_method_name TEXT,
+    PRIMARY KEY (predictor, version, allele, peptide)
+)
+"""
+
+_PREDICTION_FIELDS = ["score", "percentile_rank", "affinity", "prediction_method_name"]
+
+# SQLite's limit on the number of parameters of a statement is 999 in older versions
+_LOOKUP_BATCH_SIZE = 900
+
+
+class PredictionCache(object):
+    """
+    SQLite database of binding predictions, keyed on (predictor, version, allele, peptide).
+    """
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(_SCHEMA)
+
+    def lookup(self, predictor, version, allele, peptides):
+        """
+        Returns:
+        dict: peptide -> dict of the prediction fields, for the cached peptides.
+        """
+        peptides = list(peptides)
+        results = {}
+        for i in range(0, len(peptides), _LOOKUP_BATCH_SIZE):
+            batch = peptides[i:i + _LOOKUP_BATCH_SIZE]
+            rows = self.connection.execute(
+                "SELECT peptide, %s FROM predictions "
+                "WHERE predictor = ? AND version = ? AND allele = ? AND peptide IN (%s)" % (
+                    ", ".join(_PREDICTION_FIELDS), ", ".join("?" * len(batch))),
+                [predictor, version, allele] + batch)
+            for row in rows:
+                results[row[0]] = dict(zip(_PREDICTION_FIELDS, row[1:]))
+        return results
+
+    def store(self, predictor, version, binding_predictions):
+        """
+        Add predictions (mhctools BindingPrediction objects) to the cache, in one transaction.
+        Predictions another run stored in the meantime are kept.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(predictor, version, p.allele, p.peptide, p.score, p.percentile_rank,
+                  p.affinity, p.prediction_method_name) for p in binding_predictions])
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedPredictor(object):
+    """
+    Wraps an mhctools predictor so that its predict_peptides and predict_subsequences results
+    come from the cache where they can, and counts the cache's lookups and hits.
+
+    Other attributes (alleles, min_peptide_length, ...) are the wrapped predictor's.
+    """
+    def __init__(self, predictor, cache, predictor_name, version):
+        self.predictor = predictor
+        self.cache = cache
+        self.predictor_name = predictor_name
+        self.version = version
+        self.stats = OrderedDict([("lookups", 0), ("hits", 0)])
+
+    def __getattr__(self, name):
+        return getattr(self.predictor, name)
+
+    def __str__(self):
+        return "Cached%s" % self.predictor
+
+    def _lookup(self, peptides):
+        cached = {}
+        for allele in self.predictor.alleles:
+            for peptide, fields in self.cache.lookup(
+                    self.predictor_name, self.version, allele, peptides).items():
+                cached[(allele, peptide)] = fields
+        self.stats["lookups"] += len(peptides) * len(self.predictor.alleles)
+        self.stats["hits"] += len(cached)
+        return cached
+
+    def _is_cached(self, cached, peptide):
+        return all((allele, peptide) in cached for allele in self.predictor.alleles)
+
+    def _binding_predictions(self, cached, peptides_with_locations):
+        from mhctools import BindingPrediction
+        return [
+            BindingPrediction(
+                peptide=peptide,
+                allele=allele,
+                source_sequence_name=name,
+                offset=offset,
+                **cached[(allele, peptide)])
+            for peptide, name, offset in peptides_with_locations
+            for allele in self.predictor.alleles]
+
+    def predict_peptides(self, peptides):
+        from mhctools import BindingPredictionCollection
+        cached = self._lookup(set(peptides))
+        uncached = sorted(set(p for p in peptides if not self._is_cached(cached, p)))
+        binding_predictions = []
+        if uncached:
+            binding_predictions = list(self.predictor.predict_peptides(uncached))
+            self.cache.store(self.predictor_name, self.version, binding_predictions)
+        binding_predictions.extend(self._binding_predictions(
+            cached, [(p, None, 0) for p in sorted(set(peptides)) if self._is_cached(cached, p)]))
+        return BindingPredictionCollection(binding_predictions)
+
+    def predict_subsequences(self, sequence_dict, peptide_lengths=None):
+        from mhctools import BindingPredictionCollection
+        if isinstance(sequence_dict, str):
+            sequence_dict = {"seq": sequence_dict}
+        elif isinstance(sequence_dict, (list, tuple)):
+            sequence_dict = dict((seq, seq) for seq in sequence_dict)
+        peptide_lengths = self.predictor._check_peptide_lengths(peptide_lengths)
+
+        sequence_peptides = OrderedDict()
+        for name, sequence in sequence_dict.items():
+            sequence_peptides[name] = [
+                (sequence[offset:offset + peptide_length], name, offset)
+                for peptide_length in peptide_lengths
+                for offset in range(len(sequence) - peptide_length + 1)]
+        cached = self._lookup(set(
+            peptide for peptides in sequence_peptides.values() for peptide, _, _ in peptides))
+
+        # sequences with any uncached peptide are predicted whole, as they would be without the
+        # cache: predictors like IEDB's make one request per sequence, not per peptide
+        uncached_sequences = OrderedDict()
+        binding_predictions = []
+        for name, peptides in sequence_peptides.items():
+            if all(self._is_cached(cached, peptide) for peptide, _, _ in peptides):
+                binding_predictions.extend(self._binding_predictions(cached, peptides))
+            else:
+                uncached_sequences[name] = sequence_dict[name]
+        if uncached_sequences:
+            predicted = list(self.predictor.predict_subsequences(
+                uncached_sequences, peptide_lengths=peptide_lengths))
+            self.cache.store(self.predictor_name, self.version, predicted)
+            binding_predictions.extend(predicted)
+        return BindingPredictionCollection(binding_predictions)
+
+    def hit_rate(self):
+        return self.stats["hits"] / self.stats["lookups"] if self.stats["lookups"] else 0.0
+
+
+def default_predictor_version(predictor):
+    import mhctools
+    return "%s/mhctools-%s" % (type(predictor).__name__, mhctools.__version__)
+
+
+def run_vaxrank(cache, vaxrank_args, predictor_version=""):
+    """
+    Run Vaxrank's command line with the MHC predictor it builds wrapped in a CachedPredictor.
+
+    Returns:
+    list: the CachedPredictor objects Vaxrank built (normally one).
+    """
+    import vaxrank.cli
+
+    build_predictor = vaxrank.cli.mhc_binding_predictor_from_args
+    cached_predictors = []
+
+    def build_cached_predictor(args):
+        predictor = build_predictor(args)
+        cached_predictor = CachedPredictor(
+            predictor,
+            cache,
+            args.mhc_predictor,
+            predictor_version or default_predictor_version(predictor))
+        cached_predictors.append(cached_predictor)
+        return cached_predictor
+
+    vaxrank.cli.mhc_binding_predictor_from_args = build_cached_predictor
+    try:
+        vaxrank.cli.main(vaxrank_args)
+    finally:
+        vaxrank.cli.mhc_binding_predictor_from_args = build_predictor
+    return cached_predictors
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    if "--" not in args_list:
+        parser.error("Vaxrank's arguments must follow --")
+    split = args_list.index("--")
+    args = parser.parse_args(args_list[:split])
+
+    cache = PredictionCache(args.cache, timeout=args.timeout)
+    try:
+        cached_predictors = run_vaxrank(cache, args_list[split + 1:], args.predictor_version)
+    finally:
+        cache.close()
+
+    stats = OrderedDict([("cache", args.cache), ("predictors", [])])
+    for cached_predictor in cached_predictors:
+        predictor_stats = OrderedDict([
+            ("predictor", cached_predictor.predictor_name),
+            ("version", cached_predictor.version),
+        ])
+        predictor_stats.update(cached_predictor.stats)
+        predictor_stats["hit_rate"] = cached_predictor.hit_rate()
+        stats["predictors"].append(predictor_stats)
+        print("MHC prediction cache %s: %d/%d (allele, peptide) predictions cached, %.1f%%" % (
+            args.cache, cached_predictor.stats["hits"], cached_predictor.stats["lookups"],
+            100 * cached_predictor.hit_rate()))
+    if args.stats_output:
+        with open(args.stats_output, "w") as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
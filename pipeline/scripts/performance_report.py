@@ -0,0 +1,354 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Report where a pipeline run's time went, from its job graph, benchmarks and Snakemake stats.
+
+Joins the job graph written after each run (<workdir>/<sample>/jobs_Snakefile.json, and
+jobs_reference_Snakefile.json for reference processing), the per-job benchmark files and the
+stats.json files Snakemake writes, into:
+- a per-job (so per-shard) and per-rule table of wall time, CPU time, max RSS and I/O;
+- the critical path of each run: the chain of dependent jobs with the longest total wall time,
+  which bounds the run time however many cores there are;
+- core use over each run: core-seconds given to jobs, actually used by them, and left idle.
+
+Writes <output-prefix>.json and a standalone <output-prefix>.html. With --baseline, the per-rule
+wall times are compared with those of an earlier report's JSON.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import html
+import json
+from os.path import basename, exists
+import time
+
+from resource_model import read_benchmark
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--job-graph",
+    nargs="+",
+    required=True,
+    help="Job graph JSON file(s) written by the pipeline after a run")
+
+parser.add_argument(
+    "--stats",
+    nargs="*",
+    default=[],
+    help="Snakemake stats.json file(s) of the same runs")
+
+parser.add_argument(
+    "--baseline",
+    default="",
+    help="JSON report of an earlier run to compare with")
+
+parser.add_argument(
+    "--output-prefix",
+    required=True)
+
+BENCHMARK_COLUMNS = ("s", "max_rss", "mean_load", "io_in", "io_out")
+
+
+def read_stats_times(stats_files):
+    """
+    Start and stop times (seconds since the epoch) of the jobs in Snakemake stats.json files, as a
+    dict of output file -> (start, stop).
+    """
+    times = {}
+    for stats_file in stats_files:
+        with open(stats_file) as f:
+            stats = json.load(f)
+        for output, file_stats in stats.get("files", {}).items():
+            times[output] = tuple(
+                time.mktime(time.strptime(file_stats[key], "%a %b %d %H:%M:%S %Y"))
+                for key in ("start-time", "stop-time"))
+    return times
+
+
+def read_jobs(job_graph_file, stats_times):
+    """
+    Jobs of a run's job graph, with their timings and benchmark measurements.
+
+    Returns:
+    dict: Run with the job graph's snakefile, cores and mem_mb, and a list of jobs, each a dict
+        with rule, wildcards, threads, dependencies, start and end (None if not in the stats),
+        wall (s), cpu (s), max_rss (MB), io_in and io_out (MB).
+    """
+    with open(job_graph_file) as f:
+        graph = json.load(f)
+    jobs = []
+    for job in graph["jobs"]:
+        benchmark = None
+        if job["benchmark"] and exists(job["benchmark"]):
+            benchmark = read_benchmark(job["benchmark"], BENCHMARK_COLUMNS)
+        times = [stats_times[output] for output in job["output"] if output in stats_times]
+        start, end = times[0] if times else (None, None)
+        if start is not None:
+            wall = end - start
+        elif benchmark is not None:
+            wall = benchmark["s"]
+        else:
+            wall = 0.0
+        cpu = None
+        if benchmark is not None and benchmark["mean_load"] is not None:
+            cpu = benchmark["s"] * benchmark["mean_load"] / 100.0
+        jobs.append(OrderedDict([
+            ("jobid", job["jobid"]),
+            ("rule", job["rule"]),
+            ("wildcards", job["wildcards"]),
+            ("threads", job["threads"]),
+            ("mem_mb", job["mem_mb"]),
+            ("dependencies", job["dependencies"]),
+            ("start", start),
+            ("end", end),
+            ("wall", wall),
+            ("cpu", cpu),
+            ("max_rss", benchmark["max_rss"] if benchmark else None),
+            ("io_in", benchmark["io_in"] if benchmark else None),
+            ("io_out", benchmark["io_out"] if benchmark else None),
+        ]))
+    return OrderedDict([
+        ("snakefile", basename(graph["snakefile"])),
+        ("sample", graph["sample"]),
+        ("cores", graph["cores"]),
+        ("mem_mb", graph["mem_mb"]),
+        ("jobs", jobs),
+    ])
+
+
+def critical_path(jobs):
+    """
+    Chain of dependent jobs with the longest total wall time, as a list of jobids in run order.
+    """
+    by_id = dict((job["jobid"], job) for job in jobs)
+    # longest chain ending at each job, in topological order
+    remaining = dict((job["jobid"], len(job["dependencies"])) for job in jobs)
+    dependents = dict((job["jobid"], []) for job in jobs)
+    for job in jobs:
+        for dependency in job["dependencies"]:
+            dependents[dependency].append(job["jobid"])
+    ready = [jobid for (jobid, count) in remaining.items() if count == 0]
+    length, previous = {}, {}
+    while ready:
+        jobid = ready.pop()
+        dependencies = by_id[jobid]["dependencies"]
+        previous[jobid] = max(dependencies, key=lambda d: length[d]) if dependencies else None
+        length[jobid] = by_id[jobid]["wall"] + (length[previous[jobid]] if dependencies else 0)
+        for dependent in dependents[jobid]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    if not length:
+        return []
+    path = [max(length, key=lambda jobid: length[jobid])]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+    return path[::-1]
+
+
+def core_use(jobs, cores):
+    """
+    Core-seconds over a run's span (the first job start to the last job end): available, given
+    to jobs (their threads), used by them (CPU time) and idle (not given to any job), and a
+    timeline of the cores given and used, as (seconds since the start, given, used) steps.
+    """
+    timed = [job for job in jobs if job["start"] is not None]
+    if not timed:
+        return None
+    start = min(job["start"] for job in timed)
+    span = max(job["end"] for job in timed) - start
+    given = sum(job["threads"] * job["wall"] for job in timed)
+    used = sum(job["cpu"] or 0 for job in timed)
+    events = []
+    for job in timed:
+        load = (job["cpu"] or 0) / job["wall"] if job["wall"] else 0
+        events.append((job["start"] - start, job["threads"], load))
+        events.append((job["end"] - start, -job["threads"], -load))
+    timeline, given_now, used_now = [], 0, 0.0
+    for (t, threads, load) in sorted(events):
+        given_now += threads
+        used_now += load
+        if timeline and timeline[-1][0] == t:
+            timeline[-1] = (t, given_now, used_now)
+        else:
+            timeline.append((t, given_now, used_now))
+    return OrderedDict([
+        ("span", span),
+        ("available", cores * span),
+        ("given", given),
+        ("used", used),
+        ("idle", max(0, cores * span - given)),
+        ("timeline", timeline),
+    ])
+
+
+def rule_table(jobs, baseline_rules=None):
+    """
+    Per-rule totals over the jobs, sorted by total wall time.
+    """
+    rules = OrderedDict()
+    for job in jobs:
+        row = rules.setdefault(job["rule"], OrderedDict([
+            ("rule", job["rule"]), ("jobs", 0), ("wall", 0.0), ("max_job_wall", 0.0),
+            ("cpu", 0.0), ("max_rss", None), ("io_in", 0.0), ("io_out", 0.0)]))
+        row["jobs"] += 1
+        row["wall"] += job["wall"]
+        row["max_job_wall"] = max(row["max_job_wall"], job["wall"])
+        row["cpu"] += job["cpu"] or 0
+        if job["max_rss"] is not None:
+            row["max_rss"] = max(row["max_rss"] or 0, job["max_rss"])
+        row["io_in"] += job["io_in"] or 0
+        row["io_out"] += job["io_out"] or 0
+    if baseline_rules is not None:
+        baseline_wall = dict((row["rule"], row["wall"]) for row in baseline_rules)
+        for row in rules.values():
+            row["baseline_wall"] = baseline_wall.get(row["rule"])
+    return sorted(rules.values(), key=lambda row: -row["wall"])
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return ""
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def format_number(value, digits=0):
+    return "" if value is None else "%.*f" % (digits, value)
+
+
+def html_table(headers, rows):
+    lines = ["<table>", "<tr>%s</tr>" % "".join("<th>%s</th>" % html.escape(h) for h in headers)]
+    for row in rows:
+        lines.append("<tr>%s</tr>" % "".join("<td>%s</td>" % html.escape(str(v)) for v in row))
+    lines.append("</table>")
+    return "\n".join(lines)
+
+
+def timeline_svg(use, cores, width=900, height=160):
+    """
+    Step plot of the cores given to jobs (filled) and used by them (line) over a run.
+    """
+    span = use["span"] or 1
+    x = lambda t: width * t / span
+    y = lambda c: height - height * min(c, cores) / cores
+
+    def steps(index):
+        points, level = ["0,%d" % height], 0
+        for step in use["timeline"]:
+            points.append("%.1f,%.1f" % (x(step[0]), y(level)))
+            level = step[index]
+            points.append("%.1f,%.1f" % (x(step[0]), y(level)))
+        return " ".join(points)
+
+    return (
+        '<svg width="%d" height="%d" style="border:1px solid #999">'
+        '<polygon points="%s %d,%d" fill="#9cc3e6"/>'
+        '<polyline points="%s" fill="none" stroke="#c0392b"/>'
+        '</svg>' % (width, height, steps(1), width, height, steps(2)))
+
+
+def write_html(report, path):
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Pipeline performance</title>",
+        "<style>body{font-family:sans-serif;margin:2em} table{border-collapse:collapse;"
+        "margin-bottom:2em} td,th{border:1px solid #ccc;padding:2px 8px;text-align:right} "
+        "td:first-child,th:first-child{text-align:left}</style></head><body>",
+        "<h1>Pipeline performance: %s</h1>" % html.escape(report["sample"]),
+    ]
+    for run in report["runs"]:
+        use = run["core_use"]
+        parts.append("<h2>%s</h2>" % html.escape(run["snakefile"]))
+        if use is not None:
+            parts.append(
+                "<p>Run time %s on %d cores. Core time given to jobs %.0f%%, used by them %.0f%%, "
+                "idle %.0f%%.</p>" % (
+                    format_seconds(use["span"]), run["cores"],
+                    100.0 * use["given"] / (use["available"] or 1),
+                    100.0 * use["used"] / (use["available"] or 1),
+                    100.0 * use["idle"] / (use["available"] or 1)))
+            parts.append("<p>Cores given to jobs (blue) and used by them (red):</p>")
+            parts.append(timeline_svg(use, run["cores"]))
+        parts.append("<h3>Critical path (%s)</h3>" % format_seconds(run["critical_path_wall"]))
+        by_id = dict((job["jobid"], job) for job in run["jobs"])
+        parts.append(html_table(
+            ["rule", "wildcards", "wall", "threads"],
+            [(by_id[jobid]["rule"], format_wildcards(by_id[jobid]["wildcards"]),
+              format_seconds(by_id[jobid]["wall"]), by_id[jobid]["threads"])
+             for jobid in run["critical_path"]]))
+    baseline = any("baseline_wall" in row for row in report["rules"])
+    parts.append("<h2>Rules</h2>")
+    parts.append(html_table(
+        ["rule", "jobs", "wall", "longest job", "CPU", "max RSS (MB)", "read (MB)", "written (MB)"] +
+        (["baseline wall"] if baseline else []),
+        [[row["rule"], row["jobs"], format_seconds(row["wall"]),
+          format_seconds(row["max_job_wall"]), format_seconds(row["cpu"]),
+          format_number(row["max_rss"]), format_number(row["io_in"]),
+          format_number(row["io_out"])] +
+         ([format_seconds(row.get("baseline_wall"))] if baseline else [])
+         for row in report["rules"]]))
+    parts.append("<h2>Jobs</h2>")
+    parts.append(html_table(
+        ["rule", "wildcards", "wall", "CPU", "threads", "max RSS (MB)", "read (MB)",
+         "written (MB)"],
+        [(job["rule"], format_wildcards(job["wildcards"]), format_seconds(job["wall"]),
+          format_seconds(job["cpu"]), job["threads"], format_number(job["max_rss"]),
+          format_number(job["io_in"]), format_number(job["io_out"]))
+         for run in report["runs"]
+         for job in sorted(run["jobs"], key=lambda job: -job["wall"])]))
+    parts.append("</body></html>")
+    with open(path, "w") as f:
+        f.write("\n".join(parts) + "\n")
+
+
+def format_wildcards(wildcards):
+    return ", ".join("%s=%s" % item for item in sorted(wildcards.items()))
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    stats_times = read_stats_times(args.stats)
+    runs = [read_jobs(job_graph, stats_times) for job_graph in args.job_graph]
+    for run in runs:
+        run["critical_path"] = critical_path(run["jobs"])
+        by_id = dict((job["jobid"], job) for job in run["jobs"])
+        run["critical_path_wall"] = sum(by_id[jobid]["wall"] for jobid in run["critical_path"])
+        run["core_use"] = core_use(run["jobs"], run["cores"])
+
+    baseline_rules = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_rules = json.load(f)["rules"]
+    report = OrderedDict([
+        ("sample", runs[0]["sample"]),
+        ("rules", rule_table([job for run in runs for job in run["jobs"]], baseline_rules)),
+        ("runs", runs),
+    ])
+    with open(args.output_prefix + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    write_html(report, args.output_prefix + ".html")
+
+    for run in runs:
+        print("%s: critical path %s" % (
+            run["snakefile"], format_seconds(run["critical_path_wall"])))
+        if run["core_use"] is not None:
+            print("%s: run time %s, %.0f%% of core time idle" % (
+                run["snakefile"], format_seconds(run["core_use"]["span"]),
+                100.0 * run["core_use"]["idle"] / (run["core_use"]["available"] or 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Project full-depth QC metrics of the normal and tumor DNA from a small aligned sample of their reads.
+
+Inputs are the duplication metrics and (with a capture kit) CollectHsMetrics output of each
+sample's subsampled, aligned reads, and the read counts written by subsample_fastq.py. The
+library size is estimated from the sample's duplicates as Picard does, and gives the duplication
+rate and number of unique reads expected at full depth; the mean target and bait coverage are
+scaled up by the number of unique reads. Alignment and on-target rates are taken from the sample
+as they are. The projections are checked against the same metrics spec as sequencing.py (metrics
+that can't be projected, like PCT_TARGET_BASES_30X, are skipped). With --fail-on-error, failed
+checks make this exit with an error, so that the pipeline stops before full-depth alignment.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+import math
+import sys
+
+import yaml
+
+from duplication_metrics import estimate_library_size
+from sequencing import check_metrics, get_metrics
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+for _sample in ["normal", "tumor"]:
+    parser.add_argument(
+        "--%s-duplication-metrics" % _sample,
+        default="",
+        help="Duplication metrics of the %s DNA sample's aligned reads" % _sample)
+    parser.add_argument(
+        "--%s-hs-metrics" % _sample,
+        default="",
+        help="CollectHsMetrics output for the %s DNA sample's aligned reads" % _sample)
+    parser.add_argument(
+        "--%s-read-counts" % _sample,
+        nargs="*",
+        default=[],
+        help="subsample_fastq.py read counts of each %s DNA fragment" % _sample)
+
+parser.add_argument(
+    "--metrics-spec-file",
+    required=True,
+    help="Path to YAML file specifying the QC metric thresholds")
+
+parser.add_argument(
+    "--out",
+    required=True,
+    help="Output file path for any failed checks")
+
+parser.add_argument(
+    "--estimates-output",
+    default="",
+    help="JSON file to write the projected metrics to")
+
+parser.add_argument(
+    "--fail-on-error",
+    action="store_true",
+    help="Exit with an error if any check fails, instead of only reporting it")
+
+# HsMetrics values that don't depend on depth, and are taken from the sample as they are
+SAMPLE_HS_METRICS = ["PCT_PF_UQ_READS_ALIGNED", "PCT_SELECTED_BASES", "PCT_OFF_BAIT"]
+# HsMetrics values proportional to the number of unique reads
+SCALED_HS_METRICS = ["MEAN_TARGET_COVERAGE", "MEAN_BAIT_COVERAGE"]
+
+
+def read_counts(paths):
+    """
+    Total and sampled reads (or read pairs) over a sample's fragments.
+    """
+    total = sampled = 0
+    for path in paths:
+        with open(path) as f:
+            counts = json.load(f)
+        total += counts["total_reads"]
+        sampled += counts["sampled_reads"]
+    return total, sampled
+
+
+def project_duplication(duplication_metrics, sampling_fraction):
+    """
+    Duplication expected at full depth, from that of a sample of the reads.
+
+    Parameters:
+    duplication_metrics (dict): MarkDuplicates metrics of the sample.
+    sampling_fraction (float): Fraction of the reads in the sample.
+
+    Returns:
+    dict: PERCENT_DUPLICATION and ESTIMATED_LIBRARY_SIZE at full depth, and UNIQUE_READS_SCALE,
+        the ratio of the unique reads at full depth to those in the sample.
+    """
+    pairs = duplication_metrics["READ_PAIRS_EXAMINED"]
+    if pairs > 0:
+        examined, duplicates = pairs, duplication_metrics["READ_PAIR_DUPLICATES"]
+    else:
+        examined = duplication_metrics["UNPAIRED_READS_EXAMINED"]
+        duplicates = duplication_metrics["UNPAIRED_READ_DUPLICATES"]
+    unique = examined - duplicates
+    full_examined = examined / sampling_fraction
+    library_size = estimate_library_size(examined, unique) if unique > 0 else None
+    if library_size is None:
+        # no duplicates in the sample: as far as it can tell, every molecule is distinct
+        full_unique = full_examined
+    else:
+        full_unique = library_size * (1 - math.exp(-full_examined / library_size))
+    return OrderedDict([
+        ("PERCENT_DUPLICATION", 1 - full_unique / full_examined if full_examined else 0.0),
+        ("ESTIMATED_LIBRARY_SIZE", library_size),
+        ("UNIQUE_READS_SCALE", full_unique / unique if unique else 0.0),
+    ])
+
+
+def project_sample_metrics(duplication_metrics_path, hs_metrics_path, read_counts_paths):
+    """
+    Full-depth metrics of one sample, keyed by the file types of the metrics spec.
+    """
+    total, sampled = read_counts(read_counts_paths)
+    duplication = project_duplication(
+        get_metrics(duplication_metrics_path), sampled / total if total else 1.0)
+    projected = OrderedDict([
+        ("total_reads", total),
+        ("sampled_reads", sampled),
+        ("duplication_metrics", OrderedDict([
+            ("PERCENT_DUPLICATION", duplication["PERCENT_DUPLICATION"]),
+            ("ESTIMATED_LIBRARY_SIZE", duplication["ESTIMATED_LIBRARY_SIZE"]),
+        ])),
+        ("hs_metrics", OrderedDict()),
+    ])
+    if hs_metrics_path:
+        hs_metrics = get_metrics(hs_metrics_path)
+        for key in SAMPLE_HS_METRICS:
+            projected["hs_metrics"][key] = hs_metrics[key]
+        for key in SCALED_HS_METRICS:
+            projected["hs_metrics"][key] = hs_metrics[key] * duplication["UNIQUE_READS_SCALE"]
+    return projected
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+
+    estimates = OrderedDict()
+    metrics_by_file_type = {}
+    for sample in ["normal", "tumor"]:
+        duplication_metrics_path = getattr(args, "%s_duplication_metrics" % sample)
+        if not duplication_metrics_path:
+            continue
+        estimates[sample] = project_sample_metrics(
+            duplication_metrics_path,
+            getattr(args, "%s_hs_metrics" % sample),
+            getattr(args, "%s_read_counts" % sample))
+        for kind in ["duplication_metrics", "hs_metrics"]:
+            metrics_by_file_type["%s_dna_%s" % (sample, kind)] = estimates[sample][kind]
+        print("%s: %d of %d reads sampled, projected %s" % (
+            sample, estimates[sample]["sampled_reads"], estimates[sample]["total_reads"],
+            ", ".join("%s=%s" % item for kind in ["duplication_metrics", "hs_metrics"]
+                      for item in estimates[sample][kind].items())))
+
+    with open(args.metrics_spec_file) as metrics_spec_file:
+        all_metric_specs = yaml.safe_load(metrics_spec_file)
+    # the projections don't cover every metric of the spec (e.g. PCT_TARGET_BASES_30X), or a
+    # sample that isn't in the config
+    error_msgs = check_metrics(all_metric_specs, metrics_by_file_type, skip_missing=True)
+
+    if args.estimates_output:
+        with open(args.estimates_output, "w") as f:
+            json.dump(estimates, f, indent=2)
+    with open(args.out, "w") as error_msg_file:
+        for error_msg in error_msgs:
+            print(error_msg)
+            error_msg_file.write(error_msg + "\n")
+
+    if error_msgs and args.fail_on_error:
+        raise ValueError(
+            "Projected QC metrics failed %d checks, stopping before full-depth alignment. "
+            "Set preflight_qc to warn in the config to carry on anyway" % len(error_msgs))
+
+
+if __name__ == "__main__":
+    main()
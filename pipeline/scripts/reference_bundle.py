@@ -0,0 +1,291 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Manifest of the processed reference files, and a shared cache of verified reference bundles.
+
+Once reference processing is done, the manifest (<genome>.manifest.json) records the size,
+modification time and SHA-256 of the reference inputs (FASTA and GTF) and of every file built from
+them: the BWA index, .fai, .dict, contig lists and the STAR genome. A later run whose files all
+still match the manifest can skip reference processing. Files whose size matches but whose
+modification time doesn't (e.g. after a copy) are hashed again.
+
+A bundle is the set of built files for given inputs, identified by the hash of the inputs'
+contents. Bundles are exported to a cache directory (<cache>/<bundle id>/, with the manifest), on
+a shared or local disk, and imported from it by hardlinking (or copying) the files next to the
+reference FASTA, so that a new host doesn't have to index the reference itself.
+
+This module only uses the standard library.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import json
+import os
+from os.path import basename, dirname, exists, isdir, join, relpath, splitext
+import shutil
+
+MANIFEST_VERSION = 1
+
+# Must match _READ_LENGTH in common.rules, which names the STAR genome directory
+STAR_READ_LENGTH = 124
+
+BWA_INDEX_EXTENSIONS = ["amb", "ann", "bwt", "pac", "sa"]
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_entry(path, sha256=None):
+    """
+    Manifest entry for a file: its size, modification time and content hash (computed if not
+    given).
+    """
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256 if sha256 is not None else sha256_file(path),
+    }
+
+
+def link_or_copy(source, dest):
+    """
+    Hardlink the source file to dest, or copy it if they're on different filesystems, going through
+    a temporary file so that dest never holds a partial copy.
+    """
+    tmp_dest = "%s.tmp%d" % (dest, os.getpid())
+    try:
+        os.link(source, tmp_dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copy2(source, tmp_dest)
+    os.replace(tmp_dest, dest)
+
+
+class ReferenceBundle(object):
+    """
+    The reference inputs and built files of a pipeline config, all under the FASTA's directory.
+    """
+    def __init__(self, genome, transcripts, threads=4):
+        self.genome = genome
+        self.transcripts = transcripts
+        self.reference_dir = dirname(genome)
+        self.manifest_path = genome + ".manifest.json"
+        self.done_path = genome + ".done"
+        self.threads = threads
+
+    @classmethod
+    def from_config(cls, config, threads=4):
+        return cls(config["reference"]["genome"], config["reference"]["transcripts"], threads)
+
+    def input_paths(self):
+        return [self.genome, self.transcripts]
+
+    def star_genome_dir(self):
+        return join(self.reference_dir, "star-genome-%d" % STAR_READ_LENGTH)
+
+    def artifact_paths(self):
+        """
+        Files built by reference processing, or None if some of them are missing.
+        """
+        paths = ["%s.%s" % (self.genome, ext) for ext in BWA_INDEX_EXTENSIONS] + [
+            self.genome + ".fai",
+            splitext(self.genome)[0] + ".dict",
+            self.genome + ".contigs",
+            self.genome + ".contig_aliases",
+        ]
+        star_genome_dir = self.star_genome_dir()
+        if not isdir(star_genome_dir):
+            return None
+        for root, _, filenames in os.walk(star_genome_dir):
+            paths.extend(join(root, filename) for filename in sorted(filenames))
+        if not all(exists(path) for path in paths):
+            return None
+        return paths
+
+    def _relpath(self, path):
+        return relpath(path, self.reference_dir)
+
+    def _hash_files(self, paths):
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            return dict(zip(paths, executor.map(sha256_file, paths)))
+
+    def bundle_id(self, inputs):
+        """
+        Identifier of the bundle built from inputs with the given manifest entries.
+        """
+        sha256 = hashlib.sha256()
+        sha256.update(("star_read_length=%d\n" % STAR_READ_LENGTH).encode())
+        for name in sorted(inputs):
+            sha256.update(("%s=%s\n" % (basename(name), inputs[name]["sha256"])).encode())
+        return sha256.hexdigest()[:32]
+
+    def read_manifest(self, path=None):
+        path = path or self.manifest_path
+        if not exists(path):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def _check_entries(self, entries, base_dir):
+        """
+        Whether the files of the manifest entries under base_dir have the recorded contents,
+        hashing only those whose modification time changed. Updates the entries' modification
+        times for those whose contents still match.
+        """
+        to_hash = []
+        for name, entry in entries.items():
+            path = join(base_dir, name)
+            if not exists(path):
+                return False
+            stat = os.stat(path)
+            if stat.st_size != entry["size"]:
+                return False
+            if stat.st_mtime_ns != entry["mtime_ns"]:
+                to_hash.append(name)
+        hashes = self._hash_files([join(base_dir, name) for name in to_hash])
+        for name in to_hash:
+            if hashes[join(base_dir, name)] != entries[name]["sha256"]:
+                return False
+            entries[name]["mtime_ns"] = os.stat(join(base_dir, name)).st_mtime_ns
+        return True
+
+    def matches_manifest(self):
+        """
+        Whether the reference inputs and built files all match the manifest, i.e. reference
+        processing can be skipped.
+        """
+        manifest = self.read_manifest()
+        if manifest is None or not exists(self.done_path):
+            return False
+        input_names = set(self._relpath(path) for path in self.input_paths())
+        if input_names != set(manifest["inputs"]):
+            return False
+        # a pipeline version that builds other files has to build them
+        artifact_paths = self.artifact_paths()
+        if artifact_paths is None or (
+                set(self._relpath(path) for path in artifact_paths) != set(manifest["artifacts"])):
+            return False
+        changed = dict((name, dict(entry)) for name, entry in manifest["inputs"].items())
+        changed_artifacts = dict(
+            (name, dict(entry)) for name, entry in manifest["artifacts"].items())
+        if not (self._check_entries(changed, self.reference_dir) and
+                self._check_entries(changed_artifacts, self.reference_dir)):
+            return False
+        if changed != manifest["inputs"] or changed_artifacts != manifest["artifacts"]:
+            manifest.update(inputs=changed, artifacts=changed_artifacts)
+            self._write_manifest(manifest, self.manifest_path)
+        return True
+
+    def _write_manifest(self, manifest, path):
+        tmp_path = "%s.tmp%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def write_manifest(self):
+        """
+        Hash the inputs and built files and write the manifest. Returns it, or None if some built
+        files are missing.
+        """
+        artifact_paths = self.artifact_paths()
+        if artifact_paths is None:
+            return None
+        hashes = self._hash_files(self.input_paths() + artifact_paths)
+        inputs = dict(
+            (self._relpath(path), file_entry(path, hashes[path])) for path in self.input_paths())
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "bundle_id": self.bundle_id(inputs),
+            "inputs": inputs,
+            "artifacts": dict(
+                (self._relpath(path), file_entry(path, hashes[path])) for path in artifact_paths),
+        }
+        self._write_manifest(manifest, self.manifest_path)
+        return manifest
+
+    def export_to_cache(self, cache_dir, manifest):
+        """
+        Add the built files to the cache as <cache_dir>/<bundle id>, unless they're already there.
+        """
+        bundle_dir = join(cache_dir, manifest["bundle_id"])
+        if exists(bundle_dir):
+            return bundle_dir
+        tmp_dir = "%s.tmp%d" % (bundle_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        try:
+            for name in manifest["artifacts"]:
+                dest = join(tmp_dir, name)
+                if not exists(dirname(dest)):
+                    os.makedirs(dirname(dest))
+                link_or_copy(join(self.reference_dir, name), dest)
+            self._write_manifest(manifest, join(tmp_dir, "manifest.json"))
+            os.rename(tmp_dir, bundle_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not exists(bundle_dir):
+                raise
+        return bundle_dir
+
+    def import_from_cache(self, cache_dir):
+        """
+        Link or copy the built files for this reference's inputs from the cache, if the cache has
+        them, and write the manifest and .done file. Returns whether it did.
+        """
+        input_paths = self.input_paths()
+        if not all(exists(path) for path in input_paths):
+            return False
+        hashes = self._hash_files(input_paths)
+        inputs = dict(
+            (self._relpath(path), file_entry(path, hashes[path])) for path in input_paths)
+        bundle_dir = join(cache_dir, self.bundle_id(inputs))
+        cached_manifest = self.read_manifest(join(bundle_dir, "manifest.json"))
+        if cached_manifest is None:
+            return False
+        artifacts = cached_manifest["artifacts"]
+        for name, entry in artifacts.items():
+            # bundles are only added to the cache once complete, so a size check is enough to
+            # catch a truncated copy
+            if os.stat(join(bundle_dir, name)).st_size != entry["size"]:
+                return False
+        for name in artifacts:
+            dest = join(self.reference_dir, name)
+            if not exists(dirname(dest)):
+                os.makedirs(dirname(dest))
+            link_or_copy(join(bundle_dir, name), dest)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "bundle_id": cached_manifest["bundle_id"],
+            "inputs": inputs,
+            "artifacts": dict(
+                (name, file_entry(join(self.reference_dir, name), entry["sha256"]))
+                for name, entry in artifacts.items()),
+        }
+        self._write_manifest(manifest, self.manifest_path)
+        with open(self.done_path, "a"):
+            os.utime(self.done_path, None)
+        return True
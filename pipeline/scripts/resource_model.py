@@ -0,0 +1,242 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-rule thread and memory requests learned from the benchmarks of previous pipeline runs.
+
+After each run, the Snakemake benchmark of every job (wall time, max RSS, mean CPU load) is added
+to a history TSV file, along with the job's rule, the number of threads it was given and the total
+size of the patient's inputs. From that history:
+- A rule's memory request is the peak RSS of its jobs, scaled to this run's input size by a linear
+  fit across patients, plus MEM_HEADROOM, rounded up to whole GB.
+- A rule's thread request is cut down to the number of cores its jobs actually kept busy, if they
+  used less than BUSY_FRACTION of the threads they were given. It is never raised.
+Rules without history keep the pipeline's heuristics.
+
+Run as a script, this prints the estimates from a history file for a given input size.
+
+This module only uses the standard library, so that it can be imported when the Snakefile is
+parsed.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import csv
+import fcntl
+import math
+import os
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--history",
+    required=True,
+    help="Resource history TSV file written by the pipeline")
+
+parser.add_argument(
+    "--input-mb",
+    type=float,
+    default=None,
+    help="Total size of a patient's inputs, in MB, to scale the memory estimates to")
+
+HISTORY_COLUMNS = [
+    "sample", "input_mb", "rule", "benchmark", "threads", "s", "max_rss", "mean_load"]
+
+# memory requested on top of the predicted peak RSS
+MEM_HEADROOM = 1.25
+
+# a rule is given fewer threads only if its jobs kept less than this fraction of them busy
+BUSY_FRACTION = 0.75
+
+# CPU load of jobs shorter than this (in seconds) isn't trusted: Snakemake only samples it every
+# few seconds
+MIN_SECONDS_FOR_LOAD = 60
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_benchmark(path, columns=("s", "max_rss", "mean_load")):
+    """
+    Measurements from a Snakemake benchmark file, e.g. wall time (s), max RSS (MB) and mean CPU
+    load (in percent of a core), taking the maximum over its repeats. Returns None if the file has
+    no measurements, e.g. for a job that finished before Snakemake sampled it.
+    """
+    result = None
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            values = dict((key, _parse_float(row.get(key))) for key in columns)
+            if values["s"] is None or values["max_rss"] is None:
+                continue
+            if result is None:
+                result = values
+            else:
+                result = dict((key, max(result[key] or 0, values[key] or 0)) for key in result)
+    return result
+
+
+class ResourceModel(object):
+    """
+    Benchmark history of previous runs, as a list of dicts with the HISTORY_COLUMNS keys.
+    """
+    def __init__(self, rows=None):
+        self.rows = list(rows or [])
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a history written by ResourceModel.write, or an empty one if there's no such file.
+        """
+        if not os.path.exists(path):
+            return cls()
+        rows = []
+        with open(path) as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                for key in ("input_mb", "threads", "s", "max_rss", "mean_load"):
+                    row[key] = _parse_float(row[key])
+                rows.append(row)
+        return cls(rows)
+
+    def write(self, path):
+        """
+        Write the history as a TSV file, replacing the given file atomically.
+        """
+        tmp_path = "%s.tmp%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            writer = csv.DictWriter(
+                f, HISTORY_COLUMNS, delimiter="\t", lineterminator="\n", extrasaction="ignore")
+            writer.writeheader()
+            for row in self.rows:
+                writer.writerow(dict(
+                    (key, "NA" if row.get(key) is None else row[key]) for key in HISTORY_COLUMNS))
+        os.replace(tmp_path, path)
+
+    def add_run(self, sample, input_mb, entries):
+        """
+        Add the benchmarks of a run, as dicts with rule, benchmark, threads, s, max_rss and
+        mean_load keys. They replace the history of the same benchmarks of the same sample, e.g.
+        from an earlier run that failed.
+        """
+        replaced = set(entry["benchmark"] for entry in entries)
+        self.rows = [
+            row for row in self.rows
+            if not (row["sample"] == sample and row["benchmark"] in replaced)
+        ]
+        for entry in entries:
+            row = dict(entry)
+            row.update(sample=sample, input_mb=input_mb)
+            self.rows.append(row)
+
+    def rules(self):
+        return sorted(set(row["rule"] for row in self.rows))
+
+    def _peak_rss_per_sample(self, rule):
+        """
+        (input size, peak RSS) of each sample's jobs of the rule: the scheduler has to make room
+        for the largest of them (e.g. the largest interval shard).
+        """
+        peaks = OrderedDict()
+        for row in self.rows:
+            if row["rule"] != rule or row["max_rss"] is None:
+                continue
+            input_mb, peak = peaks.get(row["sample"], (row["input_mb"], 0))
+            peaks[row["sample"]] = (input_mb, max(peak, row["max_rss"]))
+        return list(peaks.values())
+
+    def mem_mb(self, rule, input_mb=None):
+        """
+        Memory request for the rule's jobs, in MB (a multiple of 1024), or None if there's no
+        history for the rule.
+
+        Parameters:
+        rule (str): Rule name.
+        input_mb (float): Total size of this run's inputs, or None if unknown, in which case the
+            largest peak seen is used.
+        """
+        points = self._peak_rss_per_sample(rule)
+        if not points:
+            return None
+        peaks = [peak for (_, peak) in points]
+        if input_mb is None or any(size is None or size <= 0 for (size, _) in points):
+            predicted = max(peaks)
+        else:
+            sizes = [size for (size, _) in points]
+            if len(set(sizes)) > 1:
+                # least-squares line through the peaks; memory doesn't shrink with more input
+                mean_size, mean_peak = sum(sizes) / len(sizes), sum(peaks) / len(peaks)
+                slope = max(0.0, sum(
+                    (size - mean_size) * (peak - mean_peak) for (size, peak) in points
+                ) / sum((size - mean_size) ** 2 for size in sizes))
+                predicted = mean_peak + slope * (input_mb - mean_size)
+            else:
+                # a single input size to go by: assume the peak is proportional to the input
+                # beyond it, which overestimates the memory of tools with a fixed footprint
+                predicted = peaks[0] * max(1.0, input_mb / sizes[0])
+            # never below what a smaller (or same-sized) input has needed
+            smaller_peaks = [peak for (size, peak) in points if size <= input_mb]
+            predicted = max([predicted] + smaller_peaks)
+        return 1024 * max(1, int(math.ceil(predicted * MEM_HEADROOM / 1024)))
+
+    def threads(self, rule, default):
+        """
+        Thread request for the rule's jobs: the default, or fewer if the jobs given the most
+        threads so far kept less than BUSY_FRACTION of them busy.
+        """
+        rows = [
+            row for row in self.rows
+            if row["rule"] == rule and row["threads"] and row["mean_load"] is not None and
+            (row["s"] or 0) >= MIN_SECONDS_FOR_LOAD
+        ]
+        if not rows:
+            return default
+        # estimating from the runs with the most threads means that cutting the threads down
+        # doesn't feed back into the next estimate
+        most_threads = max(row["threads"] for row in rows)
+        busy_cores = max(
+            row["mean_load"] for row in rows if row["threads"] == most_threads) / 100.0
+        if busy_cores >= BUSY_FRACTION * most_threads:
+            return default
+        return max(1, min(default, int(math.ceil(busy_cores))))
+
+
+def update_history(path, sample, input_mb, entries):
+    """
+    Add a run's benchmarks to the history file, holding a lock on it so that concurrent runs
+    writing to the same history don't lose each other's updates.
+    """
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        model = ResourceModel.read(path)
+        model.add_run(sample, input_mb, entries)
+        model.write(path)
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    model = ResourceModel.read(args.history)
+    print("rule\tsamples\tmem_mb\tthreads (if given 64)")
+    for rule in model.rules():
+        print("%s\t%d\t%s\t%d" % (
+            rule,
+            len(model._peak_rss_per_sample(rule)),
+            model.mem_mb(rule, args.input_mb),
+            model.threads(rule, 64)))
+
+
+if __name__ == "__main__":
+    main()
@@ -62,6 +62,46 @@ def get_coverage_metrics(path):
     return {k: metrics[k] for k in ('MEAN_TARGET_COVERAGE', 'MEAN_BAIT_COVERAGE')}
 
 
+def check_metrics(all_metric_specs, metrics_by_file_type, skip_missing=False):
+    """
+    Check metrics against the thresholds of a metrics spec (e.g. qc-metrics-spec.yaml).
+
+    Parameters:
+    all_metric_specs (dict): Maps each file type to a list of metric specs, each with a key,
+        comparator (MIN or MAX) and value.
+    metrics_by_file_type (dict): Maps each file type to a dict of its metric values.
+    skip_missing (bool): Skip the specs of metrics (or file types) that are missing, instead of
+        raising a KeyError.
+
+    Returns:
+    list of str: An error message for each metric outside its threshold.
+    """
+    error_msgs = []
+    for file_type, metric_specs in all_metric_specs.items():
+        if skip_missing:
+            metrics = metrics_by_file_type.get(file_type, {})
+        else:
+            metrics = metrics_by_file_type[file_type]
+
+        # iterate through each metric rule, check that each isn't broken in the metric counts
+        for metric_spec in metric_specs:
+            key = metric_spec['key']
+            expected_value = metric_spec['value']
+            if skip_missing and key not in metrics:
+                continue
+            if metric_spec['comparator'] == 'MIN':
+                if metrics[key] < expected_value:
+                    error_msgs.append('%s: %s expected to be at least %.3f but was %.3f' % (
+                        file_type, key, expected_value, metrics[key]))
+            elif metric_spec['comparator'] == 'MAX':
+                if metrics[key] > expected_value:
+                    error_msgs.append('%s: %s expected to be at most %.3f but was %.3f' % (
+                        file_type, key, expected_value, metrics[key]))
+            else:
+                print('Unknown comparator, skipping: %s' % metric_spec['comparator'])
+    return error_msgs
+
+
 def main(args_list=None):
     if args_list is None:
         args_list = sys.argv[1:]
@@ -78,33 +118,16 @@ def main(args_list=None):
     with open(args.metrics_spec_file) as metrics_spec_file:
         all_metric_specs = yaml.safe_load(metrics_spec_file)
 
-    with open(args.out, 'w') as error_msg_file:    
-        for file_type, metric_specs in all_metric_specs.items():
-            # get actual metric counts
-            path = metrics_file_to_path[file_type]
-            with open(path) as metrics_file:
-                metrics = get_metrics(path)
-
-            # iterate through each metric rule, check that each isn't broken in the metric counts
-            for metric_spec in metric_specs:
-                key = metric_spec['key']
-                expected_value = metric_spec['value']
-                if metric_spec['comparator'] == 'MIN':
-                    if metrics[key] < expected_value:
-                        error_msg = '%s: %s expected to be at least %.3f but was %.3f' % (
-                            file_type, key, expected_value, metrics[key]
-                        )
-                        print(error_msg)
-                        error_msg_file.write(error_msg + '\n')
-                elif metric_spec['comparator'] == 'MAX':
-                    if metrics[key] > expected_value:
-                        error_msg = '%s: %s expected to be at most %.3f but was %.3f' % (
-                            file_type, key, expected_value, metrics[key]
-                        )
-                        print(error_msg)
-                        error_msg_file.write(error_msg + '\n')
-                else:
-                    print('Unknown comparator, skipping: %s' % metric_spec['comparator'])
+    # get actual metric counts
+    metrics_by_file_type = {
+        file_type: get_metrics(metrics_file_to_path[file_type])
+        for file_type in all_metric_specs
+    }
+
+    with open(args.out, 'w') as error_msg_file:
+        for error_msg in check_metrics(all_metric_specs, metrics_by_file_type):
+            print(error_msg)
+            error_msg_file.write(error_msg + '\n')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,97 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Split a gzipped FASTQ file into shards with (nearly) the same number of reads each.
+
+Reads are dealt out to the shards in turn, so this needs a single pass over the input and no read
+count up front. Because the n-th read of a file always goes to the same shard, splitting the R1
+and R2 files of a read pair separately gives shards whose reads are still paired.
+"""
+
+from argparse import ArgumentParser
+import gzip
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--input",
+    required=True,
+    help="Gzipped FASTQ file to split")
+
+parser.add_argument(
+    "--outputs",
+    nargs="+",
+    required=True,
+    help="Paths of the gzipped FASTQ shards to write, one per shard")
+
+parser.add_argument(
+    "--compression-level",
+    type=int,
+    default=1,
+    help="gzip compression level of the shards, which are only read once by the aligner")
+
+# reads handed to a shard in one write call
+BATCH_SIZE = 10000
+
+
+def shard_fastq(input_path, output_paths, compression_level=1):
+    """
+    Deal the reads of a FASTQ file out to the output files in turn.
+
+    Parameters:
+    input_path (str): Gzipped FASTQ file.
+    output_paths (list of str): Gzipped FASTQ files to write.
+    compression_level (int): gzip compression level of the outputs.
+
+    Returns:
+    list of int: Number of reads written to each output.
+    """
+    outputs = [gzip.open(path, "wb", compresslevel=compression_level) for path in output_paths]
+    batches = [[] for _ in outputs]
+    num_reads = [0] * len(outputs)
+    try:
+        with gzip.open(input_path, "rb") as f:
+            shard = 0
+            while True:
+                record = [f.readline() for _ in range(4)]
+                if not record[0]:
+                    break
+                if not record[3] or not record[0].startswith(b"@"):
+                    raise ValueError(
+                        "Truncated or malformed FASTQ record after %d reads in %s" % (
+                            sum(num_reads), input_path))
+                batches[shard].extend(record)
+                num_reads[shard] += 1
+                if len(batches[shard]) >= 4 * BATCH_SIZE:
+                    outputs[shard].write(b"".join(batches[shard]))
+                    batches[shard] = []
+                shard = (shard + 1) % len(outputs)
+        for output, batch in zip(outputs, batches):
+            output.write(b"".join(batch))
+    finally:
+        for output in outputs:
+            output.close()
+    return num_reads
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    num_reads = shard_fastq(args.input, args.outputs, args.compression_level)
+    for path, n in zip(args.outputs, num_reads):
+        print("Wrote %d reads to %s" % (n, path))
+
+
+if __name__ == "__main__":
+    main()
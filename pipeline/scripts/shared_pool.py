@@ -0,0 +1,176 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pool of cores and memory shared by the pipeline runs of several patients, with fair-share turns.
+
+In batch mode, each patient's Snakemake run hands its jobs to `shared_pool.py run` (as a
+synchronous cluster submit command), which waits until the job's threads and memory are free in
+the pool and it's the job's turn, runs the Snakemake job script, and gives the resources back.
+
+Turns are fair-share: the waiting jobs are considered in order of the cores their patient holds
+(then of how long they've waited), and each one that fits in what's left starts. A job that doesn't
+fit stops the jobs behind it from overtaking it once it has waited STARVATION_SECONDS, so that
+large jobs aren't starved by a stream of small ones.
+
+The pool's state is a JSON file in the pool directory, changed under a file lock. Jobs whose
+process is gone are dropped from it.
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from os.path import join
+import subprocess
+import sys
+import time
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+subparsers = parser.add_subparsers(dest="command")
+
+init_parser = subparsers.add_parser("init", help="Create a pool")
+init_parser.add_argument("--pool-dir", required=True)
+init_parser.add_argument("--cores", type=int, required=True)
+init_parser.add_argument("--mem-mb", type=int, required=True)
+
+run_parser = subparsers.add_parser("run", help="Run a Snakemake job script in the pool")
+run_parser.add_argument("--pool-dir", required=True)
+run_parser.add_argument("--patient", required=True)
+run_parser.add_argument("jobscript")
+
+POLL_SECONDS = 1
+
+STARVATION_SECONDS = 600
+
+
+@contextmanager
+def locked_state(pool_dir):
+    """
+    The pool's state, as a dict that's written back when the block exits.
+    """
+    with open(join(pool_dir, "pool.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(join(pool_dir, "pool.json")) as f:
+            state = json.load(f)
+        yield state
+        tmp_path = join(pool_dir, "pool.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, join(pool_dir, "pool.json"))
+
+
+def init_pool(pool_dir, cores, mem_mb):
+    if not os.path.exists(pool_dir):
+        os.makedirs(pool_dir)
+    with open(join(pool_dir, "pool.json"), "w") as f:
+        json.dump({"cores": cores, "mem_mb": mem_mb, "running": {}, "waiting": {}}, f)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def drop_dead_jobs(state):
+    for jobs in (state["running"], state["waiting"]):
+        for token in [token for (token, job) in jobs.items() if not _is_alive(job["pid"])]:
+            del jobs[token]
+
+
+def may_start(state, token, now):
+    """
+    Whether the waiting job with the given token may start now.
+    """
+    free_cores = state["cores"] - sum(job["cores"] for job in state["running"].values())
+    free_mem_mb = state["mem_mb"] - sum(job["mem_mb"] for job in state["running"].values())
+    held_cores = {}
+    for job in state["running"].values():
+        held_cores[job["patient"]] = held_cores.get(job["patient"], 0) + job["cores"]
+    waiting = sorted(
+        state["waiting"].items(),
+        key=lambda item: (held_cores.get(item[1]["patient"], 0), item[1]["since"]))
+    for waiting_token, job in waiting:
+        if job["cores"] <= free_cores and job["mem_mb"] <= free_mem_mb:
+            if waiting_token == token:
+                return True
+            # leave room for the jobs ahead of this one, which will start when they next look
+            free_cores -= job["cores"]
+            free_mem_mb -= job["mem_mb"]
+        elif now - job["since"] > STARVATION_SECONDS:
+            return False
+    return False
+
+
+def read_job_properties(jobscript):
+    """
+    The job properties Snakemake writes into the job script's "# properties = {...}" line.
+    """
+    with open(jobscript) as f:
+        for line in f:
+            if line.startswith("# properties = "):
+                return json.loads(line[len("# properties = "):])
+    return {}
+
+
+def run_job(pool_dir, patient, jobscript):
+    """
+    Wait for the job's turn and resources, run it, and give them back. Returns the job script's
+    exit code.
+    """
+    properties = read_job_properties(jobscript)
+    token = str(os.getpid())
+    try:
+        with locked_state(pool_dir) as state:
+            state["waiting"][token] = {
+                "patient": patient,
+                "pid": os.getpid(),
+                "rule": properties.get("rule"),
+                # a job can't ask for more than the whole pool
+                "cores": min(properties.get("threads", 1), state["cores"]),
+                "mem_mb": min(properties.get("resources", {}).get("mem_mb", 0), state["mem_mb"]),
+                "since": time.time(),
+            }
+        while True:
+            with locked_state(pool_dir) as state:
+                drop_dead_jobs(state)
+                if may_start(state, token, time.time()):
+                    state["running"][token] = state["waiting"].pop(token)
+                    break
+            time.sleep(POLL_SECONDS)
+        return subprocess.call([jobscript])
+    finally:
+        with locked_state(pool_dir) as state:
+            state["running"].pop(token, None)
+            state["waiting"].pop(token, None)
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    if args.command == "init":
+        init_pool(args.pool_dir, args.cores, args.mem_mb)
+    elif args.command == "run":
+        sys.exit(run_job(args.pool_dir, args.patient, args.jobscript))
+    else:
+        parser.error("Expected a command: init or run")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Split an RNA BAM file into its spliced reads (with an N in the CIGAR string) and all the others.
+
+The input is read once and both outputs are written as it goes, so they keep the input's
+coordinate order and are indexed straight away, without sorting.
+"""
+
+from argparse import ArgumentParser
+
+import pysam
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--input",
+    required=True,
+    help="Coordinate-sorted RNA BAM file")
+
+parser.add_argument(
+    "--spliced-output",
+    required=True,
+    help="BAM file to write the reads with an N in their CIGAR string to")
+
+parser.add_argument(
+    "--unspliced-output",
+    required=True,
+    help="BAM file to write all the other reads to (including unmapped ones)")
+
+parser.add_argument(
+    "--compression-level",
+    type=int,
+    default=None,
+    help="BGZF compression level of the outputs; htslib's default if not given")
+
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=1,
+    help="Threads for BGZF decompression and compression")
+
+
+def split_by_cigar(
+        input_path, spliced_path, unspliced_path, compression_level=None, threads=1):
+    """
+    Write the spliced and unspliced reads of a BAM file to their own BAM files, and index them.
+
+    Parameters:
+    input_path (str): Coordinate-sorted BAM file.
+    spliced_path (str): BAM file for the reads with an N (skipped region) in their CIGAR string.
+    unspliced_path (str): BAM file for all the other reads.
+    compression_level (int): BGZF compression level of the outputs, or None for the default.
+    threads (int): Threads for BGZF decompression and compression, shared between the files.
+
+    Returns:
+    tuple: (number of spliced reads, number of unspliced reads)
+    """
+    format_options = [] if compression_level is None else [b"level=%d" % compression_level]
+    # the input is decompressed by one set of threads, and each output compressed by another
+    io_threads = max(1, threads // 3)
+    num_spliced = num_unspliced = 0
+    with pysam.AlignmentFile(input_path, "rb", threads=io_threads) as bam, \
+            pysam.AlignmentFile(
+                spliced_path, "wb", template=bam, threads=io_threads,
+                format_options=format_options) as spliced, \
+            pysam.AlignmentFile(
+                unspliced_path, "wb", template=bam, threads=io_threads,
+                format_options=format_options) as unspliced:
+        for read in bam.fetch(until_eof=True):
+            if "N" in (read.cigarstring or ""):
+                spliced.write(read)
+                num_spliced += 1
+            else:
+                unspliced.write(read)
+                num_unspliced += 1
+    pysam.index(spliced_path)
+    pysam.index(unspliced_path)
+    return num_spliced, num_unspliced
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    num_spliced, num_unspliced = split_by_cigar(
+        args.input,
+        args.spliced_output,
+        args.unspliced_output,
+        compression_level=args.compression_level,
+        threads=args.threads)
+    print("Wrote %d spliced reads to %s" % (num_spliced, args.spliced_output))
+    print("Wrote %d unspliced reads to %s" % (num_unspliced, args.unspliced_output))
+
+
+if __name__ == "__main__":
+    main()
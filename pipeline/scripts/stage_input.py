@@ -0,0 +1,211 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stage a pipeline input file into the working directory.
+
+Local files are hardlinked if the working directory is on the same file system, and symlinked
+otherwise, so nothing is copied. Remote files (gs://bucket/path) are downloaded with several
+ranged reads in parallel, each written straight to its offset in the destination file.
+
+Staged files are checked against the source size, and remote downloads also against the MD5
+the store reports, if it has one. With --remote-store-dir, remote URLs are read from a local
+directory instead (gs://bucket/path is read from <dir>/bucket/path), which stands in for the
+remote store in tests.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import errno
+import hashlib
+import os
+from os.path import abspath, dirname, exists, getsize, join
+import re
+import subprocess
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--source",
+    required=True,
+    help="Local path or remote URL of the input")
+
+parser.add_argument(
+    "--dest",
+    required=True,
+    help="Path to stage the input to")
+
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=8,
+    help="Number of ranged reads to run in parallel for remote inputs")
+
+parser.add_argument(
+    "--chunk-size-mb",
+    type=int,
+    default=256,
+    help="Size of each ranged read of a remote input")
+
+parser.add_argument(
+    "--remote-store-dir",
+    default="",
+    help="Local directory to read remote URLs from, instead of the remote store")
+
+
+REMOTE_URL_PATTERN = re.compile(r"^(?P<scheme>[a-z0-9]+)://(?P<path>.+)$")
+
+
+def is_remote(source):
+    return REMOTE_URL_PATTERN.match(source) is not None
+
+
+class GsutilStore(object):
+    """
+    Google Cloud Storage objects, read with gsutil.
+    """
+    def stat(self, url):
+        """
+        Returns:
+        tuple: (size in bytes, base64-encoded MD5 or None if the object doesn't have one, which is
+            the case for composite objects)
+        """
+        output = subprocess.check_output(["gsutil", "stat", url]).decode()
+        size = int(re.search(r"Content-Length:\s+(\d+)", output).group(1))
+        md5 = re.search(r"Hash \(md5\):\s+(\S+)", output)
+        return size, md5.group(1) if md5 else None
+
+    def read_range(self, url, start, end):
+        """
+        Bytes [start, end) of the object.
+        """
+        return subprocess.check_output(
+            ["gsutil", "-q", "cat", "-r", "%d-%d" % (start, end - 1), url])
+
+
+class LocalDirectoryStore(object):
+    """
+    Stand-in for a remote store, which reads scheme://path from <directory>/path.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def local_path(self, url):
+        return join(self.directory, REMOTE_URL_PATTERN.match(url).group("path"))
+
+    def stat(self, url):
+        with open(self.local_path(url), "rb") as f:
+            md5 = base64.b64encode(file_md5(f)).decode()
+        return getsize(self.local_path(url)), md5
+
+    def read_range(self, url, start, end):
+        with open(self.local_path(url), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+def file_md5(f, block_size=16 * 1024 * 1024):
+    md5 = hashlib.md5()
+    for block in iter(lambda: f.read(block_size), b""):
+        md5.update(block)
+    return md5.digest()
+
+
+def link_local_input(source, dest):
+    """
+    Hardlink the source to the destination, or symlink it if they are on different file systems
+    (or hardlinks aren't allowed).
+
+    Returns:
+    str: "hardlink" or "symlink".
+    """
+    try:
+        os.link(source, dest)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    os.symlink(abspath(source), dest)
+    return "symlink"
+
+
+def download_remote_input(store, url, dest, threads, chunk_size):
+    """
+    Download a remote object with parallel ranged reads and check it against its size and MD5.
+    """
+    size, expected_md5 = store.stat(url)
+    ranges = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+    with open(dest, "wb") as f:
+        f.truncate(size)
+
+    def fetch(byte_range):
+        start, end = byte_range
+        data = store.read_range(url, start, end)
+        if len(data) != end - start:
+            raise IOError("Expected %d bytes of %s at offset %d, got %d" % (
+                end - start, url, start, len(data)))
+        with open(dest, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # list() re-raises any exception from the ranged reads
+        list(executor.map(fetch, ranges))
+
+    if getsize(dest) != size:
+        raise IOError("Staged %s has %d bytes, expected %d" % (dest, getsize(dest), size))
+    if expected_md5 is not None:
+        with open(dest, "rb") as f:
+            md5 = base64.b64encode(file_md5(f)).decode()
+        if md5 != expected_md5:
+            raise IOError("MD5 of staged %s is %s, expected %s" % (dest, md5, expected_md5))
+
+
+def stage_input(source, dest, threads=8, chunk_size=256 * 1024 * 1024, remote_store_dir=""):
+    """
+    Stage a local or remote input to `dest`. On failure, any partial destination file is removed.
+
+    Returns:
+    str: How the input was staged: "hardlink", "symlink" or "download".
+    """
+    if exists(dest) or os.path.islink(dest):
+        os.remove(dest)
+    if dirname(dest):
+        os.makedirs(dirname(dest), exist_ok=True)
+    try:
+        if is_remote(source):
+            store = LocalDirectoryStore(remote_store_dir) if remote_store_dir else GsutilStore()
+            download_remote_input(store, source, dest, threads, chunk_size)
+            return "download"
+        method = link_local_input(source, dest)
+        if getsize(dest) != getsize(source):
+            raise IOError("Staged %s has a different size from %s" % (dest, source))
+        return method
+    except BaseException:
+        if exists(dest) or os.path.islink(dest):
+            os.remove(dest)
+        raise
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    method = stage_input(
+        args.source, args.dest, args.threads, args.chunk_size_mb * 1024 * 1024,
+        args.remote_store_dir)
+    print("Staged %s to %s (%s)" % (args.source, args.dest, method))
+
+
+if __name__ == "__main__":
+    main()
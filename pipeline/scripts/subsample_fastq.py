@@ -0,0 +1,140 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Take a sample of the first reads (or read pairs) of a fragment's gzipped FASTQ files, and estimate
+how many reads the whole fragment has.
+
+Only the sample is decompressed, so this takes seconds however deep the fragment is. The total
+number of reads is estimated from the size of the compressed files and the compressed bytes per
+read of the sample, so that metrics measured on the sample can be projected to the full
+fragment; it is exact if the fragment has no more reads than the sample. The R1 and R2 files of a
+read pair are read in step and their sampled reads written interleaved, for bwa mem -p.
+
+The first reads of a run all come from the first tiles of the flow cell, which is as good as a
+random sample of the library's molecules, but over-represents optical duplicates somewhat.
+"""
+
+from argparse import ArgumentParser
+import gzip
+import json
+import os
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--inputs",
+    nargs="+",
+    required=True,
+    help="Gzipped FASTQ file, or the R1 and R2 files of a read pair")
+
+parser.add_argument(
+    "--output",
+    required=True,
+    help="Gzipped FASTQ file to write the sampled reads to (interleaved for read pairs)")
+
+parser.add_argument(
+    "--counts-output",
+    required=True,
+    help="JSON file to write the (estimated) number of reads in the input and in the sample to")
+
+parser.add_argument(
+    "--num-reads",
+    type=int,
+    default=200000,
+    help="Number of reads (or read pairs) to sample")
+
+
+def read_records(f, path):
+    while True:
+        record = [f.readline() for _ in range(4)]
+        if not record[0]:
+            return
+        if not record[3] or not record[0].startswith(b"@"):
+            raise ValueError("Truncated or malformed FASTQ record in %s" % path)
+        yield b"".join(record)
+
+
+def next_records(records, input_paths, num_read):
+    """
+    The next record of each input file, or None if they have all ended.
+    """
+    record = [next(file_records, None) for file_records in records]
+    if all(part is None for part in record):
+        return None
+    if any(part is None for part in record):
+        raise ValueError("Truncated FASTQ input: after %d reads, %s ended but %s did not" % (
+            num_read,
+            " and ".join(path for (path, part) in zip(input_paths, record) if part is None),
+            " and ".join(path for (path, part) in zip(input_paths, record) if part is not None)))
+    return record
+
+
+def subsample_fastq(input_paths, output_path, num_reads):
+    """
+    Write the first num_reads reads (or all of them, if there are fewer), and estimate the number
+    of reads in the input.
+
+    Parameters:
+    input_paths (list of str): Gzipped FASTQ file, or the R1 and R2 files of a read pair.
+    output_path (str): Gzipped FASTQ file of the sampled reads, interleaved for read pairs.
+    num_reads (int): Number of reads or read pairs to sample.
+
+    Returns:
+    tuple: (number of reads or read pairs in the input, number sampled, whether the first is an
+        estimate)
+    """
+    inputs = [open(path, "rb") for path in input_paths]
+    try:
+        records = [
+            read_records(gzip.GzipFile(fileobj=f), path) for (f, path) in zip(inputs, input_paths)]
+        sampled = 0
+        with gzip.open(output_path, "wb", compresslevel=1) as output:
+            while sampled < num_reads:
+                record = next_records(records, input_paths, sampled)
+                if record is None:
+                    return sampled, sampled, False
+                output.write(b"".join(record))
+                sampled += 1
+        # one more record, to tell whether the sample is all of the input
+        if next_records(records, input_paths, sampled) is None:
+            return sampled, sampled, False
+        # compressed bytes read so far, which includes gzip's read-ahead of a few KB
+        sampled_bytes = sum(f.tell() for f in inputs)
+    finally:
+        for f in inputs:
+            f.close()
+    total_bytes = sum(os.path.getsize(path) for path in input_paths)
+    return max(sampled + 1, int(round(sampled * total_bytes / sampled_bytes))), sampled, True
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    if len(args.inputs) > 2:
+        parser.error("Expected a FASTQ file or the two files of a read pair")
+    total, sampled, estimated = subsample_fastq(args.inputs, args.output, args.num_reads)
+    with open(args.counts_output, "w") as f:
+        json.dump({
+            "total_reads": total,
+            "sampled_reads": sampled,
+            "total_reads_estimated": estimated,
+            "paired": len(args.inputs) == 2,
+        }, f, indent=2)
+    print("Sampled %d of %s%d %s" % (
+        sampled, "about " if estimated else "", total,
+        "read pairs" if len(args.inputs) == 2 else "reads"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build padded capture kit target intervals, to restrict GATK, MuTect and Strelka to.
+
+The BED file's targets are padded on both sides, clipped to the contig ends, merged and renamed
+to the reference's contig names. They are written as:
+- <output-prefix>.intervals: GATK interval list (contig:start-end, 1-based and inclusive).
+- <output-prefix>.bed.gz and <output-prefix>.bed.gz.tbi: bgzipped, tabix-indexed BED, as Strelka's
+  --callRegions wants it.
+
+With --scatter-intervals, the targets are also intersected with each of the given interval lists
+(a contig name, or a file of intervals as written by interval_shards.py), and written to
+<scatter-output-dir>/<name>.intervals, for the jobs scattered over those intervals. If a job's
+intervals don't overlap any target, its file is empty, and the pipeline skips the job's GATK and
+MuTect runs (GATK refuses an empty interval list).
+"""
+
+from argparse import ArgumentParser
+import os
+from os.path import basename, exists, join
+
+import pysam
+
+from contigs import ContigIndex
+from interval_shards import read_bed_targets, read_fai_lengths
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+
+parser.add_argument(
+    "--bed",
+    required=True,
+    help="Capture kit BED file")
+
+parser.add_argument(
+    "--fai",
+    required=True,
+    help="samtools .fai index of the reference")
+
+parser.add_argument(
+    "--padding",
+    type=int,
+    default=100,
+    help="Number of bases to pad each target by on both sides")
+
+parser.add_argument(
+    "--output-prefix",
+    required=True)
+
+parser.add_argument(
+    "--scatter-intervals",
+    nargs="*",
+    default=[],
+    help="Contig names or interval list files of the scattered jobs")
+
+parser.add_argument(
+    "--scatter-output-dir",
+    default="")
+
+
+def pad_targets(targets, lengths, padding):
+    """
+    Pad, clip and merge targets, given as a dict of contig -> sorted list of (start, end).
+    """
+    padded = {}
+    for contig, intervals in targets.items():
+        padded[contig] = []
+        for start, end in intervals:
+            start, end = max(0, start - padding), min(lengths[contig], end + padding)
+            if padded[contig] and start <= padded[contig][-1][1]:
+                padded[contig][-1] = (padded[contig][-1][0], max(end, padded[contig][-1][1]))
+            else:
+                padded[contig].append((start, end))
+    return padded
+
+
+def read_interval_list(path_or_contig, lengths, contig_index):
+    """
+    Intervals as (contig, start, end) tuples (0-based, half-open) from a GATK interval list file,
+    or the whole contig if given a contig name.
+    """
+    if not exists(path_or_contig):
+        contig = contig_index[path_or_contig]
+        return [(contig, 0, lengths[contig])]
+    intervals = []
+    with open(path_or_contig) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            contig, _, interval = line.rpartition(":")
+            if contig and contig_index.get(contig) is not None and "-" in interval:
+                start, end = interval.split("-")
+                intervals.append((contig_index[contig], int(start) - 1, int(end)))
+            else:
+                contig = contig_index[line]
+                intervals.append((contig, 0, lengths[contig]))
+    return intervals
+
+
+def intersect(intervals, targets):
+    """
+    Intersection of (contig, start, end) intervals with the per-contig targets.
+    """
+    result = []
+    for contig, start, end in intervals:
+        for target_start, target_end in targets.get(contig, []):
+            if target_start < end and target_end > start:
+                result.append((contig, max(start, target_start), min(end, target_end)))
+    return result
+
+
+def write_interval_list(path, intervals):
+    with open(path, "w") as f:
+        for contig, start, end in intervals:
+            f.write("%s:%d-%d\n" % (contig, start + 1, end))
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    lengths = read_fai_lengths(args.fai)
+    contig_index = ContigIndex(list(lengths))
+    targets = pad_targets(read_bed_targets(args.bed, contig_index), lengths, args.padding)
+    # in reference order
+    intervals = [
+        (contig, start, end)
+        for contig in contig_index.contigs
+        for (start, end) in targets.get(contig, [])
+    ]
+    print("%d padded target intervals, %d bases" % (
+        len(intervals), sum(end - start for (_, start, end) in intervals)))
+
+    write_interval_list(args.output_prefix + ".intervals", intervals)
+    bed = args.output_prefix + ".bed"
+    with open(bed, "w") as f:
+        for contig, start, end in intervals:
+            f.write("%s\t%d\t%d\n" % (contig, start, end))
+    pysam.tabix_index(bed, preset="bed", force=True)
+
+    if args.scatter_intervals:
+        os.makedirs(args.scatter_output_dir, exist_ok=True)
+    for scatter_intervals in args.scatter_intervals:
+        name = basename(scatter_intervals)
+        if name.endswith(".intervals"):
+            name = name[:-len(".intervals")]
+        job_intervals = read_interval_list(scatter_intervals, lengths, contig_index)
+        restricted = intersect(job_intervals, targets)
+        if not restricted:
+            print("No targets in %s, its jobs will be skipped" % name)
+        write_interval_list(join(args.scatter_output_dir, name + ".intervals"), restricted)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,15 +17,25 @@ from argparse import ArgumentParser
 import datetime
 import logging
 
+import os
 from os import access, R_OK, W_OK
-from os.path import dirname, isfile, join, basename, splitext, exists
+from os.path import abspath, dirname, isfile, join, basename, splitext, exists
 import psutil
+import shlex
+import shutil
+import subprocess
 import sys
 import tempfile
 
 import snakemake
 import yaml
 
+PIPELINE_DIR = join(dirname(abspath(__file__)), "pipeline")
+SCRIPTS_DIR = join(PIPELINE_DIR, "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+from reference_bundle import ReferenceBundle
+from shared_pool import init_pool
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -59,6 +69,13 @@ parser.add_argument(
     help="If this argument is present, Snakemake will do a dry run of the pipeline",
     action="store_true")
 
+parser.add_argument(
+    "--reference-cache-dir",
+    default="",
+    help="Directory of processed reference bundles shared between hosts: reference processing "
+        "imports a bundle from it if there's one for the reference inputs, and adds its own "
+        "otherwise")
+
 targets_group = parser.add_argument_group("Target arguments")
 
 targets_group.add_argument(
@@ -85,6 +102,29 @@ qc_group.add_argument(
     help="If this argument is present, will run several QC metrics",
     action="store_true")
 
+qc_group.add_argument(
+    "--performance-report",
+    help="If this argument is present, will write a report of where the run time went "
+        "(performance_report.json and .html in the output directory)",
+    action="store_true")
+
+batch_group = parser.add_argument_group("Batch mode: several patients sharing one reference")
+
+batch_group.add_argument(
+    "--batch",
+    nargs="+",
+    default=[],
+    metavar="CONFIGFILE",
+    help="Run the pipeline for each of these patient config files instead of --configfile. The "
+        "reference is processed once, and all the patients' jobs share one pool of --cores and "
+        "--memory, with fair-share turns. Each run's log is written to run_snakemake.log in the "
+        "patient's output directory")
+
+batch_group.add_argument(
+    "--shared-pool-dir",
+    default="",
+    help="Run this patient's jobs in the shared pool of a batch (set by --batch for each run)")
+
 overrides_group = parser.add_argument_group("Dockerless runs: directory override options")
 
 # TODO(julia): make sure that if any of these is specified, all the others are too
@@ -117,6 +157,11 @@ def get_reference_genome_dir(config):
 ######################################################################################
 
 
+# Remote inputs (e.g. gs://bucket/sample.fastq.gz) are checked when they're staged.
+def is_remote_input(path):
+    return "://" in path
+
+
 def validate_config(config):
     """
     Check that the paths specified in the config exist and are readable.
@@ -129,11 +174,11 @@ def validate_config(config):
             if fragment["type"] == "paired-end":
                 for read_num in ["r1", "r2"]:
                     r = fragment[read_num]
-                    if not (isfile(r) and access(r, R_OK)):
+                    if not (is_remote_input(r) or (isfile(r) and access(r, R_OK))):
                         raise ValueError("File %s does not exist or is unreadable" % r)
             elif fragment["type"] == "single-end":
                 r = fragment["r"]
-                if not (isfile(r) and access(r, R_OK)):
+                if not (is_remote_input(r) or (isfile(r) and access(r, R_OK))):
                     raise ValueError("File %s does not exist or is unreadable" % r)
             else:
                 raise ValueError("Unsupported fragment type: %s" % fragment["type"])
@@ -275,10 +320,21 @@ def run_neoantigen_pipeline(args, parsed_config, configfile):
 
     config_extension = make_config_extension_dict(args, parsed_config)
 
+    # in a batch, the jobs wait for their turn in the pool shared with the other patients
+    cluster_args = {}
+    if args.shared_pool_dir:
+        cluster_args = {
+            'cluster_sync': " ".join(shlex.quote(arg) for arg in [
+                sys.executable, join(SCRIPTS_DIR, "shared_pool.py"), "run",
+                "--pool-dir", args.shared_pool_dir,
+                "--patient", parsed_config["input"]["id"]]),
+            'nodes': args.cores,
+        }
+
     logger.info("Running neoantigen pipeline with targets %s " % targets)
     start_time = datetime.datetime.now()
     if not snakemake.snakemake(
-            'pipeline/Snakefile',
+            join(PIPELINE_DIR, 'Snakefile'),
             cores=args.cores,
             resources={'mem_mb': int(1024 * args.memory)},
             config=config_extension,
@@ -287,7 +343,8 @@ def run_neoantigen_pipeline(args, parsed_config, configfile):
             dryrun=args.dry_run,
             targets=targets,
             workdir=parsed_config["workdir"],
-            stats=stats_file):
+            stats=stats_file,
+            **cluster_args):
         raise ValueError("Pipeline failed, see Snakemake error message for details")
 
     end_time = datetime.datetime.now()
@@ -303,13 +360,26 @@ def process_reference(args, parsed_config, configfile):
     # only run targets in the reference directory (exclude output processing)
     targets = [
         x for x in get_and_check_targets(args, parsed_config) if x.startswith(reference_genome_dir)]
-    if not targets:
+    bundle = ReferenceBundle.from_config(parsed_config, threads=args.cores)
+    whole_reference = not targets
+    if whole_reference:
+        if bundle.matches_manifest():
+            logger.info("Reference files match %s, skipping reference processing" % (
+                bundle.manifest_path))
+            return
+        if args.reference_cache_dir and not args.dry_run and bundle.import_from_cache(
+                args.reference_cache_dir):
+            logger.info("Imported processed reference files from %s" % args.reference_cache_dir)
+            return
         targets = [parsed_config["reference"]["genome"] + '.done']
+    # stage the inputs in the same run, so that they're copied while the reference is processed
+    if not args.process_reference_only:
+        targets.append('stage_inputs')
     logger.info("Processing reference with targets: %s" % targets)
 
     start_time = datetime.datetime.now()
     if not snakemake.snakemake(
-            'pipeline/reference_Snakefile',
+            join(PIPELINE_DIR, 'reference_Snakefile'),
             cores=args.cores,
             resources={'mem_mb': int(1024 * args.memory)},
             config={'num_threads': args.cores, 'mem_gb': args.memory},
@@ -323,14 +393,38 @@ def process_reference(args, parsed_config, configfile):
     end_time = datetime.datetime.now()
     logger.info("--- Reference processing time: %s ---" % (str(end_time - start_time)))
 
+    if whole_reference and not args.dry_run:
+        manifest = bundle.write_manifest()
+        if manifest is not None and args.reference_cache_dir:
+            logger.info("Adding processed reference files to %s" % args.reference_cache_dir)
+            bundle.export_to_cache(args.reference_cache_dir, manifest)
 
-def main(args_list=None):
-    if args_list is None:
-        args_list = sys.argv[1:]
-    args = parser.parse_args(args_list)
-    logger.info(args)
 
-    with open(args.configfile) as configfile:
+# Joins the job graphs, benchmarks and Snakemake stats of the reference processing and main
+# pipeline runs into a performance report in the output directory.
+def write_performance_report(parsed_config):
+    output_dir = get_output_dir(parsed_config)
+    job_graphs = [
+        join(output_dir, name) for name in ["jobs_reference_Snakefile.json", "jobs_Snakefile.json"]
+        if exists(join(output_dir, name))]
+    stats_files = [
+        path for path in [
+            join(get_reference_genome_dir(parsed_config), "stats.json"),
+            join(output_dir, "stats.json")]
+        if exists(path)]
+    if not job_graphs:
+        logger.info("No job graphs in %s, not writing a performance report" % output_dir)
+        return
+    subprocess.check_call(
+        [sys.executable, join(SCRIPTS_DIR, "performance_report.py"), "--job-graph"] + job_graphs +
+        ["--stats"] + stats_files +
+        ["--output-prefix", join(output_dir, "performance_report")])
+
+
+# Returns the contents of a config file, with paths replaced for a Dockerless run if necessary,
+# and the parsed config.
+def read_config(args, configfile_path):
+    with open(configfile_path) as configfile:
         configfile_contents = configfile.read()
 
     # if necessary, replace paths in the configfile contents
@@ -344,15 +438,92 @@ def main(args_list=None):
             '/outputs', args.outputs).replace(
             '/reference-genome', args.reference_genome).replace(
             '/inputs', args.inputs)
-
-    parsed_config = yaml.safe_load(configfile_contents)
-    validate_config(parsed_config)
-
+    return configfile_contents, yaml.safe_load(configfile_contents)
+
+
+# Runs the pipeline for several patients that share a reference: processes the reference once,
+# then runs each patient's pipeline in its own process, all of them scheduling their jobs in one
+# shared pool of cores and memory.
+def run_batch(args):
+    if args.configfile or args.target is not None:
+        raise ValueError("In batch mode, cannot specify --configfile or targets")
+    configs = []
+    for configfile_path in args.batch:
+        configfile_contents, parsed_config = read_config(args, configfile_path)
+        validate_config(parsed_config)
+        configs.append((configfile_path, configfile_contents, parsed_config))
+    output_dirs = [get_output_dir(parsed_config) for (_, _, parsed_config) in configs]
+    if len(set(output_dirs)) != len(output_dirs):
+        raise ValueError("Patients in a batch must have different output directories")
+    if len(set(parsed_config["reference"]["genome"] for (_, _, parsed_config) in configs)) > 1:
+        raise ValueError("Patients in a batch must share the same reference genome")
+
+    _, configfile_contents, parsed_config = configs[0]
     with tempfile.NamedTemporaryFile(mode='w') as config_tmpfile:
         config_tmpfile.write(configfile_contents)
         logger.info("Processing reference, if necessary...")
         process_reference(args, parsed_config, config_tmpfile)
         logger.info("Reference processing done.")
+    if args.process_reference_only:
+        return
+
+    # the runs are started from the pipeline directory, so they're given absolute paths
+    pool_dir = abspath(tempfile.mkdtemp(prefix="shared_pool_", dir=parsed_config["workdir"]))
+    init_pool(pool_dir, args.cores, int(1024 * args.memory))
+    passed_args = ["--cores", str(args.cores), "--memory", str(args.memory),
+                   "--shared-pool-dir", pool_dir]
+    for flag in ["dry_run", "somatic_variant_calling_only", "run_qc", "performance_report"]:
+        if getattr(args, flag):
+            passed_args.append("--" + flag.replace("_", "-"))
+    for option in ["inputs", "outputs", "reference_genome"]:
+        if getattr(args, option):
+            passed_args.extend(["--" + option.replace("_", "-"), abspath(getattr(args, option))])
+
+    runs = []
+    try:
+        for (configfile_path, _, parsed_config), output_dir in zip(configs, output_dirs):
+            if not exists(output_dir):
+                os.makedirs(output_dir)
+            log = open(join(output_dir, "run_snakemake.log"), "w")
+            logger.info("Running neoantigen pipeline for %s" % parsed_config["input"]["id"])
+            process = subprocess.Popen(
+                [sys.executable, abspath(__file__), "--configfile", abspath(configfile_path)] +
+                passed_args,
+                stdout=log, stderr=subprocess.STDOUT, cwd=dirname(abspath(__file__)))
+            runs.append((parsed_config["input"]["id"], process, log))
+        failed = [patient for (patient, process, _) in runs if process.wait() != 0]
+    finally:
+        for (_, process, log) in runs:
+            if process.poll() is None:
+                process.terminate()
+            log.close()
+        shutil.rmtree(pool_dir, ignore_errors=True)
+    if failed:
+        raise ValueError(
+            "Pipeline failed for %s, see run_snakemake.log in their output directories" % (
+                ", ".join(failed)))
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    logger.info(args)
+
+    if args.batch:
+        run_batch(args)
+        return
+
+    configfile_contents, parsed_config = read_config(args, args.configfile)
+    validate_config(parsed_config)
+
+    with tempfile.NamedTemporaryFile(mode='w') as config_tmpfile:
+        config_tmpfile.write(configfile_contents)
+        # in a batch, the reference has already been processed
+        if not args.shared_pool_dir:
+            logger.info("Processing reference, if necessary...")
+            process_reference(args, parsed_config, config_tmpfile)
+            logger.info("Reference processing done.")
         if args.process_reference_only:
             if args.target is not None:
                 raise ValueError("If requesting --process-reference-only, cannot specify targets")
@@ -360,6 +531,8 @@ def main(args_list=None):
             logger.info("Running main pipeline...")
             run_neoantigen_pipeline(args, parsed_config, config_tmpfile)
             logger.info('Main pipeline done.')
+        if args.performance_report and not args.dry_run:
+            write_performance_report(parsed_config)
 
     # sanity-check post-processing: print any contents of QC result file
     qc_contents_path = join(get_output_dir(parsed_config), "sequencing_qc_out.txt")
@@ -369,6 +542,13 @@ def main(args_list=None):
             if len(qc_out_contents) > 0:
                 print('Some sequencing checks failed!')
                 print(qc_out_contents)
+    preflight_qc_path = join(get_output_dir(parsed_config), "preflight_qc_out.txt")
+    if parsed_config.get("preflight_qc") and exists(preflight_qc_path):
+        with open(preflight_qc_path) as preflight_qc_file:
+            preflight_qc_contents = preflight_qc_file.read()
+            if len(preflight_qc_contents) > 0:
+                print('Some preflight sequencing checks failed!')
+                print(preflight_qc_contents)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,505 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark for pipeline/scripts/annotate_variants.py on synthetic data.
+
+For each depth, this generates a reference sequence with planted SNVs, MNVs, deletions and
+insertions, indexed tumor DNA and tumor RNA BAMs (a share of the RNA reads are spliced), Mutect-
+and Strelka-style VCFs and an all-passing-variants CSV like the one vaxrank writes. It then times
+annotate_from_bam and annotate_from_vcf for each variant class, each in a fresh process so that
+the peak RSS is that of the step alone, and reports variants/sec and peak RSS. If a baseline
+copy of annotate_variants.py is given, the same steps are run with it and the results compared.
+Calls that newer pandas versions removed are rewritten in both copies before they are run (see
+PANDAS_COMPAT_REWRITES), so that the pre-NumPy master version works as a baseline.
+
+Everything runs locally, without network access or reference data. Example, comparing against
+the master branch:
+
+    git show master:pipeline/scripts/annotate_variants.py > /tmp/baseline_annotate_variants.py
+    python test/benchmark_annotate_variants.py \
+        --depths 50 200 1000 \
+        --baseline /tmp/baseline_annotate_variants.py \
+        --output benchmark.json
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import inspect
+import json
+import multiprocessing
+import os
+from os.path import abspath, dirname, exists, join
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pysam
+
+SCRIPTS_DIR = join(dirname(dirname(abspath(__file__))), "pipeline", "scripts")
+
+VARIANT_CLASSES = ["snv", "mnv", "deletion", "insertion"]
+CONTIGS = ["1", "2"]
+# distance between planted variants, so that most reads only overlap a single one
+VARIANT_SPACING = 1000
+BASES = "ACGT"
+
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[1])
+
+parser.add_argument(
+    "--depths",
+    type=int,
+    nargs="+",
+    default=[50, 200, 1000],
+    help="Read depths to generate data for")
+
+parser.add_argument(
+    "--variants-per-class",
+    type=int,
+    default=50,
+    help="Number of variants of each class (SNV, MNV, deletion, insertion)")
+
+parser.add_argument(
+    "--read-length",
+    type=int,
+    default=100)
+
+parser.add_argument(
+    "--spliced-fraction",
+    type=float,
+    default=0.3,
+    help="Fraction of RNA reads with an intron")
+
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0)
+
+parser.add_argument(
+    "--workdir",
+    default="",
+    help="Directory for the generated data, reused across runs if it exists. Defaults to a "
+         "temporary directory")
+
+parser.add_argument(
+    "--script",
+    default=join(SCRIPTS_DIR, "annotate_variants.py"),
+    help="annotate_variants.py to benchmark")
+
+parser.add_argument(
+    "--baseline",
+    default="",
+    help="Another copy of annotate_variants.py to compare timings and results against")
+
+parser.add_argument(
+    "--bam-kwargs",
+    default="{}",
+    help="JSON dict of extra keyword arguments for annotate_from_bam, e.g. '{\"sweep\": true}'. "
+         "Arguments that a script doesn't accept are skipped")
+
+parser.add_argument(
+    "--output",
+    default="",
+    help="JSON file to write the results to")
+
+
+def random_sequence(rng, length):
+    return "".join(rng.choice(BASES) for _ in range(length))
+
+
+def plant_variants(rng, reference, num_per_class):
+    """
+    Pick variants of each class, spread evenly over the contigs.
+
+    Returns:
+    list of dicts: with contig, start, ref and alt in varcode's conventions (as in the
+        all-passing-variants CSV: start is the first changed base, or the base before an
+        insertion), and the class and VAF of each variant.
+    """
+    classes = [c for c in VARIANT_CLASSES for _ in range(num_per_class)]
+    rng.shuffle(classes)
+    variants = []
+    for (i, variant_class) in enumerate(classes):
+        contig = CONTIGS[i % len(CONTIGS)]
+        position = VARIANT_SPACING * (i // len(CONTIGS) + 1)  # 0-based
+        sequence = reference[contig]
+        if variant_class == "snv":
+            ref = sequence[position]
+            alt = rng.choice([b for b in BASES if b != ref])
+        elif variant_class == "mnv":
+            ref = sequence[position:position + 2]
+            alt = "".join(rng.choice([b for b in BASES if b != r]) for r in ref)
+        elif variant_class == "deletion":
+            ref = sequence[position:position + rng.randint(1, 6)]
+            alt = ""
+        else:
+            ref = ""
+            alt = random_sequence(rng, rng.randint(1, 6))
+        variants.append(dict(
+            contig=contig,
+            start=position + 1,
+            ref=ref,
+            alt=alt,
+            variant_class=variant_class,
+            vaf=rng.uniform(0.05, 0.6)))
+    return variants
+
+
+def make_read(rng, reference, variant, carries_alt, read_length, spliced):
+    """
+    A read overlapping the variant, which carries the alternate allele if `carries_alt`, as a
+    list of (cigar_op, length) operations and its sequence.
+
+    Returns:
+    tuple: (reference_start, cigartuples, sequence)
+    """
+    sequence = reference[variant["contig"]]
+    # 0-based position of the first changed base (or the base before an insertion)
+    position = variant["start"] - 1
+    offset = rng.randint(1, read_length - 2)
+    reference_start = max(0, position - offset)
+
+    # optional soft clip at the start, and intron at a random point of the read
+    soft_clip = rng.randint(1, 5) if rng.random() < 0.1 else 0
+    intron_at = rng.randint(soft_clip + 1, read_length - 2) if spliced else None
+    intron_length = rng.randint(50, 500)
+
+    ops = []
+    bases = []
+
+    def add(op, length, op_bases=""):
+        if ops and ops[-1][0] == op:
+            ops[-1] = (op, ops[-1][1] + length)
+        else:
+            ops.append((op, length))
+        bases.append(op_bases)
+
+    if soft_clip:
+        add(4, soft_clip, random_sequence(rng, soft_clip))
+    ref_pos = reference_start
+    num_bases = soft_clip
+    while num_bases < read_length and ref_pos < len(sequence):
+        if intron_at is not None and num_bases == intron_at:
+            add(3, intron_length)
+            ref_pos += intron_length
+            intron_at = None
+            continue
+        if carries_alt and ref_pos == position:
+            if variant["variant_class"] in ("snv", "mnv"):
+                alt = variant["alt"][:read_length - num_bases]
+                add(0, len(alt), alt)
+                ref_pos += len(alt)
+                num_bases += len(alt)
+                continue
+            if variant["variant_class"] == "deletion":
+                add(2, len(variant["ref"]))
+                ref_pos += len(variant["ref"])
+                continue
+        base = sequence[ref_pos]
+        if rng.random() < 0.002:
+            base = rng.choice(BASES)
+        add(0, 1, base)
+        num_bases += 1
+        if carries_alt and ref_pos == position and variant["variant_class"] == "insertion":
+            inserted = variant["alt"][:read_length - num_bases]
+            if inserted:
+                add(1, len(inserted), inserted)
+                num_bases += len(inserted)
+        ref_pos += 1
+
+    # alignments don't end with a deletion, skip or insertion
+    while ops and ops[-1][0] in (1, 2, 3):
+        op, _ = ops.pop()
+        if op == 1:
+            bases.pop()
+    return reference_start, ops, "".join(bases)
+
+
+def write_bam(path, reference, variants, depth, read_length, spliced_fraction, rng, label):
+    """
+    Write an indexed BAM with `depth` reads overlapping each variant.
+    """
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": contig, "LN": len(reference[contig])} for contig in CONTIGS],
+        "RG": [{"ID": label, "SM": label}],
+    }
+    reads = []
+    for (i, variant) in enumerate(variants):
+        for j in range(depth):
+            carries_alt = rng.random() < variant["vaf"]
+            spliced = rng.random() < spliced_fraction
+            reference_start, ops, sequence = make_read(
+                rng, reference, variant, carries_alt, read_length, spliced)
+            read = pysam.AlignedSegment()
+            read.query_name = f"{label}_{i}_{j}"
+            read.flag = 1024 if rng.random() < 0.03 else 0
+            read.reference_id = CONTIGS.index(variant["contig"])
+            read.reference_start = reference_start
+            read.mapping_quality = 0 if rng.random() < 0.05 else 60
+            read.cigartuples = ops
+            read.query_sequence = sequence
+            read.query_qualities = pysam.qualitystring_to_array("I" * len(sequence))
+            read.set_tag("RG", label)
+            reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    with pysam.AlignmentFile(path, "wb", header=header) as f:
+        for read in reads:
+            f.write(read)
+    pysam.index(path)
+
+
+def vcf_alleles(reference, variant):
+    """
+    VCF position and alleles of a variant, with an anchor base for indels.
+    """
+    position = variant["start"]  # 1-based
+    if variant["variant_class"] == "deletion":
+        anchor = reference[variant["contig"]][position - 2]
+        return position - 1, anchor + variant["ref"], anchor
+    if variant["variant_class"] == "insertion":
+        anchor = reference[variant["contig"]][position - 1]
+        return position, anchor, anchor + variant["alt"]
+    return position, variant["ref"], variant["alt"]
+
+
+def write_vcfs(workdir, reference, variants, depth, rng):
+    """
+    Write Mutect- and Strelka-style VCFs of the variants, with some failing records.
+
+    Returns:
+    dict: label -> VCF path.
+    """
+    header = (
+        "##fileformat=VCFv4.1\n" +
+        "".join(f"##contig=<ID={c},length={len(reference[c])}>\n" for c in CONTIGS) +
+        "##reference=GRCh37\n"
+        "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n"
+        "##FORMAT=<ID=AD,Number=.,Type=Integer,Description=\"Allelic depths\">\n"
+        "##FORMAT=<ID=BQ,Number=A,Type=Float,Description=\"Average base quality\">\n"
+        "##FORMAT=<ID=DP,Number=1,Type=Integer,Description=\"Read depth\">\n"
+        "##FORMAT=<ID=FA,Number=A,Type=Float,Description=\"Allele fraction\">\n"
+        "##FORMAT=<ID=FDP,Number=1,Type=Integer,Description=\"Filtered reads\">\n"
+        "##FORMAT=<ID=SDP,Number=1,Type=Integer,Description=\"Spanning deletions\">\n"
+        "##FORMAT=<ID=SUBDP,Number=1,Type=Integer,Description=\"Sub-threshold reads\">\n")
+    formats = {
+        "mutect": (
+            "GT:AD:BQ:DP:FA",
+            lambda ref_count, alt_count: "0/1:%d,%d:30:%d:%.3f" % (
+                ref_count, alt_count, ref_count + alt_count,
+                alt_count / max(1, ref_count + alt_count))),
+        "strelka": (
+            "DP:FDP:SDP:SUBDP",
+            lambda ref_count, alt_count: "%d:0:0:0" % (ref_count + alt_count)),
+    }
+    paths = {}
+    for (label, (format_keys, sample)) in formats.items():
+        path = join(workdir, f"{label}.vcf")
+        with open(path, "w") as f:
+            f.write(header)
+            f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tTUMOR\n")
+            for variant in variants:
+                position, ref, alt = vcf_alleles(reference, variant)
+                alt_count = int(depth * variant["vaf"])
+                vcf_filter = "PASS" if rng.random() < 0.9 else "germline_risk"
+                f.write("\t".join([
+                    variant["contig"], str(position), ".", ref, alt, ".", vcf_filter, ".",
+                    format_keys, sample(depth, 0), sample(depth - alt_count, alt_count),
+                ]) + "\n")
+        paths[label] = path
+    return paths
+
+
+def generate_dataset(workdir, depth, args):
+    """
+    Generate (or reuse) the data for one depth.
+
+    Returns:
+    dict: Paths of the variants CSV, BAMs and VCFs.
+    """
+    dataset = {
+        "variants": join(workdir, "all-passing-variants.csv"),
+        "bams": {
+            "tumor_dna": join(workdir, "tumor.bam"),
+            "tumor_rna": join(workdir, "rna.bam"),
+        },
+        "vcfs": {
+            "mutect": join(workdir, "mutect.vcf"),
+            "strelka": join(workdir, "strelka.vcf"),
+        },
+    }
+    if exists(join(workdir, "done")):
+        return dataset
+    os.makedirs(workdir, exist_ok=True)
+
+    rng = random.Random(args.seed)
+    contig_length = VARIANT_SPACING * (
+        len(VARIANT_CLASSES) * args.variants_per_class // len(CONTIGS) + 2)
+    reference = {contig: random_sequence(rng, contig_length) for contig in CONTIGS}
+    variants = plant_variants(rng, reference, args.variants_per_class)
+
+    print(f"Generating {depth}X data in {workdir}")
+    write_bam(dataset["bams"]["tumor_dna"], reference, variants, depth, args.read_length,
+        0, rng, "tumor_dna")
+    write_bam(dataset["bams"]["tumor_rna"], reference, variants, depth, args.read_length,
+        args.spliced_fraction, rng, "tumor_rna")
+    write_vcfs(workdir, reference, variants, depth, rng)
+    pd.DataFrame([
+        dict(contig=v["contig"], start=v["start"], ref=v["ref"], alt=v["alt"],
+            gene_name=f"GENE{i}", variant_class=v["variant_class"])
+        for (i, v) in enumerate(variants)
+    ]).to_csv(dataset["variants"], index=False)
+    open(join(workdir, "done"), "w").close()
+    return dataset
+
+
+# Rewrites that let older copies of annotate_variants.py run under current pandas, where
+# fillna(method=...) is deprecated (2.1) or gone (3.0).
+PANDAS_COMPAT_REWRITES = [
+    ('.fillna(method="ffill")', '.ffill()'),
+    ('.fillna(method="bfill")', '.bfill()'),
+]
+
+
+def load_script(path):
+    """
+    Import a copy of annotate_variants.py, after applying PANDAS_COMPAT_REWRITES to it.
+    """
+    sys.path.insert(0, SCRIPTS_DIR)
+    with open(path) as f:
+        source = f.read()
+    for (old, new) in PANDAS_COMPAT_REWRITES:
+        source = source.replace(old, new)
+    spec = importlib.util.spec_from_loader("annotate_variants_under_test", loader=None)
+    module = importlib.util.module_from_spec(spec)
+    module.__file__ = path
+    exec(compile(source, path, "exec"), module.__dict__)
+    return module
+
+
+def read_variants(variants_file, variant_class):
+    # same preprocessing as annotate_variants.main
+    variants_df = pd.read_csv(variants_file)
+    variants_df = variants_df[variants_df.variant_class == variant_class].reset_index(drop=True)
+    variants_df["contig"] = variants_df["contig"].astype(str)
+    variants_df["ref"] = variants_df["ref"].fillna("").astype(str)
+    variants_df["alt"] = variants_df["alt"].fillna("").astype(str)
+    variants_df["gene_name"] = variants_df["gene_name"].fillna("").astype(str)
+    variants_df["unmangled_contig"] = None
+    return variants_df
+
+
+def peak_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_step(script, step, label, path, variants_file, variant_class, bam_kwargs):
+    """
+    Time one annotation step. This runs in its own process, so that the peak RSS is only that
+    of the step.
+
+    Returns:
+    tuple: (seconds, peak RSS in MB, annotated DataFrame)
+    """
+    module = load_script(script)
+    variants_df = read_variants(variants_file, variant_class)
+    start_time = time.time()
+    if step == "bam":
+        parameters = inspect.signature(module.annotate_from_bam).parameters
+        kwargs = {k: v for (k, v) in bam_kwargs.items() if k in parameters}
+        result = module.annotate_from_bam(path, variants_df, label, **kwargs)
+    else:
+        result = module.annotate_from_vcf(path, variants_df, label)
+    return time.time() - start_time, peak_rss_mb(), result
+
+
+def count_differences(result, baseline_result):
+    """
+    Number of variants whose annotations differ between the two results, over the columns they
+    have in common.
+    """
+    columns = [c for c in result.columns if c in baseline_result.columns]
+    if len(result) != len(baseline_result):
+        return max(len(result), len(baseline_result))
+    a = result[columns].reset_index(drop=True)
+    b = baseline_result[columns].reset_index(drop=True)
+    same = (a == b) | (a.isnull() & b.isnull())
+    return int((~same.all(axis=1)).sum())
+
+
+def run_in_new_process(*args):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_step, *args).result()
+
+
+def run_benchmark(args):
+    bam_kwargs = json.loads(args.bam_kwargs)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="annotate_variants_benchmark_")
+    results = []
+    for depth in args.depths:
+        dataset = generate_dataset(join(workdir, f"depth_{depth}"), depth, args)
+        steps = (
+            [("bam", label, path) for (label, path) in dataset["bams"].items()] +
+            [("vcf", label, path) for (label, path) in dataset["vcfs"].items()])
+        for (step, label, path) in steps:
+            for variant_class in VARIANT_CLASSES:
+                seconds, rss, result = run_in_new_process(
+                    args.script, step, label, path, dataset["variants"], variant_class,
+                    bam_kwargs)
+                row = {
+                    "depth": depth,
+                    "step": f"{step}:{label}",
+                    "variant_class": variant_class,
+                    "num_variants": len(result),
+                    "seconds": seconds,
+                    "variants_per_sec": len(result) / seconds if seconds else np.inf,
+                    "peak_rss_mb": rss,
+                }
+                if args.baseline:
+                    baseline_seconds, baseline_rss, baseline_result = run_in_new_process(
+                        args.baseline, step, label, path, dataset["variants"], variant_class,
+                        bam_kwargs)
+                    row["baseline_seconds"] = baseline_seconds
+                    row["baseline_peak_rss_mb"] = baseline_rss
+                    row["speedup"] = baseline_seconds / seconds if seconds else np.inf
+                    row["num_differences"] = count_differences(result, baseline_result)
+                results.append(row)
+    return pd.DataFrame(results)
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    results = run_benchmark(args)
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(results.round(3).to_string(index=False))
+    if args.output:
+        results.to_json(args.output, orient="records", indent=2)
+        print(f"Wrote: {args.output}")
+    if "num_differences" in results.columns and results.num_differences.sum() > 0:
+        print("Results differ from the baseline for %d variants" % results.num_differences.sum())
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
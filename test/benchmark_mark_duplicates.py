@@ -0,0 +1,198 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the duplicate marking backends of the pipeline's mark_dups step.
+
+This runs Picard MarkDuplicates (with the pipeline's settings) and sambamba markdup followed by
+pipeline/scripts/duplication_metrics.py on the same coordinate-sorted BAM, and reports each
+one's wall time, CPU time and peak RSS. It then compares the sambamba results to Picard's: the
+duplication metrics that sequencing.py checks, and the reads flagged as duplicates.
+
+The input is a merged, coordinate-sorted BAM from the pipeline, e.g. for the IDH1 test data
+(test/idh1_config.yaml), made by running the pipeline up to that step:
+
+    python run_snakemake.py --configfile test/idh1_config.yaml \
+        --target <outputs>/idh1-test-sample/tumor_merged_aligned_coordinate_sorted.bam
+    python test/benchmark_mark_duplicates.py \
+        --bam <outputs>/idh1-test-sample/tumor_merged_aligned_coordinate_sorted.bam \
+        --threads 1 4 8 \
+        --output benchmark.json
+
+It needs picard, sambamba and pysam.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+from os.path import abspath, dirname, join
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import pysam
+
+SCRIPTS_DIR = join(dirname(dirname(abspath(__file__))), "pipeline", "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+from duplication_metrics import METRICS_COLUMNS  # noqa: E402
+
+# metrics compared between the backends
+COMPARED_METRICS = [column for column in METRICS_COLUMNS if column not in (
+    "LIBRARY", "READ_PAIR_OPTICAL_DUPLICATES")]
+
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[1])
+
+parser.add_argument(
+    "--bam",
+    required=True,
+    help="Merged, coordinate-sorted BAM file to mark duplicates in")
+
+parser.add_argument(
+    "--threads",
+    type=int,
+    nargs="+",
+    default=[1, 4],
+    help="Thread counts to run sambamba with (Picard always runs with one)")
+
+parser.add_argument(
+    "--mem-gb",
+    type=int,
+    default=20,
+    help="Picard heap size in GB, as the pipeline gives it")
+
+parser.add_argument(
+    "--workdir",
+    default="",
+    help="Directory for the outputs. Defaults to a temporary directory")
+
+parser.add_argument(
+    "--output",
+    default="",
+    help="JSON file to write the results to")
+
+
+def run_timed(command):
+    """
+    Run a shell command, and return its wall time, CPU time (user + system, in seconds) and peak
+    RSS in MB, including the processes it starts.
+    """
+    start_time = time.time()
+    process = subprocess.Popen(["bash", "-c", command])
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start_time
+    if status != 0:
+        raise ValueError("Command failed: %s" % command)
+    # bytes on macOS, kilobytes on Linux
+    peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return seconds, usage.ru_utime + usage.ru_stime, peak_rss_mb
+
+
+def picard_command(bam, output_prefix, mem_gb):
+    tmpdir = output_prefix + "_tmp"
+    return (
+        "mkdir -p {tmpdir} && TMPDIR={tmpdir} "
+        "MAX_SEQUENCES_FOR_DISK_READ_ENDS_MAP=50000 "
+        "MAX_FILE_HANDLES_FOR_READ_ENDS_MAP=20000 "
+        "SORTING_COLLECTION_SIZE_RATIO=0.250000 "
+        "picard -Xmx{mem_gb}g -Djava.io.tmpdir={tmpdir} MarkDuplicates "
+        "INPUT={bam} OUTPUT={prefix}.bam VALIDATION_STRINGENCY=LENIENT "
+        "METRICS_FILE={prefix}_metrics.txt 2> {prefix}.log").format(
+            tmpdir=tmpdir, mem_gb=mem_gb, bam=shlex.quote(bam), prefix=output_prefix)
+
+
+def sambamba_command(bam, output_prefix, threads):
+    tmpdir = output_prefix + "_tmp"
+    return (
+        "mkdir -p {tmpdir} && "
+        "sambamba markdup -t {threads} --tmpdir {tmpdir} {bam} {prefix}.bam 2> {prefix}.log && "
+        "python {scripts}/duplication_metrics.py --bam {prefix}.bam "
+        "--output {prefix}_metrics.txt --threads {threads} >> {prefix}.log").format(
+            tmpdir=tmpdir, threads=threads, bam=shlex.quote(bam), prefix=output_prefix,
+            scripts=SCRIPTS_DIR)
+
+
+def read_metrics(path):
+    # the same parsing as scripts/sequencing.py
+    df = pd.read_csv(path, sep="\t", comment="#")
+    return df.head(1).to_dict(orient="records")[0]
+
+
+def duplicate_reads(bam_path):
+    """
+    (name, first or second of pair) of the primary reads flagged as duplicates.
+    """
+    duplicates = set()
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        for read in bam.fetch(until_eof=True):
+            if read.is_duplicate and not (read.is_secondary or read.is_supplementary):
+                duplicates.add((read.query_name, read.is_read2))
+    return duplicates
+
+
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mark_duplicates_benchmark_")
+    runs = [("picard", 1, picard_command(args.bam, join(workdir, "picard"), args.mem_gb))]
+    for threads in args.threads:
+        prefix = join(workdir, "sambamba_t%d" % threads)
+        runs.append(("sambamba", threads, sambamba_command(args.bam, prefix, threads)))
+
+    results = []
+    picard_metrics = picard_duplicates = None
+    for backend, threads, command in runs:
+        print("Running %s with %d threads" % (backend, threads))
+        prefix = join(workdir, backend if backend == "picard" else "sambamba_t%d" % threads)
+        seconds, cpu_seconds, peak_rss_mb = run_timed(command)
+        metrics = read_metrics(prefix + "_metrics.txt")
+        duplicates = duplicate_reads(prefix + ".bam")
+        row = {
+            "backend": backend,
+            "threads": threads,
+            "seconds": seconds,
+            "cpu_seconds": cpu_seconds,
+            "peak_rss_mb": peak_rss_mb,
+            "percent_duplication": metrics["PERCENT_DUPLICATION"],
+            "num_duplicates": len(duplicates),
+        }
+        if backend == "picard":
+            picard_metrics, picard_duplicates = metrics, duplicates
+        else:
+            row["speedup"] = results[0]["seconds"] / seconds if seconds else float("inf")
+            row["metrics_differing"] = ",".join(
+                column for column in COMPARED_METRICS
+                if str(metrics[column]) != str(picard_metrics[column]))
+            row["duplicates_only_here"] = len(duplicates - picard_duplicates)
+            row["duplicates_only_in_picard"] = len(picard_duplicates - duplicates)
+        results.append(row)
+    return pd.DataFrame(results)
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    results = run_benchmark(args)
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(results.round(3).to_string(index=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results.to_dict(orient="records"), f, indent=2)
+        print("Wrote: %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
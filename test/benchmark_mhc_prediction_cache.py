@@ -0,0 +1,243 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the vaxrank rule's MHC binding prediction cache (scripts/mhc_prediction_cache.py).
+
+This simulates a cohort of patients whose Vaxrank runs share the cache: each patient has some
+mutant protein fragments of its own and some shared with other patients (like recurrent driver
+mutations), and some of its alleles are common ones. Their predictions are made by a local
+stand-in predictor, with a fixed latency per request, instead of NetMHCpan or IEDB. The patients
+are run in rounds of --concurrency processes using the same database at once, as in a batch run
+(run_snakemake.py --batch), and for each round the script reports the time taken and the cache's
+hit rate. Every cached prediction is checked against the stand-in predictor's own.
+
+    python test/benchmark_mhc_prediction_cache.py --patients 12 --concurrency 4 \
+        --output benchmark.json
+
+It needs mhctools.
+"""
+
+from argparse import ArgumentParser
+import hashlib
+import json
+from multiprocessing import Pool
+from os.path import abspath, dirname, join
+import random
+import sys
+import tempfile
+import time
+
+from mhctools.base_predictor import BasePredictor
+from mhctools import BindingPrediction, BindingPredictionCollection
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "pipeline", "scripts"))
+
+from mhc_prediction_cache import CachedPredictor, PredictionCache  # noqa: E402
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+COMMON_ALLELES = ["HLA-A*02:01", "HLA-A*01:01", "HLA-B*07:02", "HLA-C*07:01"]
+RARE_ALLELES = ["HLA-A*30:01", "HLA-B*44:02", "HLA-B*35:01", "HLA-C*05:01", "HLA-C*04:01"]
+
+parser = ArgumentParser(description=__doc__.split("\n\n")[1])
+
+parser.add_argument(
+    "--patients",
+    type=int,
+    default=12,
+    help="Number of simulated patients")
+
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=4,
+    help="Number of patients run at once against the same cache")
+
+parser.add_argument(
+    "--fragments-per-patient",
+    type=int,
+    default=30,
+    help="Mutant protein fragments per patient")
+
+parser.add_argument(
+    "--shared-fraction",
+    type=float,
+    default=0.3,
+    help="Fraction of each patient's fragments drawn from a pool shared by the cohort")
+
+parser.add_argument(
+    "--request-seconds",
+    type=float,
+    default=0.02,
+    help="Latency of each of the stand-in predictor's requests")
+
+parser.add_argument(
+    "--cache",
+    default="",
+    help="Cache database to use. Defaults to a new one in a temporary directory")
+
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0)
+
+parser.add_argument(
+    "--output",
+    default="",
+    help="JSON file to write the results to")
+
+
+class StandInPredictor(BasePredictor):
+    """
+    Deterministic predictor with the interface of mhctools' ones: scores are derived from a hash
+    of the allele and peptide, and each predict_subsequences or predict_peptides call sleeps for
+    request_seconds per allele, like a request to IEDB.
+    """
+    def __init__(self, alleles, default_peptide_lengths=[8, 9, 10, 11], request_seconds=0.0):
+        BasePredictor.__init__(
+            self, alleles=alleles, default_peptide_lengths=default_peptide_lengths)
+        self.request_seconds = request_seconds
+        self.num_requests = 0
+
+    def _predict(self, allele, peptide, name=None, offset=0):
+        digest = hashlib.md5(("%s %s" % (allele, peptide)).encode()).digest()
+        affinity = 1.0 + int.from_bytes(digest[:4], "big") % 50000
+        return BindingPrediction(
+            peptide=peptide,
+            allele=allele,
+            affinity=affinity,
+            score=1.0 - affinity / 50001.0,
+            percentile_rank=digest[4] % 100,
+            source_sequence_name=name,
+            offset=offset,
+            prediction_method_name="stand-in")
+
+    def _request(self):
+        self.num_requests += len(self.alleles)
+        time.sleep(self.request_seconds * len(self.alleles))
+
+    def predict_peptides(self, peptides):
+        self._request()
+        return BindingPredictionCollection([
+            self._predict(allele, peptide) for peptide in peptides for allele in self.alleles])
+
+    def predict_subsequences(self, sequence_dict, peptide_lengths=None):
+        peptide_lengths = self._check_peptide_lengths(peptide_lengths)
+        predictions = []
+        for name, sequence in sequence_dict.items():
+            self._request()
+            for length in peptide_lengths:
+                for offset in range(len(sequence) - length + 1):
+                    for allele in self.alleles:
+                        predictions.append(self._predict(
+                            allele, sequence[offset:offset + length], name, offset))
+        return BindingPredictionCollection(predictions)
+
+
+def make_cohort(args):
+    rng = random.Random(args.seed)
+
+    def fragment():
+        return "".join(rng.choice(AMINO_ACIDS) for _ in range(35))
+
+    shared_fragments = [fragment() for _ in range(args.fragments_per_patient)]
+    patients = []
+    for _ in range(args.patients):
+        num_shared = int(args.fragments_per_patient * args.shared_fraction)
+        fragments = rng.sample(shared_fragments, num_shared) + [
+            fragment() for _ in range(args.fragments_per_patient - num_shared)]
+        alleles = rng.sample(COMMON_ALLELES, 3) + rng.sample(RARE_ALLELES, 3)
+        patients.append((alleles, fragments))
+    return patients
+
+
+def _prediction_key(prediction):
+    return (prediction.allele, prediction.peptide, prediction.source_sequence_name,
+            prediction.offset)
+
+
+def run_patient(cache_path, alleles, fragments, request_seconds):
+    """
+    Predict the epitopes of a patient's fragments, as Vaxrank does (one predict_subsequences
+    call per fragment, then predict_peptides for some wild-type peptides), through the cache.
+    """
+    predictor = StandInPredictor(alleles, request_seconds=request_seconds)
+    cache = PredictionCache(cache_path)
+    cached_predictor = CachedPredictor(predictor, cache, "stand-in", "1")
+    start_time = time.time()
+    mismatches = 0
+    for i, fragment in enumerate(fragments):
+        for predictions, expected in [
+                (cached_predictor.predict_subsequences({"fragment%d" % i: fragment}),
+                 StandInPredictor(alleles).predict_subsequences({"fragment%d" % i: fragment})),
+                (cached_predictor.predict_peptides([fragment[:9], fragment[-10:]]),
+                 StandInPredictor(alleles).predict_peptides([fragment[:9], fragment[-10:]]))]:
+            expected = dict((_prediction_key(p), p) for p in expected)
+            if len(predictions) != len(expected):
+                mismatches += abs(len(predictions) - len(expected))
+            for prediction in predictions:
+                other = expected.get(_prediction_key(prediction))
+                if other is None or (prediction.affinity, prediction.percentile_rank) != (
+                        other.affinity, other.percentile_rank):
+                    mismatches += 1
+    seconds = time.time() - start_time
+    cache.close()
+    return {
+        "seconds": seconds,
+        "lookups": cached_predictor.stats["lookups"],
+        "hits": cached_predictor.stats["hits"],
+        "predictor_requests": predictor.num_requests,
+        "mismatches": mismatches,
+    }
+
+
+def run_benchmark(args):
+    cache_path = args.cache or join(tempfile.mkdtemp(prefix="mhc_cache_benchmark_"), "cache.db")
+    patients = make_cohort(args)
+    rounds = []
+    with Pool(args.concurrency) as pool:
+        for i in range(0, len(patients), args.concurrency):
+            batch = patients[i:i + args.concurrency]
+            start_time = time.time()
+            results = pool.starmap(run_patient, [
+                (cache_path, alleles, fragments, args.request_seconds)
+                for alleles, fragments in batch])
+            lookups = sum(r["lookups"] for r in results)
+            hits = sum(r["hits"] for r in results)
+            rounds.append({
+                "round": len(rounds) + 1,
+                "patients": len(batch),
+                "seconds": time.time() - start_time,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "predictor_requests": sum(r["predictor_requests"] for r in results),
+                "mismatches": sum(r["mismatches"] for r in results),
+            })
+            print("Round %(round)d: %(patients)d patients in %(seconds).2fs, hit rate "
+                  "%(hit_rate).3f, %(predictor_requests)d predictor requests, "
+                  "%(mismatches)d mismatched predictions" % rounds[-1])
+    return rounds
+
+
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    rounds = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rounds, f, indent=2)
+        print("Wrote: %s" % args.output)
+    return 1 if any(r["mismatches"] for r in rounds) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
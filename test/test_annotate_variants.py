@@ -0,0 +1,217 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import abspath, dirname, join
+import random
+import re
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import pysam
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'pipeline', 'scripts'))
+
+from annotate_variants import (  # noqa: E402
+    annotate_from_bams, count_loci_by_fetch, count_loci_by_sweep, DecodedReadCache,
+    main as annotate_variants)
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+REFERENCE = ''.join(random.Random(0).choice('ACGT') for _ in range(300))
+
+
+def other_base(base):
+    return 'A' if base != 'A' else 'C'
+
+
+# (contig, start, ref, alt) of the variants, in varcode's conventions, and the
+# (ref_count, alt_count, depth) each should get
+SNV = ('1', 51, REFERENCE[50], other_base(REFERENCE[50]))
+MNV = ('1', 56, REFERENCE[55:57], other_base(REFERENCE[55]) + other_base(REFERENCE[56]))
+DELETION = ('1', 81, REFERENCE[80:82], '')
+INSERTION = ('1', 111, '', 'GA')
+UNCOVERED = ('1', 251, REFERENCE[250], other_base(REFERENCE[250]))
+EXPECTED_COUNTS = {
+    # the ref and soft-clipped reads, and the alt read after an intron; the spliced read with
+    # its intron over the SNV, the duplicate and the low mapping quality read don't count
+    SNV: (1, 3, 4),
+    # the soft-clipped read has only one of the two alt bases, so it covers the MNV but supports
+    # neither allele
+    MNV: (2, 2, 5),
+    # a read deleting only one of the two bases supports neither allele, and a read soft
+    # clipped before the deletion doesn't cover it
+    DELETION: (1, 1, 3),
+    # a read with a different inserted sequence supports neither allele
+    INSERTION: (1, 1, 3),
+    UNCOVERED: (0, 0, 0),
+}
+
+
+def make_read(name, start, cigar, substitutions={}, inserted=(), flag=0, mapping_quality=60):
+    """
+    Read aligned to REFERENCE at `start` (0-based), with its bases taken from the reference,
+    except for the `substitutions` (reference position -> base) and the `inserted` sequences of
+    each insertion. Soft-clipped bases are Ns.
+    """
+    inserted = list(inserted)
+    sequence = []
+    position = start
+    for (length, op) in re.findall(r'(\d+)([MIDNS])', cigar):
+        length = int(length)
+        if op == 'M':
+            sequence += [
+                substitutions.get(p, REFERENCE[p]) for p in range(position, position + length)]
+        elif op == 'I':
+            sequence.append(inserted.pop(0))
+        elif op == 'S':
+            sequence.append('N' * length)
+        if op in 'MDN':
+            position += length
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.flag = flag
+    read.reference_id = 0
+    read.reference_start = start
+    read.mapping_quality = mapping_quality
+    read.cigarstring = cigar
+    read.query_sequence = ''.join(sequence)
+    read.query_qualities = pysam.qualitystring_to_array('I' * len(read.query_sequence))
+    return read
+
+
+def make_reads():
+    snv_alt = {50: SNV[3]}
+    mnv_alt = {55: MNV[3][0], 56: MNV[3][1]}
+    return [
+        # SNV and MNV
+        make_read('snv_ref', 30, '40M'),
+        make_read('snv_alt', 35, '40M', {**snv_alt, **mnv_alt}),
+        make_read('snv_alt_soft_clipped', 45, '5S30M', {**snv_alt, 55: MNV[3][0]}),
+        make_read('snv_alt_after_intron', 0, '10M30N20M', snv_alt),
+        make_read('intron_over_snv', 20, '10M100N30M'),
+        make_read('snv_alt_duplicate', 40, '30M', snv_alt, flag=1024),
+        make_read('snv_alt_low_mapq', 40, '30M', snv_alt, mapping_quality=0),
+        make_read('mnv_alt', 52, '25M', mnv_alt),
+        # deletion
+        make_read('deletion_ref', 60, '40M'),
+        make_read('deletion_alt', 65, '15M2D20M'),
+        make_read('deletion_partial', 70, '10M1D20M'),
+        make_read('soft_clipped_before_deletion', 60, '20M10S'),
+        # insertion
+        make_read('insertion_alt', 95, '16M2I14M', inserted=['GA']),
+        make_read('insertion_ref', 100, '30M'),
+        make_read('insertion_other', 100, '11M2I17M', inserted=['TT']),
+    ]
+
+
+class TestAnnotateVariants(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        header = {
+            'HD': {'VN': '1.6', 'SO': 'coordinate'},
+            'SQ': [{'SN': '1', 'LN': len(REFERENCE)}],
+        }
+        unsorted_bam = join(cls.tmpdir.name, 'unsorted.bam')
+        with pysam.AlignmentFile(unsorted_bam, 'wb', header=header) as f:
+            for read in make_reads():
+                f.write(read)
+        cls.bam = join(cls.tmpdir.name, 'tumor.bam')
+        pysam.sort('-o', cls.bam, unsorted_bam)
+        pysam.index(cls.bam)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def count(self, count_loci, loci, cache=None):
+        with pysam.AlignmentFile(self.bam, 'rb') as bam:
+            return count_loci(bam, loci, min_mapq=10, cache=cache)
+
+    def test_counts(self):
+        loci = list(EXPECTED_COUNTS)
+        for count_loci in [count_loci_by_fetch, count_loci_by_sweep]:
+            for cache in [None, DecodedReadCache()]:
+                counts = self.count(count_loci, loci, cache)
+                self.assertEqual(
+                    dict(zip(loci, map(tuple, counts.tolist()))), EXPECTED_COUNTS,
+                    msg='%s, cache=%s' % (count_loci.__name__, cache is not None))
+
+    def test_annotate_from_bams(self):
+        # every variant twice, in a shuffled order
+        variants = list(EXPECTED_COUNTS) * 2
+        random.Random(1).shuffle(variants)
+        variants_df = pd.DataFrame(variants, columns=['contig', 'start', 'ref', 'alt'])
+
+        results = []
+        for kwargs in [
+                dict(),
+                dict(sweep=True),
+                dict(jobs=2),
+                dict(jobs=2, sweep=True),
+                dict(read_cache_size=0)]:
+            results.append(annotate_from_bams(
+                [('tumor_dna', self.bam), ('tumor_rna', self.bam)], variants_df.copy(), **kwargs))
+
+        annotated = results[0]
+        for (variant, row) in zip(variants, annotated.itertuples(index=False)):
+            ref_count, alt_count, depth = EXPECTED_COUNTS[variant]
+            for label in ['tumor_dna', 'tumor_rna']:
+                self.assertEqual(
+                    (getattr(row, label + '_ref_count'), getattr(row, label + '_alt_count'),
+                     getattr(row, label + '_depth')),
+                    (ref_count, alt_count, depth))
+            if depth:
+                self.assertAlmostEqual(row.tumor_dna_vaf, alt_count / depth)
+            else:
+                self.assertTrue(np.isnan(row.tumor_dna_vaf))
+        self.assertEqual(list(annotated.unmangled_contig), ['1'] * len(variants))
+        for result in results[1:]:
+            pd.testing.assert_frame_equal(result, annotated)
+
+    @unittest.skipIf(pyarrow is None, 'needs pyarrow')
+    def test_chunked_parquet_output(self):
+        # the first chunk has no notes and no scores, and the last has no RNA coverage
+        variants_file = join(self.tmpdir.name, 'variants.csv')
+        pd.DataFrame([
+            dict(zip(['contig', 'start', 'ref', 'alt'], variant), note=note, score=score)
+            for (variant, note, score) in [
+                (SNV, None, None),
+                (MNV, None, None),
+                (DELETION, 'checked in IGV', 2),
+                (INSERTION, None, 0.5),
+                (UNCOVERED, None, None),
+            ]
+        ]).to_csv(variants_file, index=False)
+
+        outputs = {}
+        for (name, chunk_size) in [('whole.csv', None), ('chunked.parquet', 2)]:
+            outputs[name] = join(self.tmpdir.name, name)
+            annotate_variants(
+                variants_file, [('tumor_dna', self.bam)], [], outputs[name],
+                chunk_size=chunk_size)
+        expected = pd.read_csv(
+            outputs['whole.csv'], dtype={'contig': str, 'unmangled_contig': str}
+        ).fillna({'ref': '', 'alt': ''})
+        annotated = pd.read_parquet(outputs['chunked.parquet'])
+        self.assertEqual(annotated.note.tolist(), [None, None, 'checked in IGV', None, None])
+        self.assertEqual(annotated.tumor_dna_depth.dtype, np.int64)
+        pd.testing.assert_frame_equal(
+            annotated.drop(columns='note'), expected.drop(columns='note'), check_dtype=False)
@@ -0,0 +1,89 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from os.path import abspath, dirname, join
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'pipeline', 'scripts'))
+
+from annotation_store import (  # noqa: E402
+    AnnotationStore, BAM_FINGERPRINT_BYTES, bam_fingerprint)
+
+LOCI = [('1', 51, 'T', 'A'), ('1', 81, 'TT', '')]
+COUNTS = np.array([[1, 3, 4], [1, 1, 3]])
+
+
+class TestAnnotationStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # stand-ins for a BAM file and its index, of which only the bytes are fingerprinted
+        rng = random.Random(0)
+        self.contents = bytearray(rng.getrandbits(8) for _ in range(3 * BAM_FINGERPRINT_BYTES))
+        self.bam = self.write('tumor.bam', self.contents)
+        self.write('tumor.bam.bai', b'index')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, basename, contents):
+        path = join(self.tmpdir.name, basename)
+        os.makedirs(dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def test_copies_have_the_same_fingerprint(self):
+        os.makedirs(join(self.tmpdir.name, 'copy'))
+        copy = join(self.tmpdir.name, 'copy', 'renamed.bam')
+        shutil.copy(self.bam, copy)
+        shutil.copy(self.bam + '.bai', join(self.tmpdir.name, 'copy', 'renamed.bai'))
+        self.assertEqual(bam_fingerprint(copy), bam_fingerprint(self.bam))
+
+    def test_changes_in_the_middle_of_the_bam(self):
+        # the same first and last bytes, but another index
+        changed = self.write('changed/tumor.bam', self.contents)
+        self.write('changed/tumor.bam.bai', b'other index')
+        self.assertNotEqual(bam_fingerprint(changed), bam_fingerprint(self.bam))
+
+        # without an index, the whole file is hashed
+        contents = bytearray(self.contents)
+        contents[len(contents) // 2] ^= 1
+        unindexed = self.write('unindexed/tumor.bam', self.contents)
+        changed_unindexed = self.write('unindexed/changed.bam', contents)
+        self.assertNotEqual(bam_fingerprint(changed_unindexed), bam_fingerprint(unindexed))
+
+    def test_counts_are_kept_per_version(self):
+        store_path = join(self.tmpdir.name, 'store.sqlite')
+        store = AnnotationStore(store_path, version=1)
+        self.assertEqual(store.lookup_counts(self.bam, 10, LOCI)[1], [0, 1])
+        store.store_counts(self.bam, 10, LOCI, COUNTS)
+        store.close()
+
+        store = AnnotationStore(store_path, version=1)
+        counts, missing = store.lookup_counts(self.bam, 10, LOCI)
+        self.assertEqual(missing, [])
+        np.testing.assert_equal(counts, COUNTS)
+        # other parameters or counting code don't reuse them
+        self.assertEqual(store.lookup_counts(self.bam, 20, LOCI)[1], [0, 1])
+        store.close()
+        store = AnnotationStore(store_path, version=2)
+        self.assertEqual(store.lookup_counts(self.bam, 10, LOCI)[1], [0, 1])
+        store.close()
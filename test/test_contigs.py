@@ -0,0 +1,42 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import abspath, dirname, join
+import sys
+import unittest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'pipeline', 'scripts'))
+
+from contigs import ContigIndex  # noqa: E402
+
+
+class TestContigIndex(unittest.TestCase):
+    def test_primary_contigs(self):
+        b37 = ContigIndex(['1', 'X', 'MT'])
+        hg19 = ContigIndex(['chr1', 'chrX', 'chrM'])
+        for name, b37_contig, hg19_contig in [
+                ('1', '1', 'chr1'), ('chr1', '1', 'chr1'), ('X', 'X', 'chrX'),
+                ('chrM', 'MT', 'chrM'), ('MT', 'MT', 'chrM'), ('M', 'MT', 'chrM')]:
+            self.assertEqual(b37.get(name), b37_contig)
+            self.assertEqual(hg19.get(name), hg19_contig)
+        self.assertEqual(b37.primary_contigs(), ['1', 'X', 'MT'])
+
+    def test_unplaced_and_alt_contigs(self):
+        hg19 = ContigIndex(['chr1', 'chrUn_gl000220', 'chr6_apd_hap1'])
+        self.assertEqual(hg19.get('Un_gl000220'), 'chrUn_gl000220')
+        self.assertEqual(hg19.get('chrUn_gl000220'), 'chrUn_gl000220')
+        self.assertEqual(hg19.get('6_apd_hap1'), 'chr6_apd_hap1')
+        unprefixed = ContigIndex(['1', 'Un_gl000220'])
+        self.assertEqual(unprefixed.get('chrUn_gl000220'), 'Un_gl000220')
+        self.assertEqual(hg19.primary_contigs(), ['chr1'])
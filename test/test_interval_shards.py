@@ -0,0 +1,103 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import abspath, dirname, join
+import random
+import sys
+import tempfile
+import unittest
+
+import pysam
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'pipeline', 'scripts'))
+
+import interval_shards  # noqa: E402
+from interval_shards import main as interval_shards_main, read_fasta_gaps  # noqa: E402
+
+# assembly gaps of each contig (0-based, half-open)
+GAPS = {
+    '1': [(0, 10000), (30000, 32000), (61000, 63000)],
+    '2': [(20000, 21500)],
+}
+LENGTHS = {'1': 100000, '2': 40000}
+
+
+def parse_interval(interval):
+    if ':' not in interval:
+        return interval, 0, LENGTHS[interval]
+    contig, positions = interval.split(':')
+    start, end = positions.split('-')
+    return contig, int(start) - 1, int(end)
+
+
+class TestIntervalShards(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fasta = join(self.tmpdir.name, 'reference.fasta')
+        rng = random.Random(0)
+        with open(self.fasta, 'w') as f:
+            for (contig, length) in LENGTHS.items():
+                sequence = [rng.choice('ACGT') for _ in range(length)]
+                for (start, end) in GAPS[contig]:
+                    sequence[start:end] = 'N' * (end - start)
+                # a run of Ns too short to be a gap
+                sequence[50000:50010] = 'N' * 10
+                sequence = ''.join(sequence)
+                f.write('>%s\n' % contig)
+                for i in range(0, length, 60):
+                    f.write(sequence[i:i + 60] + '\n')
+        pysam.faidx(self.fasta)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_read_fasta_gaps(self):
+        block_size = interval_shards.FASTA_BLOCK_SIZE
+        try:
+            # blocks that end inside the gaps
+            interval_shards.FASTA_BLOCK_SIZE = 1000
+            gaps = read_fasta_gaps(self.fasta, self.fasta + '.fai', ['1', '2'])
+        finally:
+            interval_shards.FASTA_BLOCK_SIZE = block_size
+        self.assertEqual(gaps, GAPS)
+
+    def shard_cuts(self, args):
+        output_dir = join(self.tmpdir.name, 'shards')
+        interval_shards_main([
+            '--fai', self.fasta + '.fai', '--contigs', '1', '2', '--num-shards', '5',
+            '--output-dir', output_dir] + args)
+        cuts = []
+        for i in range(5):
+            with open(join(output_dir, 'shard%d.intervals' % i)) as f:
+                intervals = [parse_interval(line.strip()) for line in f]
+            self.assertTrue(intervals)
+            cuts.append(intervals[0][:2])
+        return cuts[1:]
+
+    def test_cuts_in_gaps(self):
+        for (contig, position) in self.shard_cuts(['--fasta', self.fasta]):
+            self.assertTrue(
+                position == 0 or any(start < position < end for (start, end) in GAPS[contig]),
+                msg='%s:%d' % (contig, position))
+
+    def test_cuts_between_targets(self):
+        targets = [
+            ('1', 15000, 25000), ('1', 40000, 58000), ('1', 70000, 90000), ('2', 1000, 35000)]
+        bed = join(self.tmpdir.name, 'targets.bed')
+        with open(bed, 'w') as f:
+            f.writelines('%s\t%d\t%d\n' % target for target in targets)
+        for (contig, position) in self.shard_cuts(['--bed', bed]):
+            self.assertFalse(
+                any(c == contig and start <= position < end for (c, start, end) in targets),
+                msg='%s:%d' % (contig, position))
@@ -0,0 +1,141 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+from os.path import abspath, dirname, join
+import sys
+import tempfile
+import unittest
+
+SCRIPTS_DIR = join(dirname(dirname(abspath(__file__))), 'pipeline', 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+from preflight_qc import main as preflight_qc, project_duplication  # noqa: E402
+from sequencing import check_metrics  # noqa: E402
+
+METRICS_SPEC = join(SCRIPTS_DIR, 'qc-metrics-spec.yaml')
+
+
+def write_picard_metrics(path, metrics):
+    with open(path, 'w') as f:
+        f.write('## METRICS CLASS\tpicard.Metrics\n')
+        f.write('\t'.join(metrics) + '\n')
+        f.write('\t'.join(str(value) for value in metrics.values()) + '\n')
+
+
+class TestPreflightQC(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, basename):
+        return join(self.tmpdir.name, basename)
+
+    def test_project_duplication_without_duplicates(self):
+        projected = project_duplication({
+            'READ_PAIRS_EXAMINED': 1000,
+            'READ_PAIR_DUPLICATES': 0,
+        }, 0.1)
+        self.assertEqual(projected['PERCENT_DUPLICATION'], 0.0)
+        self.assertIsNone(projected['ESTIMATED_LIBRARY_SIZE'])
+        self.assertAlmostEqual(projected['UNIQUE_READS_SCALE'], 10.0)
+
+    def test_project_duplication_recovers_full_depth(self):
+        # a library of 1M molecules, sequenced to 2M read pairs, sampled at 5%
+        library_size, full_pairs, fraction = 1e6, 2e6, 0.05
+
+        def unique_pairs(pairs):
+            return library_size * (1 - math.exp(-pairs / library_size))
+
+        sample_pairs = int(full_pairs * fraction)
+        sample_unique = int(round(unique_pairs(sample_pairs)))
+        projected = project_duplication({
+            'READ_PAIRS_EXAMINED': sample_pairs,
+            'READ_PAIR_DUPLICATES': sample_pairs - sample_unique,
+        }, fraction)
+        self.assertAlmostEqual(
+            projected['PERCENT_DUPLICATION'], 1 - unique_pairs(full_pairs) / full_pairs, places=2)
+        self.assertAlmostEqual(projected['ESTIMATED_LIBRARY_SIZE'] / library_size, 1.0, places=1)
+        # sampled duplication is far lower than the full-depth one
+        self.assertLess((sample_pairs - sample_unique) / sample_pairs, 0.05)
+        self.assertGreater(projected['PERCENT_DUPLICATION'], 0.5)
+
+    def run_preflight_qc(self, mean_target_coverage, fail_on_error):
+        args = []
+        for sample in ['normal', 'tumor']:
+            write_picard_metrics(self.path('%s_dups.txt' % sample), {
+                'LIBRARY': sample,
+                'UNPAIRED_READS_EXAMINED': 0,
+                'READ_PAIRS_EXAMINED': 10000,
+                'READ_PAIR_DUPLICATES': 100,
+                'UNPAIRED_READ_DUPLICATES': 0,
+                'PERCENT_DUPLICATION': 0.01,
+            })
+            write_picard_metrics(self.path('%s_hs.txt' % sample), {
+                'BAIT_SET': 'kit',
+                'PCT_PF_UQ_READS_ALIGNED': 0.98,
+                'PCT_SELECTED_BASES': 0.8,
+                'PCT_OFF_BAIT': 0.2,
+                'MEAN_BAIT_COVERAGE': mean_target_coverage,
+                'MEAN_TARGET_COVERAGE': mean_target_coverage,
+                'PCT_TARGET_BASES_30X': 0.0,
+            })
+            with open(self.path('%s_counts.json' % sample), 'w') as f:
+                json.dump({'total_reads': 100000, 'sampled_reads': 10000, 'paired': True}, f)
+            args += [
+                '--%s-duplication-metrics' % sample, self.path('%s_dups.txt' % sample),
+                '--%s-hs-metrics' % sample, self.path('%s_hs.txt' % sample),
+                '--%s-read-counts' % sample, self.path('%s_counts.json' % sample),
+            ]
+        args += [
+            '--metrics-spec-file', METRICS_SPEC,
+            '--out', self.path('out.txt'),
+            '--estimates-output', self.path('estimates.json'),
+        ]
+        if fail_on_error:
+            args.append('--fail-on-error')
+        preflight_qc(args)
+
+    def test_passing_projection(self):
+        # ~10x the unique reads at full depth brings 30x in the sample to ~300x
+        self.run_preflight_qc(30, fail_on_error=True)
+        with open(self.path('out.txt')) as f:
+            self.assertEqual(f.read(), '')
+        with open(self.path('estimates.json')) as f:
+            estimates = json.load(f)
+        self.assertGreater(estimates['tumor']['hs_metrics']['MEAN_TARGET_COVERAGE'], 250)
+        # can't be projected from a sample, so it isn't checked
+        self.assertNotIn('PCT_TARGET_BASES_30X', estimates['tumor']['hs_metrics'])
+
+    def test_failing_projection(self):
+        self.run_preflight_qc(1, fail_on_error=False)
+        with open(self.path('out.txt')) as f:
+            errors = f.read().splitlines()
+        self.assertEqual(
+            sorted(error.split(':')[0] for error in errors),
+            ['normal_dna_hs_metrics', 'tumor_dna_hs_metrics'])
+        self.assertRaises(ValueError, self.run_preflight_qc, 1, True)
+
+    def test_check_metrics_missing_keys(self):
+        specs = {'tumor_dna_hs_metrics': [
+            {'key': 'MEAN_TARGET_COVERAGE', 'comparator': 'MIN', 'value': 250},
+            {'key': 'PCT_TARGET_BASES_30X', 'comparator': 'MIN', 'value': 0.95},
+        ]}
+        metrics = {'tumor_dna_hs_metrics': {'MEAN_TARGET_COVERAGE': 100}}
+        self.assertRaises(KeyError, check_metrics, specs, metrics)
+        self.assertEqual(len(check_metrics(specs, metrics, skip_missing=True)), 1)
+        self.assertRaises(KeyError, check_metrics, specs, {})
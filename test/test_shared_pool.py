@@ -0,0 +1,81 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import abspath, dirname, join
+import sys
+import unittest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'pipeline', 'scripts'))
+
+from shared_pool import STARVATION_SECONDS, may_start  # noqa: E402
+
+NOW = 100000.0
+
+
+def job(patient, cores, mem_mb=1000, since=NOW):
+    return {'patient': patient, 'pid': 1, 'rule': 'rule', 'cores': cores, 'mem_mb': mem_mb,
+            'since': since}
+
+
+def pool(running, waiting, cores=8, mem_mb=32000):
+    return {'cores': cores, 'mem_mb': mem_mb, 'running': running, 'waiting': waiting}
+
+
+class TestSharedPool(unittest.TestCase):
+    def test_job_starts_if_it_fits(self):
+        state = pool({'1': job('a', 4)}, {'2': job('a', 4)})
+        self.assertTrue(may_start(state, '2', NOW))
+        state = pool({'1': job('a', 6)}, {'2': job('a', 4)})
+        self.assertFalse(may_start(state, '2', NOW))
+
+    def test_job_waits_for_memory(self):
+        state = pool({'1': job('a', 1, mem_mb=30000)}, {'2': job('a', 1, mem_mb=4000)})
+        self.assertFalse(may_start(state, '2', NOW))
+
+    def test_fair_share(self):
+        # patient a holds 6 cores and patient b none: b's job goes first, even though a's has
+        # waited longer, and there's no room left for a's
+        state = pool({'1': job('a', 6)}, {
+            '2': job('a', 2, since=NOW - 60),
+            '3': job('b', 2, since=NOW - 1),
+        })
+        self.assertTrue(may_start(state, '3', NOW))
+        self.assertFalse(may_start(state, '2', NOW))
+
+    def test_same_share_goes_by_waiting_time(self):
+        state = pool({}, {
+            '1': job('a', 6, since=NOW - 1),
+            '2': job('b', 6, since=NOW - 60),
+        })
+        self.assertTrue(may_start(state, '2', NOW))
+        self.assertFalse(may_start(state, '1', NOW))
+
+    def test_small_jobs_overtake_until_starvation(self):
+        # a's 8-core job can't start while b's job runs, and is ahead of a's 2-core job
+        running = {'1': job('b', 4)}
+        large = job('a', 8, since=NOW - 10)
+        small = job('a', 2, since=NOW - 5)
+        state = pool(running, {'2': large, '3': small})
+        self.assertTrue(may_start(state, '3', NOW))
+        self.assertFalse(may_start(state, '2', NOW))
+
+        # once the large job has waited too long, the small one can't overtake it any more
+        large['since'] = NOW - STARVATION_SECONDS - 1
+        self.assertFalse(may_start(state, '3', NOW))
+        self.assertFalse(may_start(state, '2', NOW))
+
+        # and it starts as soon as the pool is free
+        del running['1']
+        self.assertTrue(may_start(state, '2', NOW))
+        self.assertFalse(may_start(state, '3', NOW))
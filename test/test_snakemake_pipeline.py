@@ -15,8 +15,8 @@
 # NOTE: for easiest readability, run this with: "nosetests --nocapture --nologcapture"
 
 import glob
-from os import chdir, listdir
-from os.path import dirname, join
+from os import chdir, getcwd, listdir
+from os.path import basename, dirname, join
 from shutil import copy2
 import tempfile
 import unittest
@@ -81,6 +81,13 @@ class TestPipeline(unittest.TestCase):
     def _get_pipeline_dir_path(cls):
         return join(cls._get_test_dir_path(), '..', 'pipeline')
 
+    # Dry run of the pipeline with a config that turns on one of its optional modes (e.g. streamed
+    # alignment), so the default pipeline is still covered by the shared test configs
+    def run_mode_config(self, basename, cli_args):
+        with tempfile.NamedTemporaryFile(mode='w') as config_tmpfile:
+            self.populate_config(basename, config_tmpfile)
+            docker_entrypoint(['--configfile', config_tmpfile.name] + cli_args)
+
     def test_vaxrank_targets(self):
         with open(join(self._get_test_dir_path(), 'idh1_config.yaml'), 'r') as idh1_config_file:
             config = yaml.safe_load(idh1_config_file)
@@ -139,6 +146,68 @@ class TestPipeline(unittest.TestCase):
         # run to make sure it doesn't crash
         docker_entrypoint(cli_args)
 
+    def test_streamed_alignment(self):
+        self.run_mode_config('idh1_config_streamed_alignment.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
+    def test_alignment_shards(self):
+        self.run_mode_config('idh1_config_alignment_shards.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
+    def test_interval_shards(self):
+        self.run_mode_config('idh1_config_interval_shards.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
+    def test_restrict_to_targets(self):
+        self.run_mode_config('idh1_config_restrict_to_targets.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
+    def test_learn_resources(self):
+        self.run_mode_config('idh1_config_learn_resources.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
+    def test_cram_final_alignments(self):
+        self.run_mode_config('idh1_config_cram.yaml', [
+            '--dry-run',
+            '--memory', '32',
+        ])
+
+    def test_compression(self):
+        self.run_mode_config('idh1_config_compression.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
+    def test_sambamba_duplicate_marking(self):
+        self.run_mode_config('idh1_config_sambamba_markdup.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
+    def test_preflight_qc(self):
+        self.run_mode_config('idh1_config_preflight_qc.yaml', [
+            '--dry-run',
+            '--memory', '15',
+            '--somatic-variant-calling-only',
+        ])
+
     def test_docker_entrypoint_script(self):
         cli_args = [
             '--configfile', self.config_tmpfile.name,
@@ -214,6 +283,35 @@ class TestPipeline(unittest.TestCase):
         ]
         docker_entrypoint(qc_cli_args)
 
+    def test_docker_entrypoint_script_batch(self):
+        with open(self.dna_only_config_tmpfile.name) as f:
+            second_patient_config = f.read().replace('idh1-test-sample', 'idh1-test-sample-2')
+        with tempfile.NamedTemporaryFile(mode='w') as second_config_tmpfile:
+            second_config_tmpfile.write(second_patient_config)
+            second_config_tmpfile.flush()
+            # run from the configs' directory with relative paths, which the runs (started from
+            # the pipeline directory) must still find
+            cwd = getcwd()
+            chdir(dirname(second_config_tmpfile.name))
+            batch_cli_args = [
+                '--batch', basename(self.config_tmpfile.name), basename(second_config_tmpfile.name),
+                '--dry-run',
+                '--memory', '33',
+                '--somatic-variant-calling-only',
+            ]
+            try:
+                docker_entrypoint(batch_cli_args)
+            finally:
+                chdir(cwd)
+
+        # patients in a batch need their own output directories
+        same_patient_cli_args = [
+            '--batch', self.config_tmpfile.name, self.dna_only_config_tmpfile.name,
+            '--dry-run',
+            '--memory', '33',
+        ]
+        self.assertRaises(ValueError, docker_entrypoint, same_patient_cli_args)
+
     def test_docker_entrypoint_script_failures(self):
         # check that invalid targets fail
         fake_target_cli_args = [
@@ -0,0 +1,83 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+from os.path import abspath, dirname, join
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'pipeline', 'scripts'))
+
+from subsample_fastq import main as subsample_fastq  # noqa: E402
+
+
+class TestSubsampleFastq(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, basename):
+        return join(self.tmpdir.name, basename)
+
+    def write_fastq(self, basename, num_reads, mate=1):
+        rng = random.Random(mate)
+        with gzip.open(self.path(basename), 'wt') as f:
+            for i in range(num_reads):
+                f.write('@read%d/%d\n%s\n+\n%s\n' % (
+                    i, mate, ''.join(rng.choice('ACGT') for _ in range(100)), 'F' * 100))
+        return self.path(basename)
+
+    def subsample(self, inputs, num_reads):
+        subsample_fastq(
+            ['--inputs'] + inputs + ['--output', self.path('sample.fastq.gz'),
+             '--counts-output', self.path('counts.json'), '--num-reads', str(num_reads)])
+        with open(self.path('counts.json')) as f:
+            counts = json.load(f)
+        with gzip.open(self.path('sample.fastq.gz'), 'rt') as f:
+            names = f.read().splitlines()[::4]
+        return counts, names
+
+    def test_estimates_the_number_of_read_pairs(self):
+        inputs = [
+            self.write_fastq('R1.fastq.gz', 20000, 1), self.write_fastq('R2.fastq.gz', 20000, 2)]
+        counts, names = self.subsample(inputs, 5000)
+        self.assertEqual(counts['sampled_reads'], 5000)
+        self.assertTrue(counts['total_reads_estimated'])
+        self.assertTrue(counts['paired'])
+        self.assertAlmostEqual(counts['total_reads'] / 20000, 1, delta=0.1)
+        # interleaved, in the order of the inputs
+        self.assertEqual(names[:4], ['@read0/1', '@read0/2', '@read1/1', '@read1/2'])
+        self.assertEqual(len(names), 10000)
+
+    def test_counts_small_inputs_exactly(self):
+        inputs = [self.write_fastq('reads.fastq.gz', 300)]
+        for num_reads in [300, 1000]:
+            counts, names = self.subsample(inputs, num_reads)
+            self.assertEqual(
+                (counts['total_reads'], counts['sampled_reads'], counts['total_reads_estimated']),
+                (300, 300, False))
+            self.assertEqual(len(names), 300)
+
+    def test_mates_with_different_numbers_of_reads(self):
+        inputs = [self.write_fastq('R1.fastq.gz', 300, 1), self.write_fastq('R2.fastq.gz', 299, 2)]
+        # a sample that ends before either file does can't tell
+        self.assertEqual(self.subsample(inputs, 100)[0]['sampled_reads'], 100)
+        for num_reads in [299, 1000]:
+            with self.assertRaisesRegex(ValueError, 'R2.fastq.gz ended'):
+                self.subsample(inputs, num_reads)